@@ -0,0 +1,67 @@
+"""
+Islandora-bagger console stand-in for benchmarks
+
+Invoked as bin/console app:islandora_bagger:create_bag --settings=... --node=ID and
+writes aip_ID.zip (a BagIt layout with a random payload of FAKE_AIP_BYTES) into
+FAKE_AIP_DIR after FAKE_BAG_SECONDS of simulated work; each bag is appended to
+FAKE_BAG_LOG as "node start end bytes". app:islandora_bagger:process_queue
+--queue=PATH bags every "node<TAB>settings" line of the queue file in one process.
+Each process first pays FAKE_BOOT_SECONDS of simulated bootstrap.
+"""
+
+import hashlib
+import os
+import sys
+import time
+import zipfile
+
+
+# write an AIP zip atomically; returns the path
+def write_aip(aip_dir, node, payload):
+    bag = f"aip_{node}"
+    manifest = f"{hashlib.sha256(payload).hexdigest()}  data/payload.bin\n"
+    path = os.path.join(aip_dir, f"{bag}.zip")
+    tmp_path = f"{path}.tmp"
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as zf:
+        zf.writestr(f"{bag}/bagit.txt", "BagIt-Version: 0.97\n")
+        zf.writestr(f"{bag}/data/payload.bin", payload)
+        zf.writestr(f"{bag}/manifest-sha256.txt", manifest)
+    os.replace(tmp_path, path)
+    return path
+
+
+#
+def create_bag(node):
+    start = time.time()
+    time.sleep(float(os.getenv("FAKE_BAG_SECONDS", "0")))
+    size = int(os.getenv("FAKE_AIP_BYTES", "4096"))
+    write_aip(os.environ["FAKE_AIP_DIR"], node, os.urandom(size))
+    if os.getenv("FAKE_BAG_LOG"):
+        with open(os.environ["FAKE_BAG_LOG"], "a") as f:
+            f.write(f"{node} {start} {time.time()} {size}\n")
+
+
+#
+def process_queue(queue_path):
+    with open(queue_path) as f:
+        entries = [line.split("\t")[0] for line in f.read().splitlines() if line]
+    for node in entries:
+        create_bag(node)
+
+
+#
+def main(argv):
+    options = dict(arg[2:].split("=", 1) for arg in argv[1:] if arg.startswith("--"))
+    time.sleep(float(os.getenv("FAKE_BOOT_SECONDS", "0")))
+    if len(argv) > 1 and argv[1] == "app:islandora_bagger:create_bag":
+        create_bag(options["node"])
+        return 0
+    if len(argv) > 1 and argv[1] == "app:islandora_bagger:process_queue":
+        process_queue(options["queue"])
+        return 0
+    print(f"unsupported command: {argv[1:]}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,200 @@
+"""
+Local Drupal stand-in for benchmarks
+
+Serves the login endpoint, the v2 preservation views and the node/media JSON
+lookups used by leaf-bagger.py and leaf-bagger-audit.py for a synthetic repository.
+"""
+
+import json
+import threading
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# synthetic repository: node changed timestamps spread evenly over this range
+_CHANGED_START = int(datetime(2022, 1, 1, tzinfo=timezone.utc).timestamp())
+_CHANGED_END = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+#
+class SyntheticRepository:
+
+    # every media_every-th node has one attached Media item changed after the node
+    def __init__(self, nodes, media_every=3, page_size=50):
+        self.nodes = nodes
+        self.media_every = media_every
+        self.page_size = page_size
+        self.step = max(1, (_CHANGED_END - _CHANGED_START) // max(1, nodes))
+
+    def node_changed(self, nid):
+        return _CHANGED_START + nid * self.step
+
+    def media_changed(self, nid):
+        return self.node_changed(nid) + self.step // 2
+
+    # media file sizes vary over two orders of magnitude
+    def media_bytes(self, nid):
+        return 1024 * (1 + (nid * 7919) % 100)
+
+    def has_media(self, nid):
+        return nid % self.media_every == 0
+
+    # preserved changed timestamp as computed by drupal.utilities
+    def changed(self, nid):
+        changed = self.node_changed(nid)
+        if self.has_media(nid):
+            changed = self.media_changed(nid)
+        return datetime.fromtimestamp(changed, tz=timezone.utc).isoformat()
+
+    # first node id changed on or after the given epoch
+    def first_changed_after(self, epoch):
+        return max(1, -(-(epoch - _CHANGED_START) // self.step))
+
+    # date filter selecting (approximately) the most recently changed fraction of nodes
+    def date_for_fraction(self, fraction):
+        nid = max(1, int(self.nodes * (1 - fraction)))
+        return datetime.fromtimestamp(self.node_changed(nid), tz=timezone.utc).strftime(
+            "%Y-%m-%d"
+        )
+
+    def _ids(self, date_filter):
+        first = 1
+        try:
+            epoch = int(
+                datetime.strptime(date_filter[:10], "%Y-%m-%d")
+                .replace(tzinfo=timezone.utc)
+                .timestamp()
+            )
+            first = self.first_changed_after(epoch)
+        except ValueError:
+            # missing or invalid filter (e.g., "None"): the view is not filtered
+            pass
+        return range(first, self.nodes + 1)
+
+    def _page(self, ids, page):
+        start = page * self.page_size
+        end = start + self.page_size
+        return ids[start:end]
+
+    def node_page(self, page, date_filter):
+        ids = self._page(self._ids(date_filter), page)
+        return [
+            {"nid": str(nid), "changed": str(self.node_changed(nid))} for nid in ids
+        ]
+
+    def media_page(self, page, date_filter):
+        first = self._ids(date_filter).start
+        first += -first % self.media_every
+        ids = self._page(range(first, self.nodes + 1, self.media_every), page)
+        return [
+            {"changed": str(self.media_changed(nid)), "field_media_of": str(nid)}
+            for nid in ids
+        ]
+
+    def node(self, nid):
+        return {
+            "nid": [{"value": nid}],
+            "changed": [
+                {
+                    "value": datetime.fromtimestamp(
+                        self.node_changed(nid), tz=timezone.utc
+                    ).isoformat()
+                }
+            ],
+        }
+
+    def node_media(self, nid):
+        if not self.has_media(nid):
+            return []
+        return [
+            {
+                "changed": [
+                    {
+                        "value": datetime.fromtimestamp(
+                            self.media_changed(nid), tz=timezone.utc
+                        ).isoformat()
+                    }
+                ],
+                "field_media_of": [{"target_id": nid}],
+                "field_file_size": [{"value": self.media_bytes(nid)}],
+            }
+        ]
+
+
+#
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body, status=200):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.path.startswith("/user/login"):
+            self.server.stats.record("login")
+            content = b"{}"
+            self.send_response(200)
+            self.send_header("Set-Cookie", "SESS=benchmark; Path=/")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self._send_json({}, 404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        page = int(query.get("page", ["0"])[0])
+        date_filter = query.get("changed", [""])[0]
+        repository = self.server.repository
+        parts = url.path.strip("/").split("/")
+        if url.path.endswith("show_node_timestamps"):
+            self.server.stats.record("crawl")
+            self._send_json(repository.node_page(page, date_filter))
+        elif url.path.endswith("show_media_timestamps"):
+            self.server.stats.record("crawl")
+            self._send_json(repository.media_page(page, date_filter))
+        elif len(parts) == 2 and parts[0] == "node":
+            self.server.stats.record("node")
+            self._send_json(repository.node(int(parts[1])))
+        elif len(parts) == 3 and parts[0] == "node" and parts[2] == "media":
+            self.server.stats.record("node")
+            self._send_json(repository.node_media(int(parts[1])))
+        else:
+            self._send_json({}, 404)
+
+
+#
+class FakeDrupal(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, repository, stats):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.repository = repository
+        self.stats = stats
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,253 @@
+"""
+Local OpenStack Swift stand-in for benchmarks
+
+Implements v1.0 auth and the container/object operations used by the bagger and the
+audit: container PUT/HEAD/GET (JSON listing with marker/prefix/limit paging) and
+object PUT/HEAD/GET. Object bodies are stored on disk; objects can also be seeded
+from existing files without a PUT.
+"""
+
+import bisect
+import email.utils
+import hashlib
+import json
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+_ACCOUNT = "AUTH_benchmark"
+_TOKEN = "benchmark-token"
+_LISTING_LIMIT = 10000
+
+
+#
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if "Content-Length" not in (headers or {}):
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _parse(self):
+        url = urlparse(self.path)
+        parts = url.path.lstrip("/").split("/", 3)
+        container = unquote(parts[2]) if len(parts) > 2 else None
+        obj = unquote(parts[3]) if len(parts) > 3 else None
+        return url, parse_qs(url.query), container, obj
+
+    def _read_body(self):
+        # stream the request body (fixed length or chunked)
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get("Content-Length", 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def do_GET(self):
+        url, query, container, obj = self._parse()
+        swift = self.server
+        if url.path.startswith("/auth/"):
+            swift.stats.record("auth")
+            self._send(
+                200,
+                {
+                    "X-Storage-Url": f"{swift.url}v1/{_ACCOUNT}",
+                    "X-Auth-Token": _TOKEN,
+                    "X-Auth-Token-Expires": "86400",
+                },
+            )
+        elif obj is None and container is not None:
+            swift.stats.record("listing")
+            marker = query.get("marker", [""])[0]
+            prefix = query.get("prefix", [""])[0]
+            limit = int(query.get("limit", [_LISTING_LIMIT])[0])
+            listing = swift.listing(container, marker, prefix, limit)
+            self._send(
+                200,
+                {"Content-Type": "application/json; charset=utf-8"},
+                json.dumps(listing).encode(),
+            )
+        elif obj is not None:
+            record = swift.get(container, obj)
+            if record is None:
+                self._send(404)
+                return
+            with open(record["path"], "rb") as f:
+                body = f.read()
+            swift.stats.record("download", nbytes=len(body))
+            self._send(200, swift.object_headers(record), body)
+        else:
+            self._send(404)
+
+    def do_HEAD(self):
+        url, query, container, obj = self._parse()
+        swift = self.server
+        if obj is None:
+            swift.stats.record("head_container")
+            self._send(204, {"X-Container-Object-Count": str(swift.count(container))})
+            return
+        swift.stats.record("head")
+        record = swift.get(container, obj)
+        if record is None:
+            self._send(404)
+        else:
+            self._send(200, swift.object_headers(record))
+
+    def do_PUT(self):
+        url, query, container, obj = self._parse()
+        swift = self.server
+        if obj is None:
+            swift.stats.record("container_put")
+            self._send(201)
+            return
+        start = time.time()
+        md5 = hashlib.md5()
+        path = swift.object_path(container, obj)
+        size = 0
+        with open(path, "wb") as f:
+            for chunk in self._read_body():
+                md5.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        headers = {
+            name.lower(): value
+            for name, value in self.headers.items()
+            if name.lower().startswith("x-object-meta-")
+            or name.lower() in ("content-type", "x-object-manifest")
+        }
+        etag = md5.hexdigest()
+        swift.put(container, obj, path, size, etag, headers)
+        swift.stats.record("upload", nbytes=size, start=start)
+        self._send(201, {"Etag": etag, "Last-Modified": _http_date(time.time())})
+
+    def do_POST(self):
+        self._send(204)
+
+    def do_DELETE(self):
+        self._send(204)
+
+
+#
+def _http_date(ts):
+    return email.utils.formatdate(ts, usegmt=True)
+
+
+#
+class FakeSwift(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, storage_dir, stats):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.storage_dir = storage_dir
+        self.stats = stats
+        self._lock = threading.Lock()
+        self._objects = {}
+        self._sorted = {}
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    @property
+    def auth_url(self):
+        return f"{self.url}auth/v1.0"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def object_path(self, container, obj):
+        directory = os.path.join(self.storage_dir, container)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, obj.replace("/", "%2F"))
+
+    # register an existing file as an object without a PUT
+    def seed(self, container, obj, path, etag, headers):
+        self.put(container, obj, path, os.path.getsize(path), etag, headers)
+
+    def put(self, container, obj, path, size, etag, headers):
+        record = {
+            "name": obj,
+            "path": path,
+            "bytes": size,
+            "hash": etag,
+            "last_modified": time.time(),
+            "headers": headers,
+        }
+        with self._lock:
+            self._objects.setdefault(container, {})[obj] = record
+            self._sorted.pop(container, None)
+
+    def get(self, container, obj):
+        with self._lock:
+            return self._objects.get(container, {}).get(obj)
+
+    def count(self, container):
+        with self._lock:
+            return len(self._objects.get(container, {}))
+
+    def listing(self, container, marker, prefix, limit):
+        with self._lock:
+            records = self._objects.get(container, {})
+            if container not in self._sorted:
+                self._sorted[container] = sorted(records)
+            names = self._sorted[container]
+            listing = []
+            start = bisect.bisect_right(names, marker)
+            for name in names[start:]:
+                if not name.startswith(prefix or ""):
+                    continue
+                record = records[name]
+                listing.append(
+                    {
+                        "name": name,
+                        "bytes": record["bytes"],
+                        "hash": record["hash"],
+                        "content_type": record["headers"].get("content-type", ""),
+                        "last_modified": time.strftime(
+                            "%Y-%m-%dT%H:%M:%S.000000",
+                            time.gmtime(record["last_modified"]),
+                        ),
+                    }
+                )
+                if len(listing) >= min(limit, _LISTING_LIMIT):
+                    break
+        return listing
+
+    @staticmethod
+    def object_headers(record):
+        return record["headers"] | {
+            "Content-Length": str(record["bytes"]),
+            "Etag": record["hash"],
+            "Last-Modified": _http_date(record["last_modified"]),
+        }
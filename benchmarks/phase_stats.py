@@ -0,0 +1,48 @@
+"""
+Per-phase request statistics collected by the benchmark stand-ins
+"""
+
+import threading
+import time
+
+
+#
+class PhaseStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {}
+
+    # count an event of a phase; the phase span runs from its first to its last event
+    def record(self, phase, count=1, nbytes=0, start=None, end=None):
+        now = time.time()
+        start = now if start is None else start
+        end = now if end is None else end
+        with self._lock:
+            value = self.phases.setdefault(
+                phase, {"first": start, "last": end, "count": 0, "bytes": 0}
+            )
+            value["first"] = min(value["first"], start)
+            value["last"] = max(value["last"], end)
+            value["count"] += count
+            value["bytes"] += nbytes
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+
+    # wall time, count and throughput per phase
+    def summary(self):
+        with self._lock:
+            phases = {name: dict(value) for name, value in self.phases.items()}
+        summary = {}
+        for name, value in phases.items():
+            wall = max(value["last"] - value["first"], 1e-6)
+            summary[name] = {
+                "wall_seconds": round(wall, 3),
+                "count": value["count"],
+                "bytes": value["bytes"],
+                "per_second": round(value["count"] / wall, 1),
+                "mb_per_second": round(value["bytes"] / wall / 1e6, 2),
+            }
+        return summary
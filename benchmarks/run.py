@@ -0,0 +1,378 @@
+##############################################################################################
+# desc: end-to-end benchmark of leaf-bagger.py and leaf-bagger-audit.py against local
+#       Drupal, OpenStack Swift and islandora-bagger stand-ins; reports per-phase wall
+#       time, throughput and peak RSS and saves the results as JSON for comparison
+# usage: python3 benchmarks/run.py \
+#          --sizes 1000,50000,500000 \
+#          --output benchmarks/results/$(date +"%Y-%m-%dT_%H-%M-%S").json \
+#          --compare benchmarks/results/previous.json \
+#          --bagger_args "--bag_workers 4 --upload_workers 4"
+# license: CC0 1.0 Universal (CC0 1.0) Public Domain Dedication
+##############################################################################################
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timezone
+
+from fake_console import write_aip
+from fake_drupal import FakeDrupal, SyntheticRepository
+from fake_swift import FakeSwift
+from phase_stats import PhaseStats
+
+_BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+_APP_DIR = os.path.join(
+    os.path.dirname(_BENCHMARK_DIR), "rootfs", "var", "www", "leaf-isle-bagger"
+)
+_CONTAINER = "benchmark"
+
+# stand-in request phases reported per script
+_PHASES = {
+    "leaf-bagger": {
+        "crawl": "crawl",
+        "bag": "bag",
+        "upload": "upload",
+        "head": "head",
+        "listing": "listing",
+        "auth": "auth",
+    },
+    "leaf-bagger-audit": {
+        "crawl": "crawl",
+        "listing": "listing",
+        "head": "audit",
+        "download": "deep",
+        "auth": "auth",
+    },
+}
+
+
+#
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        required=False,
+        help="Comma separated synthetic repository sizes (number of nodes).",
+        default="1000,50000,500000",
+    )
+    parser.add_argument(
+        "--bag_fraction",
+        required=False,
+        help="Fraction of the most recently changed nodes selected for bagging.",
+        type=float,
+        default=0.01,
+    )
+    parser.add_argument(
+        "--aip_bytes",
+        required=False,
+        help="Payload size of each generated AIP.",
+        type=int,
+        default=4096,
+    )
+    parser.add_argument(
+        "--bag_seconds",
+        required=False,
+        help="Simulated islandora-bagger work per AIP.",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--boot_seconds",
+        required=False,
+        help="Simulated islandora-bagger process startup (Symfony bootstrap, Drupal login).",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--page_size",
+        required=False,
+        help="Number of items per Drupal view page.",
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        "--bagger_args",
+        required=False,
+        help="Extra arguments passed to leaf-bagger.py.",
+        default="",
+    )
+    parser.add_argument(
+        "--audit_args",
+        required=False,
+        help="Extra arguments passed to leaf-bagger-audit.py.",
+        default="",
+    )
+    parser.add_argument(
+        "--output",
+        required=False,
+        help="Location to store the JSON results.",
+        default=os.path.join(_BENCHMARK_DIR, "results", "latest.json"),
+    )
+    parser.add_argument(
+        "--compare",
+        required=False,
+        help="JSON results of a previous run to compare against.",
+        default=None,
+    )
+    return parser.parse_args()
+
+
+# run a script to completion; wall time and peak RSS of the child process
+def run_script(script, script_args, env, log_path):
+    start = time.monotonic()
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen(
+            [sys.executable, script] + script_args,
+            cwd=_APP_DIR,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        "returncode": proc.returncode,
+        "wall_seconds": round(time.monotonic() - start, 3),
+        # Linux reports ru_maxrss in KiB
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+    }
+
+
+# record the simulated bag jobs; returns the bagged node ids
+def record_bags(stats, bag_log):
+    bagged = set()
+    if not os.path.exists(bag_log):
+        return bagged
+    with open(bag_log) as f:
+        for line in f:
+            node, start, end, size = line.split()
+            stats.record("bag", nbytes=int(size), start=float(start), end=float(end))
+            bagged.add(int(node))
+    return bagged
+
+
+# local AIPs and Swift objects for the nodes the bagger did not preserve
+def seed(repository, swift, aip_dir, skip, aip_bytes):
+    for nid in range(1, repository.nodes + 1):
+        if nid in skip:
+            continue
+        path = write_aip(aip_dir, nid, os.urandom(aip_bytes))
+        with open(path, "rb") as f:
+            content = f.read()
+        swift.seed(
+            _CONTAINER,
+            f"aip_{nid}.zip",
+            path,
+            hashlib.md5(content).hexdigest(),
+            {
+                "content-type": "application/zip",
+                "x-object-meta-last-mod-timestamp": repository.changed(nid),
+                "x-object-meta-sha256sum": hashlib.sha256(content).hexdigest(),
+            },
+        )
+
+
+# count the audit report rows by status
+def audit_status(audit_csv):
+    counts = {}
+    if os.path.exists(audit_csv):
+        with open(audit_csv, newline="") as f:
+            for row in csv.DictReader(f):
+                status = row["status"] or "ok"
+                counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+#
+def phase_summary(stats, script):
+    summary = stats.summary()
+    return {
+        label: summary[phase]
+        for phase, label in _PHASES[script].items()
+        if phase in summary
+    }
+
+
+#
+def script_env(tmp, drupal, swift, args):
+    # keep OpenStack settings of the shell from redirecting the scripts
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if not key.startswith(("OS_", "ST_"))
+    }
+    app_dir = os.path.join(tmp, "bagger_app")
+    os.makedirs(os.path.join(app_dir, "bin"))
+    console = os.path.join(app_dir, "bin", "console")
+    with open(console, "w") as f:
+        f.write(
+            "#!/bin/sh\n"
+            f'exec {shlex.quote(sys.executable)} {shlex.quote(os.path.join(_BENCHMARK_DIR, "fake_console.py"))} "$@"\n'
+        )
+    os.chmod(console, 0o755)
+    env |= {
+        "BAGGER_DRUPAL_DEFAULT_ACCOUNT_NAME": "benchmark",
+        "BAGGER_DRUPAL_DEFAULT_ACCOUNT_PASSWORD": "benchmark",
+        "BAGGER_APP_DIR": app_dir,
+        "ST_AUTH": swift.auth_url,
+        "ST_USER": "benchmark",
+        "ST_KEY": "benchmark",
+        "OS_USERNAME": "benchmark",
+        "FAKE_AIP_DIR": os.path.join(tmp, "aip"),
+        "FAKE_AIP_BYTES": str(args.aip_bytes),
+        "FAKE_BAG_SECONDS": str(args.bag_seconds),
+        "FAKE_BOOT_SECONDS": str(args.boot_seconds),
+        "FAKE_BAG_LOG": os.path.join(tmp, "bag.log"),
+    }
+    return env
+
+
+#
+def bench_size(nodes, args):
+
+    result = {}
+    stats = PhaseStats()
+    repository = SyntheticRepository(nodes, page_size=args.page_size)
+    with tempfile.TemporaryDirectory(prefix="leaf-bagger-benchmark-") as tmp:
+        aip_dir = os.path.join(tmp, "aip")
+        storage_dir = os.path.join(tmp, "swift")
+        output_dir = os.path.join(tmp, "output")
+        for directory in (aip_dir, storage_dir, output_dir):
+            os.makedirs(directory)
+
+        drupal = FakeDrupal(repository, stats).start()
+        swift = FakeSwift(storage_dir, stats).start()
+        try:
+            env = script_env(tmp, drupal, swift, args)
+
+            # preserve the recently changed nodes
+            bagger = run_script(
+                "leaf-bagger.py",
+                [
+                    "--server",
+                    drupal.url,
+                    "--output",
+                    os.path.join(output_dir, "bagger.csv"),
+                    "--error_log",
+                    os.path.join(output_dir, "bagger_error.log"),
+                    "--container",
+                    _CONTAINER,
+                    "--date",
+                    repository.date_for_fraction(args.bag_fraction),
+                    "--aip_dir",
+                    aip_dir,
+                    "--bagger_app_dir",
+                    env["BAGGER_APP_DIR"],
+                ]
+                + shlex.split(args.bagger_args),
+                env,
+                os.path.join(output_dir, "bagger.log"),
+            )
+            bagged = record_bags(stats, env["FAKE_BAG_LOG"])
+            bagger["nodes_bagged"] = len(bagged)
+            bagger["phases"] = phase_summary(stats, "leaf-bagger")
+            result["leaf-bagger"] = bagger
+            stats.reset()
+
+            # audit the full repository
+            seed_start = time.monotonic()
+            seed(repository, swift, aip_dir, bagged, args.aip_bytes)
+            result["seed_seconds"] = round(time.monotonic() - seed_start, 3)
+            audit_csv = os.path.join(output_dir, "audit.csv")
+            audit = run_script(
+                "leaf-bagger-audit.py",
+                [
+                    "--server",
+                    drupal.url,
+                    "--output",
+                    audit_csv,
+                    "--container",
+                    _CONTAINER,
+                    "--bagger_app_dir",
+                    aip_dir,
+                ]
+                + shlex.split(args.audit_args),
+                env,
+                os.path.join(output_dir, "audit.log"),
+            )
+            audit["status"] = audit_status(audit_csv)
+            audit["phases"] = phase_summary(stats, "leaf-bagger-audit")
+            result["leaf-bagger-audit"] = audit
+        finally:
+            drupal.stop()
+            swift.stop()
+
+    return result
+
+
+#
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=_BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+# print wall time and peak RSS changes against a previous run
+def compare(previous, current):
+    print(f"{'size':>8} {'script':<20} {'wall (s)':>20} {'peak RSS (MB)':>20}")
+    for size, scripts in current["results"].items():
+        for script in ("leaf-bagger", "leaf-bagger-audit"):
+            new = scripts.get(script)
+            old = previous.get("results", {}).get(size, {}).get(script)
+            if not new or not old:
+                continue
+            print(
+                f"{size:>8} {script:<20}"
+                f" {_delta(old['wall_seconds'], new['wall_seconds']):>20}"
+                f" {_delta(old['peak_rss_mb'], new['peak_rss_mb']):>20}"
+            )
+
+
+#
+def _delta(old, new):
+    change = (new - old) / old * 100 if old else 0
+    return f"{old}->{new} ({change:+.0f}%)"
+
+
+#
+def main():
+    args = parse_args()
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "results": {},
+    }
+    for size in [int(size) for size in args.sizes.split(",") if size]:
+        print(f"benchmark: {size} nodes", file=sys.stderr)
+        results["results"][str(size)] = bench_size(size, args)
+        print(json.dumps(results["results"][str(size)], indent=2), file=sys.stderr)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -28,3 +28,11 @@ def test(session):
     session.install("-r", _requirements_tests)
     session.install("-r", _requirements_app)
     session.run("pytest", *session.posargs)
+
+
+# end-to-end benchmark against local stand-ins; not run by default
+# e.g., nox -s benchmark -- --sizes 1000 --compare benchmarks/results/previous.json
+@nox.session(default=False)
+def benchmark(session):
+    session.install("-r", _requirements_app)
+    session.run("python", "benchmarks/run.py", *session.posargs)
@@ -7,7 +7,7 @@ function setup_cron {
         cat <<EOF | crontab -u nginx -
 # min   hour    day     month   weekday command
 # ${BAGGER_CROND_SCHEDULE}        cd ${BAGGER_APP_DIR} && ./bin/console app:islandora_bagger:process_queue --queue=${BAGGER_QUEUE_PATH}
-${BAGGER_CROND_SCHEDULE}        cd ${LEAF_BAGGER_APP_DIR} && ./venv/bin/python3 leaf-bagger.py --server ${BAGGER_DRUPAL_URL} --output ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_\$(date +"%Y-%m-%dT_%H-%M-%S").csv --container ${OS_CONTAINER}  --date \$(date -d "@\$((\$(date +%s) - ${LEAF_BAGGER_CROND_DATE_WINDOW}))" +"%Y-%m-%d") --error_log ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_\$(date +"%Y-%m-%dT_%H-%M-%S")_error.log; ./venv/bin/python3 leaf-bagger-audit.py --server ${BAGGER_DRUPAL_URL} --output ${LEAF_BAGGER_AUDIT_OUTPUT_DIR}/_leaf_bagger_audit_\$(date +"%Y-%m-%dT_%H-%M-%S").csv --container ${OS_CONTAINER};
+${BAGGER_CROND_SCHEDULE}        cd ${LEAF_BAGGER_APP_DIR} && ./venv/bin/python3 leaf-bagger.py --server ${BAGGER_DRUPAL_URL} --output ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_\$(date +"%Y-%m-%dT_%H-%M-%S").csv --container ${OS_CONTAINER}  --date \$(date -d "@\$((\$(date +%s) - ${LEAF_BAGGER_CROND_DATE_WINDOW}))" +"%Y-%m-%d") --error_log ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_\$(date +"%Y-%m-%dT_%H-%M-%S")_error.log --state_db ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_state.sqlite --fixity_cache ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_fixity.sqlite --dedupe_payload --largest_first --http_cache ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_http_cache.sqlite; ./venv/bin/python3 leaf-bagger-audit.py --server ${BAGGER_DRUPAL_URL} --output ${LEAF_BAGGER_AUDIT_OUTPUT_DIR}/_leaf_bagger_audit_\$(date +"%Y-%m-%dT_%H-%M-%S").csv --container ${OS_CONTAINER} --state_db ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_state.sqlite --fixity_cache ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_fixity.sqlite --rehash_older_than 30 --stream --http_cache ${LEAF_BAGGER_OUTPUT_DIR}/_leaf_bagger_http_cache.sqlite;
 EOF
     fi
 }
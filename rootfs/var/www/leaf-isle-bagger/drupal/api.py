@@ -2,28 +2,162 @@
 Drupal API utility functions
 """
 
+import logging
+import threading
+
 import requests
 
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
+from urllib3.util.retry import Retry
+
+from drupal import cache as drupalCache
+from metrics import prometheus as metricsPrometheus
+
+_AUTH_ENDPOINT = "user/login?_format=json"
+
+# responses indicating an expired or missing Drupal session
+_REAUTH_STATUS = (401, 403)
+
+# transient responses retried for idempotent requests
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+# requests session with pooled connections, explicit timeouts, retry of idempotent
+# requests with jittered exponential backoff, and transparent re-authentication
+# when the Drupal session expires during a long run
+class DrupalSession(requests.Session):
+
+    def __init__(
+        self,
+        server,
+        username,
+        password,
+        timeout=(10, 120),
+        retries=5,
+        backoff=0.5,
+        pool_size=16,
+    ):
+        super().__init__()
+        self.server = server
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        # optional drupal.cache.HttpCache consulted by GET requests of this module
+        self.cache = None
+        self._login_lock = threading.Lock()
+        self._login_generation = 0
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            status_forcelist=_RETRY_STATUS,
+            allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+            backoff_factor=backoff,
+            backoff_jitter=backoff,
+            raise_on_status=False,
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    # authenticate with Drupal; the session cookie is kept by the session
+    def login(self):
+        response = super().request(
+            "POST",
+            urljoin(self.server, _AUTH_ENDPOINT),
+            json={"name": self.username, "pass": self.password},
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        self._login_generation += 1
+        return response
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        generation = self._login_generation
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code in _REAUTH_STATUS and method.upper() in ("GET", "HEAD"):
+            with self._login_lock:
+                # another thread may have re-authenticated already
+                if generation == self._login_generation:
+                    logging.warning(
+                        f"Drupal session expired [{response.status_code}]; re-authenticating"
+                    )
+                    self.login()
+            response = super().request(method, url, *args, **kwargs)
+        return response
+
+    def close(self):
+        super().close()
+        if self.cache is not None:
+            self.cache.close()
 
 
 # initialize a session with API endpoint
 def init_session(args, username, password):
 
-    session = requests.Session()
-    # session.auth = (username, password)
-
-    auth_endpoint = "user/login?_format=json"
-    response = session.post(
-        urljoin(args.server, auth_endpoint),
-        json={"name": username, "pass": password},
-        headers={"Content-Type": "application/json"},
+    session = DrupalSession(
+        args.server,
+        username,
+        password,
+        timeout=(args.http_connect_timeout, args.http_read_timeout),
+        retries=args.http_retries,
+        pool_size=args.http_pool_size,
     )
-    response.raise_for_status()
+    if getattr(args, "http_cache", None):
+        session.cache = drupalCache.HttpCache(
+            args.http_cache,
+            ttl=args.http_cache_ttl,
+            max_bytes=int(args.http_cache_max_mb * 1024 * 1024),
+        )
+    session.login()
 
     return session
 
 
+# GET a Drupal endpoint; raise on an unsuccessful response
+# with a session cache, cached pages are reused while fresh or revalidated (304)
+def _get(session, url):
+    cache = getattr(session, "cache", None)
+    if cache is None:
+        response = session.get(url)
+        response.raise_for_status()
+        return response
+
+    entry = cache.lookup(url)
+    if entry is not None and cache.fresh(entry):
+        metricsPrometheus.inc("http_cache_requests_total", result="hit")
+        return _cached_response(url, entry)
+
+    response = session.get(url, headers=cache.validators(entry) if entry else {})
+    if response.status_code == 304 and entry is not None:
+        metricsPrometheus.inc("http_cache_requests_total", result="revalidated")
+        cache.refresh(url, response)
+        return _cached_response(url, entry)
+    response.raise_for_status()
+    metricsPrometheus.inc("http_cache_requests_total", result="miss")
+    cache.store(url, response)
+    return response
+
+
+# a response built from a cache entry
+def _cached_response(url, entry):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = entry.body
+    if entry.content_type:
+        response.headers["Content-Type"] = entry.content_type
+    return response
+
+
 #
 def node_view_endpoint(page=0, date_filter=""):
     return (
@@ -33,17 +167,7 @@ def node_view_endpoint(page=0, date_filter=""):
 
 #
 def get_node_list(session, server, page=0, date_filter=""):
-
-    response = session.get(
-        urljoin(server, node_view_endpoint(page, date_filter)),
-        # allow_redirects=config["allow_redirects"],
-        # verify=config["secure_ssl_only"],
-        # auth=(config["username"], config["password"]),
-        # params=config["query"],
-        # headers=config["headers"],
-    )
-    response.raise_for_status()
-    return response
+    return _get(session, urljoin(server, node_view_endpoint(page, date_filter)))
 
 
 #
@@ -55,20 +179,12 @@ def media_view_endpoint(page=0, date_filter=""):
 
 #
 def get_media_list(session, server, page=0, date_filter=""):
-    response = session.get(
-        urljoin(server, media_view_endpoint(page, date_filter)),
-    )
-    response.raise_for_status()
-    return response
+    return _get(session, urljoin(server, media_view_endpoint(page, date_filter)))
 
 
 #
 def get_node_by_format(session, server, item_id):
-    response = session.get(
-        urljoin(server, f"node/{item_id}?_format=json"),
-    )
-    response.raise_for_status()
-    return response
+    return _get(session, urljoin(server, f"node/{item_id}?_format=json"))
 
 
 def media_associated_with_node_endpoint(id):
@@ -77,6 +193,4 @@ def media_associated_with_node_endpoint(id):
 
 #
 def get_associated_media_by_format(session, server, id):
-    response = session.get(urljoin(server, media_associated_with_node_endpoint(id)))
-    response.raise_for_status()
-    return response
+    return _get(session, urljoin(server, media_associated_with_node_endpoint(id)))
@@ -0,0 +1,189 @@
+"""
+On-disk HTTP cache (SQLite) for Drupal GET requests
+"""
+
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+# a cached response
+CacheEntry = namedtuple(
+    "CacheEntry",
+    ["body", "content_type", "etag", "last_modified", "cache_control", "stored_at"],
+)
+
+# Cache-Control directives requiring a revalidation before every reuse
+REVALIDATE_DIRECTIVES = ("no-cache", "must-revalidate", "private")
+
+
+# Cache-Control header as a map of lowercase directive to value (None without a value)
+def parse_cache_control(header):
+    directives = {}
+    for part in (header or "").split(","):
+        name, _, value = part.partition("=")
+        name = name.strip().lower()
+        if name:
+            directives[name] = value.strip().strip('"') if value else None
+    return directives
+
+
+# max-age (seconds) of the directives; None if absent or invalid
+def max_age(directives):
+    try:
+        return int(directives["max-age"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+#
+class HttpCache:
+
+    def __init__(self, path, ttl=300, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    body BLOB,
+                    content_type TEXT,
+                    etag TEXT,
+                    last_modified TEXT,
+                    cache_control TEXT,
+                    size INTEGER,
+                    stored_at REAL,
+                    accessed_at REAL
+                )
+                """)
+            # caches created before the cache_control column
+            columns = [
+                row["name"]
+                for row in self._conn.execute("PRAGMA table_info(responses)")
+            ]
+            if "cache_control" not in columns:
+                self._conn.execute(
+                    "ALTER TABLE responses ADD COLUMN cache_control TEXT"
+                )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at"
+                " ON responses (accessed_at)"
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # cached response for the URL; None on a miss
+    def lookup(self, url):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT body, content_type, etag, last_modified, cache_control,"
+                " stored_at"
+                " FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url)
+            )
+        return CacheEntry(*row)
+
+    # True if the entry may be used without asking the server
+    # no-cache, must-revalidate and private entries are always revalidated; max-age
+    # bounds the others, and the TTL applies only without a Cache-Control directive
+    def fresh(self, entry):
+        directives = parse_cache_control(entry.cache_control)
+        if any(name in directives for name in REVALIDATE_DIRECTIVES):
+            return False
+        age = time.time() - entry.stored_at
+        if max_age(directives) is not None:
+            return age < max_age(directives)
+        if entry.etag or entry.last_modified:
+            return False
+        return age < self.ttl
+
+    # conditional request headers revalidating the entry
+    def validators(self, entry):
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    # store a successful response; responses marked no-store, or requiring a
+    # revalidation without a validator to revalidate with, are not cached
+    def store(self, url, response):
+        cache_control = response.headers.get("Cache-Control")
+        directives = parse_cache_control(cache_control)
+        validated = response.headers.get("ETag") or response.headers.get(
+            "Last-Modified"
+        )
+        if "no-store" in directives or (
+            not validated and any(name in directives for name in REVALIDATE_DIRECTIVES)
+        ):
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+            return
+        body = response.content
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (url, body, content_type, etag, last_modified, cache_control, size,"
+                " stored_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    body,
+                    response.headers.get("Content-Type"),
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    cache_control,
+                    len(body),
+                    now,
+                    now,
+                ),
+            )
+            self._evict()
+
+    # record a successful revalidation (304 Not Modified) of the entry
+    # a Cache-Control header sent with the 304 replaces the stored one
+    def refresh(self, url, response=None):
+        cache_control = response.headers.get("Cache-Control") if response else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE responses SET stored_at = ?,"
+                " cache_control = COALESCE(?, cache_control) WHERE url = ?",
+                (time.time(), cache_control, url),
+            )
+
+    # drop least recently used entries until the cache fits within max_bytes
+    def _evict(self):
+        total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        while total > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT url, size FROM responses ORDER BY accessed_at LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                self._conn.execute("DELETE FROM responses WHERE url = ?", (row["url"],))
+                total -= row["size"]
+                if total <= self.max_bytes:
+                    break
@@ -0,0 +1,151 @@
+"""
+Compact inventory of Drupal nodes selected for preservation or audit
+"""
+
+from array import array
+from datetime import datetime, timezone
+
+DEFAULT_CONTENT_TYPE = "application/zip"
+
+
+# epoch seconds of a Drupal changed value: epoch seconds (int or str) or ISO-8601
+# an ISO-8601 value without an offset is read as UTC
+def to_epoch(value):
+    if isinstance(value, int):
+        return value
+    if value.lstrip("-").isdigit():
+        return int(value)
+    changed = datetime.fromisoformat(value)
+    if changed.tzinfo is None:
+        changed = changed.replace(tzinfo=timezone.utc)
+    return int(changed.timestamp())
+
+
+# ISO-8601 (UTC) form of epoch seconds as recorded in Swift metadata and reports
+def to_iso8601(epoch):
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).isoformat()
+
+
+# a node of the inventory
+class NodeRecord:
+
+    __slots__ = ("id", "changed", "content_type")
+
+    def __init__(self, id, changed, content_type):
+        self.id = id
+        self.changed = changed
+        self.content_type = content_type
+
+    @property
+    def changed_iso(self):
+        return to_iso8601(self.changed)
+
+    def __eq__(self, other):
+        return isinstance(other, NodeRecord) and (
+            self.id,
+            self.changed,
+            self.content_type,
+        ) == (other.id, other.changed, other.content_type)
+
+    def __repr__(self):
+        return f"NodeRecord({self.id}, {self.changed_iso}, {self.content_type})"
+
+
+#
+class NodeInventory:
+
+    __slots__ = ("_ids", "_changed", "_types", "_index", "_content_types")
+
+    def __init__(self, records=()):
+        self._ids = array("q")
+        self._changed = array("q")
+        self._types = array("B")
+        self._index = {}
+        self._content_types = []
+        for id, changed, *content_type in records:
+            self.add(id, changed, *content_type)
+
+    # add a node or update the changed timestamp of a node already in the inventory
+    def add(self, id, changed, content_type=DEFAULT_CONTENT_TYPE):
+        id = int(id)
+        changed = to_epoch(changed)
+        type_index = self._type_index(content_type)
+        row = self._index.get(id)
+        if row is None:
+            self._index[id] = len(self._ids)
+            self._ids.append(id)
+            self._changed.append(changed)
+            self._types.append(type_index)
+        else:
+            self._changed[row] = changed
+            self._types[row] = type_index
+
+    # drop a node (e.g., its AIP is missing) so it is not used in subsequent steps
+    def discard(self, id):
+        self._index.pop(int(id), None)
+
+    # a new inventory of the nodes for which keep(id) is true
+    def filtered(self, keep):
+        inventory = NodeInventory()
+        for record in self.values():
+            if keep(record.id):
+                inventory.add(record.id, record.changed, record.content_type)
+        return inventory
+
+    def get(self, id, default=None):
+        row = self._index.get(id)
+        if row is None:
+            return default
+        return self._record(row)
+
+    def __getitem__(self, id):
+        row = self._index.get(id)
+        if row is None:
+            raise KeyError(id)
+        return self._record(row)
+
+    def __contains__(self, id):
+        return id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    # node ids in insertion order
+    def __iter__(self):
+        index = self._index
+        for row, id in enumerate(self._ids):
+            if index.get(id) == row:
+                yield id
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for id in self:
+            yield self._record(self._index[id])
+
+    def items(self):
+        for record in self.values():
+            yield record.id, record
+
+    def __eq__(self, other):
+        return isinstance(other, NodeInventory) and list(self.items()) == list(
+            other.items()
+        )
+
+    def __repr__(self):
+        return f"NodeInventory({list(self.values())})"
+
+    def _record(self, row):
+        return NodeRecord(
+            self._ids[row],
+            self._changed[row],
+            self._content_types[self._types[row]],
+        )
+
+    def _type_index(self, content_type):
+        try:
+            return self._content_types.index(content_type)
+        except ValueError:
+            self._content_types.append(content_type)
+            return len(self._content_types) - 1
@@ -2,16 +2,26 @@
 Script utility functions
 """
 
+import concurrent.futures
 import json
 import logging
 import os
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from getpass import getpass
 
 # local
 from drupal import api as drupalApi
+from drupal import inventory as drupalInventory
+from metrics import prometheus as metricsPrometheus
+
+# islandora-bagger settings used for AIP generation (relative to the bagger app dir)
+BAGGER_SETTINGS = "var/sample_per_bag_config.yaml"
 
 
 #
@@ -20,6 +30,28 @@ def drupal_to_iso8601(ts: int | str) -> str:
     return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
 
 
+# largest changed timestamp (ISO-8601) such that every node changed at or before it was
+# preserved; None if the earliest node was not preserved (or there are no nodes)
+def preserved_high_water_mark(node_list, preserved):
+    mark = None
+    for item in sorted(node_list.values(), key=lambda item: item.changed):
+        if item.id not in preserved:
+            break
+        mark = item.changed_iso
+    return mark
+
+
+# Drupal view date filter for the changed timestamp less a safety overlap (seconds)
+# the view parses the filter with strtotime() in the site timezone, so the value is
+# qualified as UTC ("Z", URL safe unlike "+00:00"); a mark without offset is UTC
+def date_filter_from_mark(mark, overlap=0):
+    changed = datetime.fromisoformat(mark)
+    if changed.tzinfo is None:
+        changed = changed.replace(tzinfo=timezone.utc)
+    changed = changed.astimezone(timezone.utc) - timedelta(seconds=overlap)
+    return changed.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
 #
 def get_drupal_credentials():
 
@@ -35,36 +67,131 @@ def get_drupal_credentials():
     return username, password
 
 
+# fetch the pages of a paginated Drupal view with a bounded window of concurrent requests
+# pages are probed ahead until the first empty page (the end of the view) and yielded
+# in page order as they become available, even if they arrive out of order
+def crawl_pages(fetch, window=1):
+
+    window = max(1, window)
+    results = {}
+    errors = {}
+    last_page = None
+    next_page = 0
+    next_yield = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=window) as executor:
+        pending = {}
+        while True:
+            # stop probing ahead once the end of the view is known or a page failed
+            while (
+                len(pending) < window
+                and not errors
+                and (last_page is None or next_page < last_page)
+            ):
+                pending[executor.submit(fetch, next_page)] = next_page
+                next_page += 1
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                page = pending.pop(future)
+                try:
+                    content = future.result()
+                except Exception as e:
+                    errors[page] = e
+                    continue
+                if len(content) == 0:
+                    # no more pages
+                    last_page = page if last_page is None else min(last_page, page)
+                else:
+                    results[page] = content
+
+            while next_yield in results and (
+                last_page is None or next_yield < last_page
+            ):
+                yield results.pop(next_yield)
+                next_yield += 1
+
+    # ignore failed probes beyond the end of the view
+    for page in sorted(errors):
+        if last_page is None or page < last_page:
+            raise errors[page]
+
+
 # build list of ids from Drupal Nodes
-def id_list_from_nodes(session, args):
+def id_list_from_nodes(session, args, window=1):
+
+    node_list = drupalInventory.NodeInventory()
+
+    for node_json in crawl_pages(_node_page_fetcher(session, args), window):
+        for node in node_json:
+            add_to_node_list(node_list, node["nid"], node["changed"])
+
+    return node_list
 
-    node_list = {}
-    page = 0
 
-    while True:
-        node = drupalApi.get_node_list(session, args.server, page, args.date)
-        node_json = json.loads(node.content)
+# stream the Drupal Node view page by page with Media changes merged in from a media
+# index (see media_changed_index); nodes only referenced by Media follow the last page
+def stream_nodes_with_media(session, args, media_index, window=1):
+
+    seen = set()
+    for node_json in crawl_pages(_node_page_fetcher(session, args), window):
+        node_list = drupalInventory.NodeInventory()
+        for node in node_json:
+            add_to_node_list(node_list, node["nid"], node["changed"])
+        merge_media_changed(
+            node_list,
+            {key: media_index[key] for key in node_list if key in media_index},
+        )
+        seen.update(node_list)
+        metricsPrometheus.inc("nodes_discovered_total", len(node_list))
+        yield node_list
+
+    node_list = drupalInventory.NodeInventory()
+    merge_media_changed(
+        node_list,
+        {key: value for key, value in media_index.items() if key not in seen},
+    )
+    metricsPrometheus.inc("nodes_discovered_total", len(node_list))
+    yield node_list
+
+
+# fetch and decode a page of the Drupal Node view
+def _node_page_fetcher(session, args):
+
+    def fetch(page):
+        with metricsPrometheus.timer("crawl"):
+            node = drupalApi.get_node_list(session, args.server, page, args.date)
+            node_json = json.loads(node.content)
+        metricsPrometheus.inc("drupal_pages_fetched_total", view="node")
         logging.debug("Page %s of node content: %s", page, node_json)
+        return node_json
 
-        if len(node_json) == 0:
-            # no more pages
-            break
-        else:
-            for node in node_json:
-                add_to_node_list(
-                    node_list, node["nid"], drupal_to_iso8601(node["changed"])
-                )
-            page += 1
+    return fetch
+
+
+# build list of ids from the Drupal Node and Media views crawled at the same time
+def id_list_from_views(session, args, window=1):
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        nodes = executor.submit(id_list_from_nodes, session, args, window)
+        media = executor.submit(media_changed_index, session, args, window)
+        node_list = nodes.result()
+        logging.info(f"Drupal nodes before media inclusion - {len(node_list)}")
+        merge_media_changed(node_list, media.result())
+    metricsPrometheus.inc("nodes_discovered_total", len(node_list))
     return node_list
 
 
 # build list of ids from Drupal Nodes
 def id_list_from_arg(session, args):
-    node_list = {}
+    node_list = drupalInventory.NodeInventory()
     node = drupalApi.get_node_by_format(session, args.server, args.force_single_node)
     node = json.loads(node.content)
     add_to_node_list(node_list, node["nid"][0]["value"], node["changed"][0]["value"])
+    metricsPrometheus.inc("nodes_discovered_total", len(node_list))
     return node_list
 
 
@@ -85,90 +212,283 @@ def single_node_merge_with_media(session, server, node_list, node_id):
         associated_media = json.loads(associated_media_json.content)
         for media in associated_media:
             media_changed = (
-                media["changed"][0]["value"] if ("changed" in media) else None
+                drupalInventory.to_epoch(media["changed"][0]["value"])
+                if ("changed" in media)
+                else None
             )
             node = node_list.get(node_id, None)
             if (
                 media_changed is not None
                 and node is not None
-                and node["changed"] < media_changed
+                and node.changed < media_changed
             ):
                 # media changed but the parent node did not change
-                node_list[node_id]["changed"] = media_changed
+                node_list.add(node_id, media_changed, node.content_type)
                 logging.info(f"  Updating node list changed date : {node_list}")
 
 
+# total file size of the Drupal Media attached to the node (Islandora field_file_size)
+# None if the Media cannot be retrieved
+def media_bytes(session, server, node_id):
+    try:
+        associated_media = json.loads(
+            drupalApi.get_associated_media_by_format(session, server, node_id).content
+        )
+    except Exception as e:
+        logging.error(f"  media size: node {node_id} - {e}")
+        return None
+    return sum(
+        int(value["value"])
+        for media in associated_media
+        for value in media.get("field_file_size", [])
+        if value.get("value") is not None
+    )
+
+
+# media sizes of the given nodes requested concurrently; a map of node id to bytes
+def media_bytes_index(session, server, node_ids, workers=1):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(
+            zip(
+                node_ids,
+                executor.map(
+                    lambda node_id: media_bytes(session, server, node_id), node_ids
+                ),
+            )
+        )
+
+
 # query media as media changes are not reflected as node revisions
 # exclude Drupal Media not attached to a Drupal Node
-def id_list_merge_with_media(session, args, node_list):
+def id_list_merge_with_media(session, args, node_list, window=1):
+    merge_media_changed(node_list, media_changed_index(session, args, window))
+
 
-    page = 0
-    while True:
-        media = drupalApi.get_media_list(session, args.server, page, args.date)
-        media_json = json.loads(media.content)
+# index of the most recent Media changed timestamp per associated Drupal Node
+def media_changed_index(session, args, window=1):
+
+    media_index = {}
+
+    def fetch(page):
+        with metricsPrometheus.timer("crawl"):
+            media = drupalApi.get_media_list(session, args.server, page, args.date)
+            media_json = json.loads(media.content)
+        metricsPrometheus.inc("drupal_pages_fetched_total", view="media")
         logging.debug("Page %s of media content: %s", page, media_json)
+        return media_json
 
-        if len(media_json) == 0:
-            # no more pages
-            break
-        else:
-            for media in media_json:
+    for media_json in crawl_pages(fetch, window):
+        for media in media_json:
+
+            # skip rows with a missing, null or non-integer parent id
+            media_of = None
+            try:
+                if len(media["field_media_of"]) >= 1:
+                    media_of = int(media["field_media_of"])
+            except (KeyError, TypeError, ValueError):
+                logging.error(f"Invalid media parent id {media.get('field_media_of')}")
 
-                media_of = None
-                if "field_media_of" in media and len(media["field_media_of"]) >= 1:
-                    media_of = media["field_media_of"]
+            media_changed = (
+                drupalInventory.to_epoch(media["changed"])
+                if ("changed" in media)
+                else None
+            )
 
-                media_changed = (
-                    drupal_to_iso8601(media["changed"])
-                    if ("changed" in media)
-                    else None
+            if (
+                media_of is not None
+                and media_changed is not None
+                and (
+                    media_of not in media_index or media_index[media_of] < media_changed
                 )
+            ):
+                media_index[media_of] = media_changed
 
-                if (
-                    media_of is not None
-                    and media_changed is not None
-                    and (
-                        media_of not in node_list
-                        or node_list[media_of]["changed"] < media_changed
-                    )
-                ):
-                    # media changed but the parent node did not change
-                    add_to_node_list(node_list, media_of, media_changed)
-            page += 1
+    return media_index
+
+
+# add nodes whose media changed after the node (or the node is not in the list)
+def merge_media_changed(node_list, media_index):
+    for media_of, media_changed in media_index.items():
+        if media_of not in node_list or node_list[media_of].changed < media_changed:
+            # media changed but the parent node did not change
+            add_to_node_list(node_list, media_of, media_changed)
 
 
 def add_to_node_list(node_list, id, changed):
-    node_list[id] = {"changed": changed, "content_type": "application/zip"}
+    node_list.add(id, changed, drupalInventory.DEFAULT_CONTENT_TYPE)
 
 
-# create archival information package
-def create_aip(node_list, bagger_app_path):
+# create archival information packages using a bounded pool of islandora-bagger processes
+# returns a map of node id to AIP generation success
+def create_aip(node_list, bagger_app_path, workers=1, timeout=None):
 
-    for node in list(node_list.keys()):
-        # cd ${BAGGER_APP_DIR}
-        # ./bin/console app:islandora_bagger:create_bag -vvv --settings=var/sample_per_bag_config.yaml --node=1
-        # https://docs.python.org/3/library/subprocess.html
-        logging.info(f"  Generating AIP: {node}")
-        try:
-            ret = subprocess.run(
+    aip_status = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(create_aip_node, node, bagger_app_path, timeout): node
+            for node in list(node_list.keys())
+        }
+        for future in concurrent.futures.as_completed(futures):
+            aip_status[futures[future]] = future.result()
+
+    failed = [node for node, success in aip_status.items() if not success]
+    if failed:
+        logging.error(f"  AIP generation failed for {len(failed)} node(s): {failed}")
+    return aip_status
+
+
+# create a single archival information package; stream the output into the log
+def create_aip_node(node, bagger_app_path, timeout=None):
+    with metricsPrometheus.timer("bag"):
+        success = _create_aip_node(node, bagger_app_path, timeout)
+    metricsPrometheus.inc("bags_total", result="success" if success else "failure")
+    return success
+
+
+#
+def _create_aip_node(node, bagger_app_path, timeout=None):
+
+    # cd ${BAGGER_APP_DIR}
+    # ./bin/console app:islandora_bagger:create_bag -vvv --settings=var/sample_per_bag_config.yaml --node=1
+    # https://docs.python.org/3/library/subprocess.html
+    logging.info(f"  Generating AIP: {node}")
+    return _run_bagger(
+        [
+            "./bin/console",
+            "app:islandora_bagger:create_bag",
+            f"--settings={BAGGER_SETTINGS}",
+            f"--node={node}",
+        ],
+        "node",
+        node,
+        bagger_app_path,
+        timeout,
+    )
+
+
+# create archival information packages through islandora-bagger process_queue:
+# the nodes are split into queue files of chunk_size, each bagged by one long-lived
+# process (one bootstrap and Drupal login per chunk) with up to `workers` in parallel
+# per-node success is an AIP at aip_path(node) written since the chunk started
+# the chunks start at once; returns an iterator of (node, success) for the nodes of
+# each chunk as the chunk completes
+def create_aip_queued(
+    nodes, bagger_app_path, aip_path, chunk_size=100, workers=1, timeout=None
+):
+    nodes = list(nodes)
+    chunk_size = max(1, chunk_size)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+    futures = [
+        executor.submit(
+            create_aip_chunk,
+            nodes[start:end],
+            bagger_app_path,
+            aip_path,
+            timeout,
+        )
+        for start, end in zip(
+            range(0, len(nodes), chunk_size),
+            range(chunk_size, len(nodes) + chunk_size, chunk_size),
+        )
+    ]
+    # submitted chunks still run to completion
+    executor.shutdown(wait=False)
+    return (
+        item
+        for future in concurrent.futures.as_completed(futures)
+        for item in future.result().items()
+    )
+
+
+# bag a chunk of nodes with a single process_queue run; returns a map of node to success
+def create_aip_chunk(nodes, bagger_app_path, aip_path, timeout=None):
+    # zip mtimes may have a coarser resolution than the clock
+    started = int(time.time()) - 1
+    with tempfile.NamedTemporaryFile(
+        "w", prefix="leaf_bagger_", suffix=".queue", delete=False
+    ) as queue_file:
+        for node in nodes:
+            queue_file.write(f"{node}\t{BAGGER_SETTINGS}\n")
+    logging.info(f"  Generating AIPs: {len(nodes)} node(s) via {queue_file.name}")
+    try:
+        with metricsPrometheus.timer("bag"):
+            _run_bagger(
                 [
                     "./bin/console",
-                    "app:islandora_bagger:create_bag",
-                    "--settings=var/sample_per_bag_config.yaml",
-                    f"--node={node}",
+                    "app:islandora_bagger:process_queue",
+                    f"--queue={queue_file.name}",
                 ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=False,
-                cwd=bagger_app_path,
-                text=True,
+                "queue",
+                queue_file.name,
+                bagger_app_path,
+                timeout * len(nodes) if timeout else None,
             )
-            logging.error(f"  AIP generation for node: {node}\n output: {ret.stderr}")
-            if ret.returncode != 0:
-                logging.critical(f"{ret.stdout}")
-                logging.critical(f"{ret.stderr}")
-                ret.check_returncode()
-        except subprocess.CalledProcessError as e:
-            logging.error(f"{e}")
-        except Exception as e:
-            logging.error(f"{e}")
+    finally:
+        os.unlink(queue_file.name)
+
+    # the exit status covers the whole queue; judge each node by its AIP
+    aip_status = {}
+    for node in nodes:
+        try:
+            aip_status[node] = os.path.getmtime(aip_path(node)) >= started
+        except OSError:
+            aip_status[node] = False
+        metricsPrometheus.inc(
+            "bags_total", result="success" if aip_status[node] else "failure"
+        )
+        if not aip_status[node]:
+            logging.error(f"  AIP generation for node: {node} - no AIP from queue")
+    return aip_status
+
+
+# run an islandora-bagger console command; stream the output into the log
+# returns True on a zero exit status within the time limit
+def _run_bagger(command, kind, label, bagger_app_path, timeout=None):
+
+    timed_out = threading.Event()
+    try:
+        with subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=bagger_app_path,
+            text=True,
+            start_new_session=True,
+        ) as proc:
+
+            # kill the process group so child processes do not hold the output pipe
+            # the timer may fire after the process exited but before it is cancelled
+            def kill():
+                if proc.poll() is not None:
+                    return
+                timed_out.set()
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+            timer = threading.Timer(timeout, kill) if timeout else None
+            if timer:
+                timer.start()
+            try:
+                for line in proc.stdout:
+                    logging.info(f"  AIP [{label}]: {line.rstrip()}")
+                proc.wait()
+            finally:
+                if timer:
+                    timer.cancel()
+    except Exception as e:
+        logging.error(f"  AIP generation for {kind}: {label} - {e}")
+        return False
+
+    if timed_out.is_set():
+        logging.error(
+            f"  AIP generation for {kind}: {label} - timeout after {timeout}s"
+        )
+        return False
+    if proc.returncode != 0:
+        logging.error(
+            f"  AIP generation for {kind}: {label} - exit code {proc.returncode}"
+        )
+        return False
+    return True
@@ -0,0 +1,49 @@
+##############################################################################################
+# desc: merge the shard reports of leaf-bagger-audit.py --shard i/N into a single audit
+#       report with the same columns and status codes
+# usage: python3 leaf-bagger-audit-merge.py --output ${output_path} ${shard_report} ...
+# license: CC0 1.0 Universal (CC0 1.0) Public Domain Dedication
+# date: May 15, 2024
+##############################################################################################
+
+import argparse
+import logging
+import os
+import pathlib
+
+from swift import utilities as swiftUtilities
+
+
+#
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output", required=True, help="Location to store the merged audit report."
+    )
+    parser.add_argument(
+        "--logging_level",
+        required=False,
+        help="Logging level DEBUG|INFO|ERROR.",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    )
+    parser.add_argument("reports", nargs="+", help="Shard audit reports to merge.")
+    return parser.parse_args()
+
+
+#
+def main():
+
+    args = parse_args()
+
+    logging.basicConfig(level=args.logging_level)
+
+    pathlib.Path(os.path.dirname(args.output)).mkdir(parents=True, exist_ok=True)
+    with open(args.output, "wt", encoding="utf-8", newline="") as output_file:
+        audit_fd = swiftUtilities.audit_init(output_file)
+        count = swiftUtilities.audit_merge(audit_fd, args.reports)
+    logging.info(f"Audit: merged {count} row(s) from {len(args.reports)} report(s)")
+
+
+if __name__ == "__main__":
+    main()
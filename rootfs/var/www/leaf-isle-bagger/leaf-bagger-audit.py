@@ -8,12 +8,21 @@
 ##############################################################################################
 
 import argparse
+import json
 import logging
 import os
 import pathlib
+import random
+import time
 
 from drupal import api as drupalApi
+from drupal import inventory as drupalInventory
 from drupal import utilities as drupalUtilities
+from metrics import prometheus as metricsPrometheus
+from pipeline import sampling as pipelineSampling
+from state import store as stateStore
+from swift import connection as swiftConnection
+from swift import fixity as swiftFixity
 from swift import utilities as swiftUtilities
 
 
@@ -53,27 +62,402 @@ def parse_args():
         help="Path to the Bag creation tool.",
         default=f"{os.getenv('BAGGER_OUTPUT_DIR')}",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--http_connect_timeout",
+        required=False,
+        help="Drupal connection timeout (seconds).",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "--http_read_timeout",
+        required=False,
+        help="Drupal response read timeout (seconds).",
+        type=float,
+        default=120,
+    )
+    parser.add_argument(
+        "--http_retries",
+        required=False,
+        help="Number of retries of failed idempotent Drupal requests.",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--http_pool_size",
+        required=False,
+        help="Maximum number of pooled connections to Drupal.",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "--http_cache",
+        required=False,
+        help="Path to the SQLite cache of Drupal responses (ETag/Last-Modified aware).",
+        default=None,
+    )
+    parser.add_argument(
+        "--http_cache_ttl",
+        required=False,
+        help="Reuse cached Drupal responses without Cache-Control or validators for the given seconds.",
+        type=float,
+        default=300,
+    )
+    parser.add_argument(
+        "--http_cache_max_mb",
+        required=False,
+        help="Maximum size (MB) of the Drupal response cache; least recently used evicted.",
+        type=float,
+        default=512,
+    )
+    parser.add_argument(
+        "--swift_token_cache",
+        required=False,
+        help="Path to a file (mode 0600) caching the Swift auth token between runs.",
+        default=None,
+    )
+    parser.add_argument(
+        "--swift_token_ttl",
+        required=False,
+        help="Lifetime (seconds) of a Swift auth token; reused until 5 minutes before expiry.",
+        type=float,
+        default=3600,
+    )
+    parser.add_argument(
+        "--crawl_window",
+        required=False,
+        help="Number of Drupal view pages to request concurrently.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--shard",
+        required=False,
+        help=(
+            "Audit only shard i (0-based) of N, e.g., 0/4, partitioned by node id;"
+            " merge the shard reports with leaf-bagger-audit-merge.py."
+        ),
+        type=shard_arg,
+        default=None,
+    )
+    parser.add_argument(
+        "--stream",
+        required=False,
+        help=(
+            "Index Drupal Media first, then audit Node view pages as they arrive,"
+            " writing report rows progressively."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch_size",
+        required=False,
+        help="Number of Swift objects to request per audit batch.",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--head_threads",
+        required=False,
+        help="Number of concurrent Swift object metadata requests.",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--state_db",
+        required=False,
+        help="Path to the SQLite preservation state store.",
+        default=None,
+    )
+    parser.add_argument(
+        "--export_report",
+        required=False,
+        help=(
+            "Write the audit report of every audited node in the state store to the"
+            " given CSV path (a view of --state_db)."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--fixity_cache",
+        required=False,
+        help="Path to the SQLite fixity cache of local AIP checksums.",
+        default=None,
+    )
+    parser.add_argument(
+        "--rehash_older_than",
+        "--rehash-older-than",
+        required=False,
+        help="Recompute cached AIP checksums older than the given number of days.",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--deep",
+        required=False,
+        help="Download each Swift object and verify its MD5 and SHA-256 as it streams.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--deep_workers",
+        required=False,
+        help="Number of concurrent Swift object downloads of the deep audit.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--deep_max_mbps",
+        required=False,
+        help="Bandwidth cap of the deep audit downloads in MB/s (default: no cap).",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--sample",
+        required=False,
+        help="Audit a stratified random sample of the nodes and estimate the failure rate.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--sample_confidence",
+        required=False,
+        help="Confidence level of the sampling audit failure-rate estimate.",
+        type=float,
+        default=0.95,
+    )
+    parser.add_argument(
+        "--sample_margin",
+        required=False,
+        help="Margin of error of the sampling audit failure-rate estimate.",
+        type=float,
+        default=0.02,
+    )
+    parser.add_argument(
+        "--sample_recent_days",
+        required=False,
+        help="Nodes changed within the given number of days are oversampled.",
+        type=float,
+        default=7,
+    )
+    parser.add_argument(
+        "--sample_seed",
+        required=False,
+        help="Random seed of the sampling audit (to reproduce a sample).",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--sample_report",
+        required=False,
+        help="Write the sampling audit strata and failure-rate estimate to the given JSON file.",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics_file",
+        required=False,
+        help="Write run metrics to the given Prometheus textfile (e.g., *.prom).",
+        default=None,
+    )
+    args = parser.parse_args()
+    if args.export_report and not args.state_db:
+        parser.error("--export_report requires --state_db")
+    return args
+
+
+# parse a shard argument "i/N" into (i, N)
+def shard_arg(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard (expected i/N): {value}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard (0 <= i < N): {value}")
+    return index, count
+
+
+# deep fixity settings from the arguments; None without --deep
+def deep_audit(args):
+    if not args.deep:
+        return None
+    max_bytes = args.deep_max_mbps * 1e6 if args.deep_max_mbps else None
+    return swiftUtilities.DeepAudit(args.deep_workers, max_bytes)
 
 
 #
-def process(args, session, output_file):
+def process(args, session, output_file, fixity_cache=None, state_store=None):
+
+    if state_store:
+        # record each audit row in the state store along with the CSV
+        output_file = stateStore.AuditRecorder(output_file, state_store)
+
+    if args.stream and not args.sample:
+        process_stream(args, session, output_file, fixity_cache, state_store)
+        return
 
     # a list of resources to preserve
-    node_list = {}
+    node_list = drupalInventory.NodeInventory()
 
     # get a list of Drupal Node IDs changed since a given optional date
-    node_list = drupalUtilities.id_list_from_nodes(session, args)
-    logging.info(f"Audit: Drupal nodes before media inclusion - {node_list}")
-
-    # inspect Drupal Media for changes
+    # inspect Drupal Media for changes (Node and Media views crawled concurrently)
     # a Media change is does not transitively change the associated Node change timestamp)
     # if Media changed then add associated Node ID to the list
-    drupalUtilities.id_list_merge_with_media(session, args, node_list)
+    node_list = drupalUtilities.id_list_from_views(session, args, args.crawl_window)
     logging.info(f"Audit: Drupal nodes with media changes - {node_list}")
 
+    if args.shard:
+        index, count = args.shard
+        node_list = swiftUtilities.audit_shard(node_list, index, count)
+        logging.info(f"Audit: shard {index}/{count} - {len(node_list)} node(s)")
+
+    if state_store:
+        state_store.record_discovered(node_list)
+
+    if args.sample:
+        process_sample(args, node_list, output_file, fixity_cache, state_store)
+        return
+
     # audit archival information packages
-    swiftUtilities.audit(output_file, node_list, args.bagger_app_dir, args.container)
+    swiftUtilities.audit(
+        output_file,
+        node_list,
+        args.bagger_app_dir,
+        args.container,
+        args.batch_size,
+        args.head_threads,
+        fixity_cache,
+        deep_audit(args),
+        state_store,
+    )
+
+
+# audit a stratified random sample of the nodes and estimate the repository failure rate
+def process_sample(args, node_list, output_file, fixity_cache=None, state_store=None):
+
+    # nodes without a verified Swift copy of their current version are unverified
+    verified = state_store.find_current(node_list) if state_store else None
+    recent_since = time.time() - args.sample_recent_days * 86400
+    strata = pipelineSampling.stratify(node_list, verified, recent_since)
+    sizes = {name: len(keys) for name, keys in strata.items()}
+    # the weighted allocation needs more nodes than a simple random sample
+    design_effect = pipelineSampling.design_effect(sizes)
+    allocation = pipelineSampling.allocate(
+        sizes,
+        pipelineSampling.sample_size(
+            len(node_list),
+            args.sample_confidence,
+            args.sample_margin,
+            design_effect=design_effect,
+        ),
+    )
+    sample = pipelineSampling.draw(strata, allocation, random.Random(args.sample_seed))
+    for name in strata:
+        metricsPrometheus.set_gauge(
+            "audit_sample_nodes", sizes[name], stratum=name, group="population"
+        )
+        metricsPrometheus.set_gauge(
+            "audit_sample_nodes", allocation[name], stratum=name, group="sample"
+        )
+    logging.info(
+        f"Audit: sample {sum(allocation.values())} of {len(node_list)} node(s)"
+        f" (design effect {design_effect:.2f}) - "
+        + ", ".join(f"{name} {allocation[name]}/{sizes[name]}" for name in strata)
+    )
+
+    # audit archival information packages
+    sampled_keys = {key for keys in sample.values() for key in keys}
+    tally = pipelineSampling.StatusTally(output_file)
+    swiftUtilities.audit(
+        tally,
+        node_list.filtered(lambda key: key in sampled_keys),
+        args.bagger_app_dir,
+        args.container,
+        args.batch_size,
+        args.head_threads,
+        fixity_cache,
+        deep_audit(args),
+        state_store,
+    )
+
+    # a sampled node without an audit row (e.g., a failed Swift request) is a failure
+    statuses = {
+        name: [tally.statuses.get(key) for key in keys] for name, keys in sample.items()
+    }
+    rate = pipelineSampling.failure_rate(sizes, statuses, args.sample_confidence)
+    if rate.unaudited:
+        logging.error(
+            f"Audit: {rate.unaudited} of {rate.sampled} sampled node(s) not audited;"
+            " counted as failures, upper bound 100%"
+        )
+    for bound in ("estimate", "lower", "upper"):
+        metricsPrometheus.set_gauge(
+            "audit_failure_rate", getattr(rate, bound), bound=bound
+        )
+    logging.info(
+        f"Audit: sample failure rate {rate.estimate:.2%}"
+        f" ({rate.confidence:.0%} CI {rate.lower:.2%} - {rate.upper:.2%})"
+        f" - {rate.failures} failure(s) in {rate.sampled} node(s)"
+    )
+    if args.sample_report:
+        with open(args.sample_report, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "population": sizes,
+                    "sample": allocation,
+                    "failures": {
+                        name: sum(1 for status in values if status is None or status)
+                        for name, values in statuses.items()
+                    },
+                    "unaudited": {
+                        name: sum(1 for status in values if status is None)
+                        for name, values in statuses.items()
+                    },
+                    "design_effect": design_effect,
+                    "failure_rate": rate._asdict(),
+                    "margin": args.sample_margin,
+                    "seed": args.sample_seed,
+                },
+                f,
+                indent=2,
+            )
+
+
+# index Media changes first, then audit each page of the Node view as it arrives
+def process_stream(args, session, output_file, fixity_cache=None, state_store=None):
+
+    media_index = drupalUtilities.media_changed_index(session, args, args.crawl_window)
+    logging.info(f"Audit: Drupal media index - {len(media_index)} node(s)")
+
+    def node_pages():
+        for node_list in drupalUtilities.stream_nodes_with_media(
+            session, args, media_index, args.crawl_window
+        ):
+            if args.shard:
+                node_list = swiftUtilities.audit_shard(node_list, *args.shard)
+            if state_store:
+                state_store.record_discovered(node_list)
+            yield node_list
+
+    # audit archival information packages
+    swiftUtilities.audit_stream(
+        output_file,
+        node_pages(),
+        args.bagger_app_dir,
+        args.container,
+        args.batch_size,
+        args.head_threads,
+        fixity_cache,
+        deep_audit(args),
+        state_store,
+    )
+
+
+# audit report of every node audited by this or earlier runs, from the state store
+def export_report(path, state_store):
+    with open(path, "w", encoding="utf-8", newline="") as report_file:
+        state_store.export_audit(swiftUtilities.audit_init(report_file))
+    logging.info(f"Audit: state store report - {path}")
 
 
 #
@@ -88,14 +472,41 @@ def main():
     # Options: DEBUG, INFO, WARNING, ERROR, CRITICAL
     logging.getLogger().setLevel(log_level)
 
+    metricsPrometheus.init("leaf-bagger-audit")
+    start = time.monotonic()
+
     username, password = drupalUtilities.get_drupal_credentials()
 
     session = drupalApi.init_session(args, username, password)
 
     pathlib.Path(os.path.dirname(args.output)).mkdir(parents=True, exist_ok=True)
-    with open(args.output, "wt", encoding="utf-8", newline="") as output_file:
-        audit_fd = swiftUtilities.audit_init(output_file)
-        process(args, session, audit_fd)
+    try:
+        with swiftFixity.open_cache(
+            args.fixity_cache, args.rehash_older_than
+        ) as fixity_cache:
+            with stateStore.open_store(args.state_db) as state_store:
+                # line buffered when streaming so an interrupted run leaves a partial report
+                with open(
+                    args.output,
+                    "wt",
+                    buffering=1 if args.stream else -1,
+                    encoding="utf-8",
+                    newline="",
+                ) as output_file:
+                    audit_fd = swiftUtilities.audit_init(output_file)
+                    with swiftConnection.open_service(
+                        {"object_dd_threads": args.head_threads},
+                        args.swift_token_cache,
+                        args.swift_token_ttl,
+                    ):
+                        process(args, session, audit_fd, fixity_cache, state_store)
+                if args.export_report:
+                    export_report(args.export_report, state_store)
+    finally:
+        if args.metrics_file is not None:
+            metricsPrometheus.write_textfile(
+                args.metrics_file, time.monotonic() - start
+            )
 
 
 if __name__ == "__main__":
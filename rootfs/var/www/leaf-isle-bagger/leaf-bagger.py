@@ -15,9 +15,19 @@ import argparse
 import logging
 import os
 import pathlib
+import threading
+import time
 
 from drupal import api as drupalApi
+from drupal import inventory as drupalInventory
 from drupal import utilities as drupalUtilities
+from metrics import prometheus as metricsPrometheus
+from pipeline import schedule as pipelineSchedule
+from pipeline import utilities as pipelineUtilities
+from state import journal as stateJournal
+from state import store as stateStore
+from swift import connection as swiftConnection
+from swift import fixity as swiftFixity
 from swift import utilities as swiftUtilities
 
 
@@ -71,17 +81,287 @@ def parse_args():
         help="Override node selection and process only the specified item.",
         default="",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--http_connect_timeout",
+        required=False,
+        help="Drupal connection timeout (seconds).",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "--http_read_timeout",
+        required=False,
+        help="Drupal response read timeout (seconds).",
+        type=float,
+        default=120,
+    )
+    parser.add_argument(
+        "--http_retries",
+        required=False,
+        help="Number of retries of failed idempotent Drupal requests.",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--http_pool_size",
+        required=False,
+        help="Maximum number of pooled connections to Drupal.",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "--http_cache",
+        required=False,
+        help="Path to the SQLite cache of Drupal responses (ETag/Last-Modified aware).",
+        default=None,
+    )
+    parser.add_argument(
+        "--http_cache_ttl",
+        required=False,
+        help="Reuse cached Drupal responses without Cache-Control or validators for the given seconds.",
+        type=float,
+        default=300,
+    )
+    parser.add_argument(
+        "--http_cache_max_mb",
+        required=False,
+        help="Maximum size (MB) of the Drupal response cache; least recently used evicted.",
+        type=float,
+        default=512,
+    )
+    parser.add_argument(
+        "--swift_token_cache",
+        required=False,
+        help="Path to a file (mode 0600) caching the Swift auth token between runs.",
+        default=None,
+    )
+    parser.add_argument(
+        "--swift_token_ttl",
+        required=False,
+        help="Lifetime (seconds) of a Swift auth token; reused until 5 minutes before expiry.",
+        type=float,
+        default=3600,
+    )
+    parser.add_argument(
+        "--crawl_window",
+        required=False,
+        help="Number of Drupal view pages to request concurrently.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--bag_workers",
+        required=False,
+        help="Number of islandora-bagger processes to run concurrently.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--hash_workers",
+        required=False,
+        help="Number of AIPs to checksum concurrently.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--upload_workers",
+        required=False,
+        help="Number of AIPs to upload concurrently.",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--segment_threshold",
+        required=False,
+        help="Upload AIPs larger than the given size (bytes) as segmented large objects.",
+        type=int,
+        default=swiftUtilities.DEFAULT_UPLOAD_TUNING.segment_threshold,
+    )
+    parser.add_argument(
+        "--segment_size",
+        required=False,
+        help="Minimum segment size (bytes) of segmented large objects.",
+        type=int,
+        default=swiftUtilities.DEFAULT_UPLOAD_TUNING.segment_size,
+    )
+    parser.add_argument(
+        "--max_segments",
+        required=False,
+        help="Maximum segments per large object; the segment size grows to fit.",
+        type=int,
+        default=swiftUtilities.DEFAULT_UPLOAD_TUNING.max_segments,
+    )
+    parser.add_argument(
+        "--large_object",
+        required=False,
+        help="Segmented large object type: static (slo) or dynamic (dlo).",
+        default="slo",
+        choices=["slo", "dlo"],
+    )
+    parser.add_argument(
+        "--segment_threads",
+        required=False,
+        help="Number of segments of a large object uploaded concurrently.",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--object_threads",
+        required=False,
+        help="Number of Swift object upload threads.",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--validate_workers",
+        required=False,
+        help="Number of uploads to validate concurrently.",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--queue_size",
+        required=False,
+        help="Maximum number of AIPs waiting between pipeline stages.",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "--skip_current",
+        required=False,
+        help="Skip nodes whose Swift copy matches the Drupal changed timestamp.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--reuse_aip",
+        required=False,
+        help="Skip AIP generation if the local AIP is not older than the Drupal changed timestamp.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--force_rebag",
+        required=False,
+        help="Regenerate every AIP, overriding --reuse_aip.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dedupe_payload",
+        required=False,
+        help="Skip the upload if the AIP payload manifest matches the Swift copy (metadata updated).",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bag_batch_size",
+        required=False,
+        help="Generate AIPs via islandora-bagger process_queue in batches of the given size"
+        " (--bag_workers batches in parallel); 0 runs create_bag per node.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--largest_first",
+        required=False,
+        help="Generate AIPs in descending order of estimated cost (Drupal Media size, bag history).",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bag_timeout",
+        required=False,
+        help="Time limit (seconds) for the generation of a single AIP (per node of a batch).",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--state_db",
+        required=False,
+        help="Path to the SQLite preservation state store.",
+        default=None,
+    )
+    parser.add_argument(
+        "--export_report",
+        required=False,
+        help=(
+            "Write the upload report of every node uploaded by any run to the given"
+            " CSV path (a view of --state_db)."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--since_last_run",
+        required=False,
+        help=(
+            "Select items changed since the last fully preserved change (state store"
+            " high-water mark) instead of --date; --date applies if there is no mark."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--overlap",
+        required=False,
+        help="Safety overlap (seconds) subtracted from the high-water mark.",
+        type=float,
+        default=3600,
+    )
+    parser.add_argument(
+        "--run_journal",
+        required=False,
+        help="Path to the SQLite run journal of completed stages per node.",
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        required=False,
+        help="Continue the last unfinished run of the run journal.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fixity_cache",
+        required=False,
+        help="Path to the SQLite fixity cache of local AIP checksums.",
+        default=None,
+    )
+    parser.add_argument(
+        "--rehash_older_than",
+        "--rehash-older-than",
+        required=False,
+        help="Recompute cached AIP checksums older than the given number of days.",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics_file",
+        required=False,
+        help="Write run metrics to the given Prometheus textfile (e.g., *.prom).",
+        default=None,
+    )
+    args = parser.parse_args()
+    if args.resume and not args.run_journal:
+        parser.error("--resume requires --run_journal")
+    if args.since_last_run and not args.state_db:
+        parser.error("--since_last_run requires --state_db")
+    if args.export_report and not args.state_db:
+        parser.error("--export_report requires --state_db")
+    return args
+
+
+# state store mark of the largest changed timestamp fully preserved
+_MARK = "preserved_changed"
 
 
 #
-def process(args, session):
+def process(args, session, fixity_cache=None, state_store=None, journal=None):
 
     # a list of resources to preserve
-    node_list = {}
+    node_list = drupalInventory.NodeInventory()
 
-    # get a list of Drupal Node IDs either from specified ID or via a list
-    if args.force_single_node:
+    # get a list of Drupal Node IDs either from specified ID, the unfinished run or via a list
+    resumed = journal.resume() if journal and args.resume else None
+    if resumed is not None:
+        node_list = resumed
+        logging.info(
+            f"AIP: resuming run {journal.run_id} with {len(node_list)} node(s)"
+        )
+    elif args.force_single_node:
         node_list = drupalUtilities.id_list_from_arg(session, args)
         logging.info(f"AIP: Drupal node before media inclusion - {node_list}")
         # inspect associated Drupal Media for changes
@@ -92,22 +372,57 @@ def process(args, session):
         )
         logging.info(f"AIP: Drupal node with media changes - {node_list}")
     else:
+        # poll from the high-water mark of the last run; the full --date window otherwise
+        mark = state_store.get_mark(_MARK) if args.since_last_run else None
+        if mark:
+            args.date = drupalUtilities.date_filter_from_mark(mark, args.overlap)
+            logging.info(f"AIP: changed since high-water mark {mark} - {args.date}")
         # get a list of Drupal Node IDs changed since a given optional date
-        # or a single node then force update
-        node_list = drupalUtilities.id_list_from_nodes(session, args)
-        logging.info(f"AIP: Drupal nodes before media inclusion - {node_list}")
-        # inspect associated Drupal Media for changes
+        # inspect associated Drupal Media for changes (Node and Media views crawled concurrently)
         # a Media change does not transitively update the associated Node change timestamp)
         # if Media changed but not the associated Node then add associated Node ID to the list
-        drupalUtilities.id_list_merge_with_media(session, args, node_list)
+        node_list = drupalUtilities.id_list_from_views(session, args, args.crawl_window)
         logging.info(f"AIP: Drupal nodes with media changes - {node_list}")
 
-    # create archival information packages
-    logging.info("Create AIPs")
-    drupalUtilities.create_aip(node_list, args.bagger_app_dir)
+    if resumed is None:
+        if state_store:
+            state_store.record_discovered(node_list)
+        if journal:
+            journal.start(node_list)
+
+    results = preserve(args, node_list, fixity_cache, state_store, journal, session)
+    if journal:
+        journal.finish()
+
+    # advance the high-water mark to the last change before the first unpreserved node
+    if state_store and not args.force_single_node:
+        preserved = {
+            key for key in node_list if key not in results or results[key]["success"]
+        }
+        mark = drupalUtilities.preserved_high_water_mark(node_list, preserved)
+        if mark:
+            state_store.set_mark(_MARK, mark)
+            logging.info(f"AIP: high-water mark {mark}")
+
+
+# Swift thread pools sized to the configured concurrency: large AIPs fan out over the
+# segment threads; small AIPs and object HEAD requests over the object threads
+def swift_service_options(args):
+    return {
+        "segment_threads": args.segment_threads,
+        "object_uu_threads": args.object_threads,
+        "object_dd_threads": args.object_threads,
+    }
+
+
+# stream each node through AIP generation, hashing, upload and validation
+# with bounded queues between the stages so CPU, disk and network work overlap
+# stages recorded in the run journal, if given, are skipped when still valid:
+# bagged/hashed if the local AIP is unchanged, uploaded if the Swift ETag matches
+def preserve(
+    args, node_list, fixity_cache=None, state_store=None, journal=None, session=None
+):
 
-    # upload archival information packages
-    logging.info("Upload AIPs")
     options = {
         "header": {
             "x-object-meta-project-id": "",
@@ -116,13 +431,308 @@ def process(args, session):
             "x-object-meta-promise": "",
         }
     }
-    swiftUtilities.upload_aip(
-        node_list, args.aip_dir, options, args.container, args.output
+
+    tuning = swiftUtilities.UploadTuning(
+        args.segment_threshold,
+        args.segment_size,
+        args.max_segments,
+        args.large_object == "slo",
     )
+    with swiftUtilities.swift_service(swift_service_options(args)) as swift_conn_dst:
+
+        # drop nodes already preserved with the current Drupal changed timestamp
+        skipped = set()
+        if args.skip_current and not args.force_single_node:
+            # the state store answers for nodes verified by earlier runs; Swift for the rest
+            if state_store:
+                skipped = state_store.find_current(node_list)
+            skipped |= swiftUtilities.find_current(
+                swift_conn_dst,
+                node_list.filtered(lambda key: key not in skipped),
+                args.container,
+            )
+            node_list = node_list.filtered(lambda key: key not in skipped)
+
+        # dispatch the largest estimated bag cost first (LPT) across the bag workers
+        media, costs = {}, {}
+        if args.largest_first and session is not None:
+            node_list, media, costs = schedule_largest_first(
+                args, session, node_list, state_store
+            )
+
+        # local AIPs reused instead of regenerated; bag time of the generated ones
+        reuse_aip = args.reuse_aip and not args.force_rebag
+        bag_stats = {
+            "reused": 0,
+            "generated": 0,
+            "seconds": 0.0,
+            "first_start": None,
+            "last_end": None,
+        }
+        bag_stats_lock = threading.Lock()
+        bagged_keys = []
+
+        # account for AIP generation between the given monotonic times
+        def record_bag_times(keys, bag_start, bag_end, busy_seconds):
+            with bag_stats_lock:
+                bag_stats["generated"] += len(keys)
+                bag_stats["seconds"] += busy_seconds
+                bag_stats["first_start"] = min(
+                    bag_stats["first_start"] or bag_start, bag_start
+                )
+                bag_stats["last_end"] = max(bag_stats["last_end"] or bag_end, bag_end)
+                bagged_keys.extend(keys)
+
+        start = time.monotonic()
+        with open(args.output, "w", newline="") as db_file:
+            db_writer = swiftUtilities.log_init(db_file)
+
+            # True if the node needs an AIP generated; resumed and reused AIPs do not
+            def bag_needed(key, item_values):
+                aip_path = swiftUtilities.generate_aip_path(args.aip_dir, key)
+                if journal and journal.done_with_aip(key, "bagged", aip_path):
+                    logging.info(f"  resume: AIP current - {aip_path}")
+                    return False
+                if reuse_aip and swiftUtilities.aip_current(aip_path, item_values):
+                    logging.info(f"  AIP newer than Drupal change, reused - {aip_path}")
+                    metricsPrometheus.inc("bags_total", result="reused")
+                    with bag_stats_lock:
+                        bag_stats["reused"] += 1
+                    if journal:
+                        journal.record_bagged(key, aip_path)
+                    return False
+                return True
+
+            # with --bag_batch_size, AIPs are generated by process_queue batches started
+            # ahead of the pipeline; nodes enter the pipeline as their batch completes
+            bag_status = {}
+
+            def queued_items():
+                pending = [
+                    key
+                    for key, item_values in node_list.items()
+                    if bag_needed(key, item_values)
+                ]
+                bag_start = time.monotonic()
+                bagged = drupalUtilities.create_aip_queued(
+                    pending,
+                    args.bagger_app_dir,
+                    lambda key: swiftUtilities.generate_aip_path(args.aip_dir, key),
+                    args.bag_batch_size,
+                    args.bag_workers,
+                    args.bag_timeout,
+                )
+                pending_keys = set(pending)
+                for key, item_values in node_list.items():
+                    if key not in pending_keys:
+                        yield key, item_values
+                for key, success in bagged:
+                    bag_status[key] = success
+                    yield key, node_list[key]
+                if pending:
+                    # busy time of the parallel process_queue runs
+                    bag_end = time.monotonic()
+                    record_bag_times(
+                        pending,
+                        bag_start,
+                        bag_end,
+                        (bag_end - bag_start)
+                        * min(
+                            max(1, args.bag_workers),
+                            -(-len(pending) // args.bag_batch_size),
+                        ),
+                    )
+
+            # create archival information packages
+            def bag(key, item_values):
+                aip_path = swiftUtilities.generate_aip_path(args.aip_dir, key)
+                if args.bag_batch_size:
+                    # None: the AIP was resumed or reused
+                    success = bag_status.pop(key, None)
+                    if success is None:
+                        return item_values
+                elif not bag_needed(key, item_values):
+                    return item_values
+                else:
+                    bag_start = time.monotonic()
+                    success = drupalUtilities.create_aip_node(
+                        key, args.bagger_app_dir, args.bag_timeout
+                    )
+                    bag_end = time.monotonic()
+                    record_bag_times([key], bag_start, bag_end, bag_end - bag_start)
+                    # bag time history for the cost estimates of later runs
+                    if success and state_store:
+                        state_store.record_bag_time(
+                            key, media.get(key), bag_end - bag_start
+                        )
+                if success:
+                    if journal and swiftUtilities.aip_exists(aip_path):
+                        journal.record_bagged(key, aip_path)
+                    return item_values
+                return None
 
-    # validate archival information packages
-    logging.info("Validate Upload")
-    swiftUtilities.validate(node_list, args.container)
+            # checksum archival information packages for the upload metadata
+            def checksum(key, item_values):
+                aip_path = swiftUtilities.generate_aip_path(args.aip_dir, key)
+                if journal and journal.done_with_aip(key, "hashed", aip_path):
+                    row = journal.get(key)
+                    checksums = {"md5sum": row["md5sum"], "sha256sum": row["sha256sum"]}
+                    return item_values, checksums
+                checksums = swiftUtilities.hash_aip(key, args.aip_dir, fixity_cache)
+                if checksums:
+                    if journal:
+                        journal.record_hashed(key, checksums)
+                    return item_values, checksums
+                return None
+
+            # upload archival information packages
+            def upload(key, payload):
+                item_values, checksums = payload
+                if journal and journal.done(key, "uploaded"):
+                    etag = swiftUtilities.object_etag(
+                        swift_conn_dst, key, args.container
+                    )
+                    if etag and etag == journal.get(key)["swift_etag"]:
+                        logging.info(f"  resume: Swift copy current - {key}")
+                        return item_values
+                uploaded = swiftUtilities.upload_aip_node(
+                    swift_conn_dst,
+                    key,
+                    item_values,
+                    checksums,
+                    args.aip_dir,
+                    options,
+                    args.container,
+                    db_writer,
+                    fixity_cache,
+                    tuning,
+                    args.dedupe_payload,
+                )
+                if not uploaded:
+                    return None
+                if journal:
+                    journal.record_uploaded(key, uploaded["etag"])
+                if state_store:
+                    aip_path = swiftUtilities.generate_aip_path(args.aip_dir, key)
+                    state_store.record_upload(
+                        key,
+                        item_values.changed_iso,
+                        aip_path,
+                        os.path.getsize(aip_path),
+                        uploaded["checksums"],
+                        args.container,
+                        os.getenv("OS_USERNAME"),
+                        uploaded,
+                    )
+                return item_values
+
+            # validate archival information packages
+            def validate(key, item_values):
+                if journal and journal.done(key, "validated"):
+                    return item_values
+                if not swiftUtilities.validate_node(
+                    swift_conn_dst, key, item_values, args.container
+                ):
+                    return None
+                if state_store:
+                    state_store.record_verified(key, item_values.changed_iso)
+                if journal:
+                    journal.record_validated(key)
+                return item_values
+
+            logging.info("Create, upload and validate AIPs")
+            results = pipelineUtilities.run_pipeline(
+                queued_items() if args.bag_batch_size else node_list.items(),
+                [
+                    pipelineUtilities.Stage("bag", bag, args.bag_workers),
+                    pipelineUtilities.Stage("hash", checksum, args.hash_workers),
+                    pipelineUtilities.Stage("upload", upload, args.upload_workers),
+                    pipelineUtilities.Stage(
+                        "validate", validate, args.validate_workers
+                    ),
+                ],
+                args.queue_size,
+            )
+            os.fsync(db_file)
+
+    logging.info(f"AIP: pipeline summary - {pipelineUtilities.summarize(results)}")
+    if args.skip_current:
+        # estimate from this run's mean wall time per processed node
+        elapsed = time.monotonic() - start
+        saved = f"{len(skipped) * elapsed / len(results):.0f}s" if results else "n/a"
+        logging.info(
+            f"AIP: skipped {len(skipped)} node(s) current in Swift; estimated time saved {saved}"
+        )
+    if reuse_aip:
+        # estimate from this run's mean time per generated AIP
+        saved = (
+            f"{bag_stats['reused'] * bag_stats['seconds'] / bag_stats['generated']:.0f}s"
+            if bag_stats["generated"]
+            else "n/a"
+        )
+        logging.info(
+            f"AIP: reused {bag_stats['reused']} current local AIP(s); estimated time saved {saved}"
+        )
+    if costs and bagged_keys:
+        log_makespan(args, node_list, costs, set(bagged_keys), bag_stats)
+    return results
+
+
+# reorder the node list by descending estimated bag cost: the node's last bag time
+# from the state store if known, else its Drupal Media size through the cost model
+# fitted to the bag history; returns the ordered node list, media sizes and costs
+def schedule_largest_first(args, session, node_list, state_store=None):
+    history = state_store.bag_times(node_list.keys()) if state_store else {}
+    model = (
+        pipelineSchedule.fit_cost_model(state_store.bag_history_stats())
+        if state_store
+        else pipelineSchedule.DEFAULT_BAG_COST_MODEL
+    )
+    media = drupalUtilities.media_bytes_index(
+        session,
+        args.server,
+        [key for key in node_list.keys() if key not in history],
+        args.http_pool_size,
+    )
+    costs = {
+        key: pipelineSchedule.estimate_cost(model, media.get(key), history.get(key))
+        for key in node_list.keys()
+    }
+    order = pipelineSchedule.lpt_order(costs)
+    logging.info(
+        f"AIP: largest-first schedule of {len(order)} node(s), {len(history)} from bag"
+        f" history; model {model.overhead:.1f}s + {model.seconds_per_byte * 2**20:.3f}s/MiB"
+    )
+    ordered = drupalInventory.NodeInventory(
+        (key, node_list[key].changed, node_list[key].content_type) for key in order
+    )
+    return ordered, media, costs
+
+
+# log the predicted (LPT over the estimated costs) and actual bag makespan
+def log_makespan(args, node_list, costs, bagged_keys, bag_stats):
+    order = [key for key in node_list.keys() if key in bagged_keys]
+    if args.bag_batch_size:
+        # process_queue batches are the scheduled jobs
+        jobs = {}
+        for index, key in enumerate(order):
+            batch = index // args.bag_batch_size
+            jobs[batch] = jobs.get(batch, 0.0) + costs[key]
+        predicted = pipelineSchedule.makespan(jobs, list(jobs), args.bag_workers)
+    else:
+        predicted = pipelineSchedule.makespan(costs, order, args.bag_workers)
+    actual = bag_stats["last_end"] - bag_stats["first_start"]
+    logging.info(
+        f"AIP: bag makespan predicted {predicted:.0f}s, actual {actual:.0f}s"
+        f" ({len(order)} AIP(s), {args.bag_workers} worker(s))"
+    )
+
+
+# upload report of every node uploaded by this or earlier runs, from the state store
+def export_report(path, state_store):
+    with open(path, "w", newline="") as report_file:
+        state_store.export_uploads(swiftUtilities.log_init(report_file))
+    logging.info(f"AIP: state store report - {path}")
 
 
 #
@@ -139,12 +749,36 @@ def main():
     logging.basicConfig(level=args.logging_level, handlers=logging_handlers)
     logging.getLogger("swiftclient").setLevel(logging.CRITICAL)
 
+    metricsPrometheus.init("leaf-bagger")
+    start = time.monotonic()
+
     username, password = drupalUtilities.get_drupal_credentials()
 
     session = drupalApi.init_session(args, username, password)
 
     pathlib.Path(os.path.dirname(args.output)).mkdir(parents=True, exist_ok=True)
-    process(args, session)
+    try:
+        with swiftFixity.open_cache(
+            args.fixity_cache, args.rehash_older_than
+        ) as fixity_cache:
+            with stateStore.open_store(args.state_db) as state_store:
+                # single node runs are not journaled so they never displace a resumable run
+                with stateJournal.open_journal(
+                    None if args.force_single_node else args.run_journal
+                ) as journal:
+                    with swiftConnection.open_service(
+                        swift_service_options(args),
+                        args.swift_token_cache,
+                        args.swift_token_ttl,
+                    ):
+                        process(args, session, fixity_cache, state_store, journal)
+                if args.export_report:
+                    export_report(args.export_report, state_store)
+    finally:
+        if args.metrics_file is not None:
+            metricsPrometheus.write_textfile(
+                args.metrics_file, time.monotonic() - start
+            )
 
 
 if __name__ == "__main__":
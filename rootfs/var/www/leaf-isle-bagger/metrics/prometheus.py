@@ -0,0 +1,179 @@
+"""
+Run metrics in the Prometheus textfile-collector format
+
+Counters and latency histograms are recorded in a process-wide registry and written
+at the end of a run (e.g., into the node_exporter textfile collector directory) so
+throughput regressions and quietly slower runs show up on a graph.
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+_PREFIX = "leaf_bagger_"
+
+# latency histogram bucket upper bounds (seconds)
+_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+_HELP = {
+    "drupal_pages_fetched_total": "Drupal preservation view pages fetched.",
+    "nodes_discovered_total": "Drupal nodes selected for preservation or audit.",
+    "bags_total": "AIPs generated by islandora-bagger or reused by result.",
+    "bytes_hashed_total": "Bytes of local AIPs read to compute checksums.",
+    "bytes_uploaded_total": "Bytes of AIPs uploaded to Swift.",
+    "bytes_downloaded_total": "Bytes of Swift objects downloaded by the deep audit.",
+    "uploads_deduplicated_total": "AIP uploads skipped as the Swift copy has the same payload.",
+    "swift_requests_total": "Swift requests by phase.",
+    "swift_auth_total": "Swift authentications by token source.",
+    "http_cache_requests_total": "Cached Drupal GET requests by result.",
+    "audit_records_total": "Audit report rows by status.",
+    "audit_sample_nodes": "Nodes in the sampling audit population and sample by stratum.",
+    "audit_failure_rate": "Failure-rate estimate of the sampling audit and its confidence bounds.",
+    "phase_seconds": "Latency of a unit of work (page, node or batch) by phase.",
+    "run_seconds": "Wall time of the run.",
+    "run_timestamp_seconds": "Unix time the run finished.",
+}
+
+
+#
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.const_labels = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                key, {"buckets": [0] * len(_BUCKETS), "sum": 0.0, "count": 0}
+            )
+            for index, bound in enumerate(_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    # lines in the Prometheus text exposition format
+    def render(self):
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {
+                key: {
+                    "buckets": list(value["buckets"]),
+                    "sum": value["sum"],
+                    "count": value["count"],
+                }
+                for key, value in self.histograms.items()
+            }
+
+        lines = []
+        for metrics, metric_type in ((counters, "counter"), (gauges, "gauge")):
+            for name in sorted({name for name, _ in metrics}):
+                lines += _header(name, metric_type)
+                for (metric, labels), value in sorted(metrics.items()):
+                    if metric == name:
+                        lines.append(f"{_PREFIX}{name}{self._labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines += _header(name, "histogram")
+            for (metric, labels), value in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(_BUCKETS, value["buckets"]):
+                    lines.append(
+                        f"{_PREFIX}{name}_bucket{self._labels(labels, le=bound)} {count}"
+                    )
+                lines.append(
+                    f"{_PREFIX}{name}_bucket{self._labels(labels, le='+Inf')} {value['count']}"
+                )
+                lines.append(
+                    f"{_PREFIX}{name}_sum{self._labels(labels)} {value['sum']}"
+                )
+                lines.append(
+                    f"{_PREFIX}{name}_count{self._labels(labels)} {value['count']}"
+                )
+        return lines
+
+    def _labels(self, labels, **extra):
+        items = list(self.const_labels.items()) + list(labels) + list(extra.items())
+        if not items:
+            return ""
+        values = ",".join(f'{key}="{_escape(value)}"' for key, value in items)
+        return "{" + values + "}"
+
+
+#
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+#
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+#
+def _header(name, metric_type):
+    return [
+        f"# HELP {_PREFIX}{name} {_HELP.get(name, name)}",
+        f"# TYPE {_PREFIX}{name} {metric_type}",
+    ]
+
+
+# process-wide registry used by the module functions
+REGISTRY = Registry()
+
+
+#
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+#
+def set_gauge(name, value, **labels):
+    REGISTRY.set_gauge(name, value, **labels)
+
+
+#
+def observe(name, seconds, **labels):
+    REGISTRY.observe(name, seconds, **labels)
+
+
+# record the wall time of the block in the phase latency histogram
+@contextlib.contextmanager
+def timer(phase):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        REGISTRY.observe("phase_seconds", time.monotonic() - start, phase=phase)
+
+
+# label every metric of the run with the script name
+def init(script):
+    REGISTRY.const_labels = {"script": script}
+
+
+# write the metrics atomically so the collector never reads a partial file
+def write_textfile(path, run_seconds=None):
+    if run_seconds is not None:
+        REGISTRY.set_gauge("run_seconds", run_seconds)
+    REGISTRY.set_gauge("run_timestamp_seconds", time.time())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(REGISTRY.render()) + "\n")
+    os.replace(tmp_path, path)
@@ -0,0 +1,150 @@
+"""
+Stratified random sampling audit
+"""
+
+import math
+import random
+import statistics
+
+from collections import namedtuple
+
+STRATUM_UNVERIFIED = "unverified"
+STRATUM_RECENT = "recent"
+STRATUM_SETTLED = "settled"
+
+# sample allocation weight of a node per stratum, relative to a settled node
+STRATUM_WEIGHTS = {STRATUM_UNVERIFIED: 4.0, STRATUM_RECENT: 2.0, STRATUM_SETTLED: 1.0}
+
+# failure-rate estimate and its confidence interval; unaudited of the sampled nodes
+# have no audit status and are counted among the failures
+FailureRate = namedtuple(
+    "FailureRate",
+    ["estimate", "lower", "upper", "confidence", "sampled", "failures", "unaudited"],
+)
+
+
+# two-sided standard normal quantile of a confidence level (e.g., 1.96 for 0.95)
+def z_score(confidence):
+    return statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+
+
+# nodes to sample from a population to estimate a proportion within the margin of error
+# design_effect: variance of the sampling design relative to a simple random sample
+def sample_size(
+    population, confidence=0.95, margin=0.02, proportion=0.5, design_effect=1.0
+):
+    if population <= 0:
+        return 0
+    n0 = (
+        z_score(confidence) ** 2
+        * proportion
+        * (1 - proportion)
+        / margin**2
+        * design_effect
+    )
+    return min(population, math.ceil(n0 / (1 + (n0 - 1) / population)))
+
+
+# design effect of allocating a sample by stratum size times weight (see allocate):
+# the variance sum W_h^2 p (1 - p) / n_h of the stratified estimate with population
+# shares W_h relative to p (1 - p) / n, i.e., (sum W_h / k_h) (sum W_h k_h)
+def design_effect(sizes, weights=STRATUM_WEIGHTS):
+    population = sum(sizes.values())
+    if population <= 0:
+        return 1.0
+    shares = {
+        name: (size / population, weights.get(name, 1.0))
+        for name, size in sizes.items()
+        if size
+    }
+    return sum(share / weight for share, weight in shares.values()) * sum(
+        share * weight for share, weight in shares.values()
+    )
+
+
+# the stratum of each node: never verified (or verified for an older changed
+# timestamp), changed within the recent window, or settled
+def stratify(node_list, verified, recent_since):
+    strata = {STRATUM_UNVERIFIED: [], STRATUM_RECENT: [], STRATUM_SETTLED: []}
+    for key, values in node_list.items():
+        if verified is not None and key not in verified:
+            strata[STRATUM_UNVERIFIED].append(key)
+        elif values.changed >= recent_since:
+            strata[STRATUM_RECENT].append(key)
+        else:
+            strata[STRATUM_SETTLED].append(key)
+    return strata
+
+
+# split n between the strata by size times weight; each non-empty stratum gets at
+# least min(2, size) nodes (to estimate its variance) and no more than its size
+def allocate(sizes, n, weights=STRATUM_WEIGHTS):
+    allocation = {name: min(size, 2) for name, size in sizes.items()}
+    remaining = n - sum(allocation.values())
+    while remaining > 0:
+        open_strata = {
+            name: sizes[name] * weights.get(name, 1.0)
+            for name in sizes
+            if allocation[name] < sizes[name]
+        }
+        total = sum(open_strata.values())
+        if total <= 0:
+            break
+        granted = 0
+        for name, share in sorted(open_strata.items(), key=lambda item: -item[1]):
+            extra = min(
+                sizes[name] - allocation[name],
+                max(1, math.floor(remaining * share / total)),
+                remaining - granted,
+            )
+            allocation[name] += extra
+            granted += extra
+        remaining -= granted
+    return allocation
+
+
+# a random sample of each stratum of the allocated size
+def draw(strata, allocation, rng=random):
+    return {name: rng.sample(keys, allocation[name]) for name, keys in strata.items()}
+
+
+# stratified estimate of the failure rate from the sampled statuses of each stratum;
+# with no failures observed the upper bound is the exact binomial bound
+# a None status (no audit row) is a failure and the upper bound becomes 1
+def failure_rate(sizes, sampled, confidence=0.95):
+    population = sum(sizes.values())
+    estimate = variance = 0.0
+    n = failures = unaudited = 0
+    for name, statuses in sampled.items():
+        n_h = len(statuses)
+        if not n_h:
+            continue
+        unaudited += sum(1 for status in statuses if status is None)
+        f_h = sum(1 for status in statuses if status is None or status)
+        p_h = f_h / n_h
+        share = sizes[name] / population
+        estimate += share * p_h
+        if n_h > 1:
+            variance += share**2 * (1 - n_h / sizes[name]) * p_h * (1 - p_h) / (n_h - 1)
+        n += n_h
+        failures += f_h
+    half_width = z_score(confidence) * math.sqrt(variance)
+    lower = max(0.0, estimate - half_width)
+    upper = min(1.0, estimate + half_width)
+    if n and not failures:
+        upper = max(upper, 1 - ((1 - confidence) / 2) ** (1 / n))
+    if unaudited or not n:
+        upper = 1.0
+    return FailureRate(estimate, lower, upper, confidence, n, failures, unaudited)
+
+
+# wraps an audit CSV writer to keep the status of each audited node
+class StatusTally:
+
+    def __init__(self, audit_writer):
+        self.audit_writer = audit_writer
+        self.statuses = {}
+
+    def writerow(self, row):
+        self.audit_writer.writerow(row)
+        self.statuses[int(row["drupal_id"])] = row["status"]
@@ -0,0 +1,46 @@
+"""
+Largest-first (LPT) scheduling of AIP generation
+"""
+
+import heapq
+
+from collections import namedtuple
+
+# estimated bag seconds = overhead + media bytes * seconds_per_byte
+BagCostModel = namedtuple("BagCostModel", ["overhead", "seconds_per_byte"])
+
+# used until the bag history holds enough distinct samples to fit the model
+DEFAULT_BAG_COST_MODEL = BagCostModel(10.0, 1 / (20 * 1024 * 1024))
+
+
+# least squares fit of the model to the bag history sums (see StateStore.bag_history_stats)
+def fit_cost_model(stats, default=DEFAULT_BAG_COST_MODEL):
+    n, sum_x, sum_y, sum_xx, sum_xy = stats
+    denominator = n * sum_xx - sum_x * sum_x
+    if n < 2 or denominator <= 0:
+        return default
+    slope = (n * sum_xy - sum_x * sum_y) / denominator
+    if slope <= 0:
+        return default
+    overhead = (sum_y - slope * sum_x) / n
+    return BagCostModel(max(0.0, overhead), slope)
+
+
+# estimated bag seconds of a node: its last bag time if known, else the model estimate
+def estimate_cost(model, media_bytes, history=None):
+    if history is not None:
+        return history
+    return model.overhead + (media_bytes or 0) * model.seconds_per_byte
+
+
+# keys in descending cost order; ties keep the given order
+def lpt_order(costs):
+    return sorted(costs, key=lambda key: -costs[key])
+
+
+# makespan of list scheduling the keys in order on the given number of workers
+def makespan(costs, order, workers=1):
+    finish = [0.0] * max(1, workers)
+    for key in order:
+        heapq.heapreplace(finish, finish[0] + costs[key])
+    return max(finish)
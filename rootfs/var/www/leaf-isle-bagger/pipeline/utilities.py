@@ -0,0 +1,90 @@
+"""
+Staged pipeline utility functions
+
+Items flow through a sequence of stages connected by bounded queues; each stage has
+its own pool of worker threads so work in different stages (e.g., CPU, disk, network)
+overlaps instead of waiting on a barrier between steps.
+"""
+
+import logging
+import queue
+import threading
+
+from collections import namedtuple
+
+# name: label used in logs and results
+# func: callable(key, payload) returning the payload for the next stage or None on failure
+# workers: number of concurrent workers for the stage
+Stage = namedtuple("Stage", ["name", "func", "workers"])
+
+_STAGE_DONE = object()
+
+
+# run each (key, payload) item through the stages in order
+# returns a map of key to {"stage": last stage attempted, "success": bool}
+def run_pipeline(items, stages, queue_size=16):
+
+    results = {}
+    results_lock = threading.Lock()
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+
+    def record(key, stage, success):
+        with results_lock:
+            results[key] = {"stage": stage.name, "success": success}
+
+    def worker(index):
+        stage = stages[index]
+        while True:
+            item = queues[index].get()
+            if item is _STAGE_DONE:
+                break
+            key, payload = item
+            try:
+                payload = stage.func(key, payload)
+            except Exception as e:
+                logging.error(f"  {stage.name}: {key} - {e}")
+                payload = None
+            if payload is None:
+                logging.error(f"  {stage.name}: {key} - failed")
+                record(key, stage, False)
+            elif index + 1 < len(stages):
+                record(key, stage, True)
+                queues[index + 1].put((key, payload))
+            else:
+                record(key, stage, True)
+
+    threads = []
+    for index, stage in enumerate(stages):
+        stage_threads = [
+            threading.Thread(
+                target=worker, args=(index,), name=f"{stage.name}-{n}", daemon=True
+            )
+            for n in range(max(1, stage.workers))
+        ]
+        for thread in stage_threads:
+            thread.start()
+        threads.append(stage_threads)
+
+    # feed the first stage; blocks while the first queue is full
+    # stop the stages even if iterating items raises, then re-raise
+    try:
+        for item in items:
+            queues[0].put(item)
+    finally:
+        # drain stages in order so each stage finishes before its successor is stopped
+        for index, stage_threads in enumerate(threads):
+            for _ in stage_threads:
+                queues[index].put(_STAGE_DONE)
+            for thread in stage_threads:
+                thread.join()
+
+    return results
+
+
+# count the items that completed all stages and the failures per stage
+def summarize(results):
+    summary = {"success": 0}
+    for value in results.values():
+        key = "success" if value["success"] else value["stage"]
+        summary[key] = summary.get(key, 0) + 1
+    return summary
@@ -0,0 +1,184 @@
+"""
+Run journal (SQLite) for checkpointed, resumable preservation runs
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+from drupal import inventory as drupalInventory
+
+# pipeline stages in completion order
+STAGES = ("discovered", "bagged", "hashed", "uploaded", "validated")
+
+
+#
+class RunJournal:
+
+    def __init__(self, path):
+        self.path = path
+        self.run_id = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            # one small commit per node stage; WAL keeps them cheap
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    status TEXT,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS run_nodes (
+                    run_id INTEGER,
+                    node_id TEXT,
+                    changed INTEGER,
+                    content_type TEXT,
+                    stage TEXT,
+                    aip_size INTEGER,
+                    aip_mtime_ns INTEGER,
+                    md5sum TEXT,
+                    sha256sum TEXT,
+                    swift_etag TEXT,
+                    updated_at REAL,
+                    PRIMARY KEY (run_id, node_id)
+                )
+                """)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # start a new run with the discovered node list; earlier unfinished runs are abandoned
+    def start(self, node_list):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE runs SET status = 'abandoned' WHERE status = 'running'"
+            )
+            self.run_id = self._conn.execute(
+                "INSERT INTO runs (status, started_at) VALUES ('running', ?)", (now,)
+            ).lastrowid
+            self._conn.executemany(
+                "INSERT INTO run_nodes"
+                " (run_id, node_id, changed, content_type, stage, updated_at)"
+                " VALUES (?, ?, ?, ?, 'discovered', ?)",
+                [
+                    (self.run_id, str(key), values.changed, values.content_type, now)
+                    for key, values in node_list.items()
+                ],
+            )
+        return self.run_id
+
+    # continue the last unfinished run; returns its node list or None if there is none
+    def resume(self):
+        with self._lock:
+            run = self._conn.execute(
+                "SELECT run_id FROM runs WHERE status = 'running'"
+                " ORDER BY run_id DESC LIMIT 1"
+            ).fetchone()
+            if run is None:
+                return None
+            self.run_id = run["run_id"]
+            rows = self._conn.execute(
+                "SELECT node_id, changed, content_type FROM run_nodes WHERE run_id = ?"
+                " ORDER BY rowid",
+                (self.run_id,),
+            ).fetchall()
+        return drupalInventory.NodeInventory(
+            (row["node_id"], row["changed"], row["content_type"]) for row in rows
+        )
+
+    # mark the current run complete so it is not resumed
+    def finish(self):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE runs SET status = 'finished', finished_at = ? WHERE run_id = ?",
+                (time.time(), self.run_id),
+            )
+
+    # recorded state of a node in the current run; None if unknown
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM run_nodes WHERE run_id = ? AND node_id = ?",
+                (self.run_id, str(key)),
+            ).fetchone()
+        return dict(row) if row else None
+
+    # True if the node completed the given stage in the current run
+    def done(self, key, stage):
+        row = self.get(key)
+        return row is not None and STAGES.index(row["stage"]) >= STAGES.index(stage)
+
+    # True if the node completed the stage and its AIP is unchanged since
+    def done_with_aip(self, key, stage, aip_path):
+        row = self.get(key)
+        if row is None or STAGES.index(row["stage"]) < STAGES.index(stage):
+            return False
+        try:
+            stat_result = os.stat(aip_path)
+        except OSError:
+            return False
+        return (stat_result.st_size, stat_result.st_mtime_ns) == (
+            row["aip_size"],
+            row["aip_mtime_ns"],
+        )
+
+    # record the AIP generated for the node
+    def record_bagged(self, key, aip_path):
+        stat_result = os.stat(aip_path)
+        self._record(
+            key,
+            "bagged",
+            aip_size=stat_result.st_size,
+            aip_mtime_ns=stat_result.st_mtime_ns,
+        )
+
+    # record the AIP checksums of the node
+    def record_hashed(self, key, checksums):
+        self._record(
+            key,
+            "hashed",
+            md5sum=checksums["md5sum"],
+            sha256sum=checksums["sha256sum"],
+        )
+
+    # record the Swift ETag of the uploaded AIP
+    def record_uploaded(self, key, etag):
+        self._record(key, "uploaded", swift_etag=etag)
+
+    # record the uploaded AIP as validated
+    def record_validated(self, key):
+        self._record(key, "validated")
+
+    #
+    def _record(self, key, stage, **columns):
+        columns["stage"] = stage
+        columns["updated_at"] = time.time()
+        updates = ", ".join(f"{column} = ?" for column in columns)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE run_nodes SET {updates} WHERE run_id = ? AND node_id = ?",
+                list(columns.values()) + [self.run_id, str(key)],
+            )
+
+
+# open the run journal if a path is given; a context manager yielding None otherwise
+def open_journal(path):
+    if not path:
+        return contextlib.nullcontext(None)
+    return RunJournal(path)
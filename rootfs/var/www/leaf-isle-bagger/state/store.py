@@ -0,0 +1,302 @@
+"""
+Local preservation state store (SQLite) of each Drupal node
+"""
+
+import contextlib
+import sqlite3
+import threading
+import time
+
+
+#
+class StateStore:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS nodes (
+                    node_id TEXT PRIMARY KEY,
+                    drupal_changed TEXT,
+                    preserved_changed TEXT,
+                    aip_path TEXT,
+                    aip_size INTEGER,
+                    md5sum TEXT,
+                    sha256sum TEXT,
+                    container_name TEXT,
+                    uploaded_by TEXT,
+                    swift_uploaded_at TEXT,
+                    swift_etag TEXT,
+                    last_verified_at REAL,
+                    audit_status TEXT,
+                    audit_swift_timestamp TEXT,
+                    audit_swift_meta_changed TEXT,
+                    audit_swift_bytes TEXT,
+                    audited_at REAL
+                )
+                """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS nodes_audit_status ON nodes (audit_status)"
+            )
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS marks (
+                    name TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at REAL
+                )
+                """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS bag_history (
+                    node_id TEXT PRIMARY KEY,
+                    media_bytes INTEGER,
+                    bag_seconds REAL,
+                    bagged_at REAL
+                )
+                """)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # record the Drupal changed timestamp of discovered nodes in one transaction
+    def record_discovered(self, node_list):
+        self._upsert_many(
+            ["drupal_changed"],
+            [(str(key), values.changed_iso) for key, values in node_list.items()],
+        )
+
+    # record a verified upload of the node's AIP
+    def record_upload(
+        self, key, changed, aip_path, aip_size, checksums, container, uploaded_by, dst
+    ):
+        self._upsert_many(
+            [
+                "drupal_changed",
+                "aip_path",
+                "aip_size",
+                "md5sum",
+                "sha256sum",
+                "container_name",
+                "uploaded_by",
+                "swift_uploaded_at",
+                "swift_etag",
+            ],
+            [
+                (
+                    str(key),
+                    changed,
+                    aip_path,
+                    aip_size,
+                    checksums["md5sum"],
+                    checksums["sha256sum"],
+                    container,
+                    uploaded_by,
+                    dst["last_modified"],
+                    dst["etag"],
+                )
+            ],
+        )
+
+    # record the Swift copy of the node as verified for the given changed timestamp
+    def record_verified(self, key, changed):
+        self._upsert_many(
+            ["preserved_changed", "last_verified_at"],
+            [(str(key), changed, time.time())],
+        )
+
+    # record an audit result; a successful audit also verifies the Swift copy
+    def record_audit(self, row):
+        columns = [
+            "drupal_changed",
+            "audit_swift_timestamp",
+            "audit_swift_meta_changed",
+            "audit_swift_bytes",
+            "audit_status",
+            "audited_at",
+        ]
+        values = [
+            str(row["drupal_id"]),
+            row["drupal_changed"],
+            row["swift_timestamp"],
+            row["swift_meta_changed"],
+            row["swift_bytes"],
+            row["status"],
+            time.time(),
+        ]
+        if row["status"] == "":
+            columns += ["preserved_changed", "last_verified_at"]
+            values += [row["drupal_changed"], time.time()]
+        self._upsert_many(columns, [tuple(values)])
+
+    # state of a single node; None if unknown
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM nodes WHERE node_id = ?", (str(key),)
+            ).fetchone()
+        return dict(row) if row else None
+
+    # state of each given node keyed as given; unknown nodes are absent
+    def get_many(self, keys):
+        keys = list(keys)
+        names = {str(key): key for key in keys}
+        states = {}
+        with self._lock:
+            # bounded by the SQLite host parameter limit
+            for start in range(0, len(keys), 500):
+                end = start + 500
+                batch = [str(key) for key in keys[start:end]]
+                rows = self._conn.execute(
+                    "SELECT * FROM nodes WHERE node_id IN"
+                    f" ({', '.join(['?'] * len(batch))})",
+                    batch,
+                ).fetchall()
+                for row in rows:
+                    states[names[row["node_id"]]] = dict(row)
+        return states
+
+    # keys of the nodes whose verified Swift copy matches the given changed timestamp
+    def find_current(self, node_list):
+        current = set()
+        with self._lock:
+            for key, values in node_list.items():
+                row = self._conn.execute(
+                    "SELECT preserved_changed FROM nodes WHERE node_id = ?", (str(key),)
+                ).fetchone()
+                if row and row["preserved_changed"] == values.changed_iso:
+                    current.add(key)
+        return current
+
+    # named run marks (e.g., the preserved high-water mark); None if unset
+    def get_mark(self, name):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM marks WHERE name = ?", (name,)
+            ).fetchone()
+        return row["value"] if row else None
+
+    #
+    def set_mark(self, name, value):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO marks (name, value, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET"
+                " value = excluded.value, updated_at = excluded.updated_at",
+                (name, value, time.time()),
+            )
+
+    # record the measured AIP generation time of the node and its Drupal Media size
+    def record_bag_time(self, key, media_bytes, seconds):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO bag_history (node_id, media_bytes, bag_seconds, bagged_at)"
+                " VALUES (?, ?, ?, ?) ON CONFLICT (node_id) DO UPDATE SET"
+                " media_bytes = COALESCE(excluded.media_bytes, bag_history.media_bytes),"
+                " bag_seconds = excluded.bag_seconds, bagged_at = excluded.bagged_at",
+                (str(key), media_bytes, seconds, time.time()),
+            )
+
+    # last AIP generation time of each given node with a recorded bag time
+    def bag_times(self, keys):
+        times = {}
+        with self._lock:
+            for key in keys:
+                row = self._conn.execute(
+                    "SELECT bag_seconds FROM bag_history WHERE node_id = ?", (str(key),)
+                ).fetchone()
+                if row:
+                    times[key] = row["bag_seconds"]
+        return times
+
+    # (n, sum x, sum y, sum x^2, sum xy) of media bytes x and bag seconds y
+    def bag_history_stats(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*), TOTAL(media_bytes), TOTAL(bag_seconds),"
+                " TOTAL(1.0 * media_bytes * media_bytes),"
+                " TOTAL(1.0 * media_bytes * bag_seconds)"
+                " FROM bag_history WHERE media_bytes IS NOT NULL"
+            ).fetchone()
+        return tuple(row)
+
+    # emit the upload report (see swift.utilities.log_init) as a view of the store
+    def export_uploads(self, db_writer):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM nodes WHERE swift_uploaded_at IS NOT NULL"
+                " ORDER BY CAST(node_id AS INTEGER), node_id"
+            ).fetchall()
+        for row in rows:
+            db_writer.writerow(
+                {
+                    "id": f"aip_{row['node_id']}.zip",
+                    "md5sum": row["md5sum"],
+                    "sha256sum": row["sha256sum"],
+                    "uploaded_by": row["uploaded_by"],
+                    "last_updated_at": row["swift_uploaded_at"],
+                    "container_name": row["container_name"],
+                    "notes": "",
+                }
+            )
+
+    # emit the audit report (see swift.utilities.audit_init) as a view of the store
+    def export_audit(self, audit_writer):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM nodes WHERE audited_at IS NOT NULL"
+                " ORDER BY CAST(node_id AS INTEGER), node_id"
+            ).fetchall()
+        for row in rows:
+            audit_writer.writerow(
+                {
+                    "drupal_id": row["node_id"],
+                    "drupal_changed": row["drupal_changed"],
+                    "swift_id": (
+                        f"aip_{row['node_id']}.zip" if row["audit_swift_bytes"] else ""
+                    ),
+                    "swift_timestamp": row["audit_swift_timestamp"],
+                    "swift_meta_changed": row["audit_swift_meta_changed"],
+                    "swift_bytes": row["audit_swift_bytes"],
+                    "status": row["audit_status"],
+                }
+            )
+
+    # insert or update the given columns of the rows keyed by node_id
+    def _upsert_many(self, columns, rows):
+        names = ", ".join(["node_id"] + columns)
+        placeholders = ", ".join(["?"] * (len(columns) + 1))
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO nodes ({names}) VALUES ({placeholders})"
+                f" ON CONFLICT (node_id) DO UPDATE SET {updates}",
+                rows,
+            )
+
+
+# wraps an audit CSV writer so each audit row is also recorded in the store
+class AuditRecorder:
+
+    def __init__(self, audit_writer, state_store):
+        self.audit_writer = audit_writer
+        self.state_store = state_store
+
+    def writerow(self, row):
+        self.audit_writer.writerow(row)
+        self.state_store.record_audit(row)
+
+
+# open the state store if a path is given; a context manager yielding None otherwise
+def open_store(path):
+    if not path:
+        return contextlib.nullcontext(None)
+    return StateStore(path)
@@ -0,0 +1,196 @@
+"""
+Shared Swift service and authentication token cache
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import prometheus as metricsPrometheus
+from swiftclient.multithreading import MultiThreadingManager
+from swiftclient.service import (
+    SwiftService,
+    _default_global_options,
+    _default_local_options,
+    get_conn,
+    process_options,
+)
+
+# Keystone's default token lifetime; tokens are not reused within the margin of expiry
+DEFAULT_TOKEN_TTL = 3600
+_EXPIRY_MARGIN = 300
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+#
+class TokenCache:
+
+    def __init__(self, path, ttl=DEFAULT_TOKEN_TTL, margin=_EXPIRY_MARGIN):
+        self.path = path
+        self.ttl = ttl
+        self.margin = margin
+
+    # (storage URL, token) cached for the identity; None if missing or near expiry
+    def load(self, identity):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (
+            entry.get("identity") != identity
+            or entry.get("expires_at", 0) - self.margin <= time.time()
+        ):
+            return None
+        return entry["storage_url"], entry["token"]
+
+    # replace the cached token; only the owner may read the file
+    def store(self, identity, storage_url, token):
+        entry = {
+            "identity": identity,
+            "storage_url": storage_url,
+            "token": token,
+            "expires_at": time.time() + self.ttl,
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self.path)
+
+    # drop the cached token of the identity (e.g., revoked)
+    def invalidate(self, identity):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entry = json.load(f)
+            if entry.get("identity") == identity:
+                os.remove(self.path)
+        except (OSError, ValueError):
+            pass
+
+
+# digest of the account a token belongs to (auth URL, user, project, region)
+def auth_identity(options):
+    os_options = options.get("os_options") or {}
+    fields = [
+        options.get("auth"),
+        options.get("auth_version"),
+        options.get("user"),
+        os_options.get("project_name") or os_options.get("tenant_name"),
+        os_options.get("project_id") or os_options.get("tenant_id"),
+        os_options.get("region_name"),
+    ]
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+# SwiftService options resolved, as SwiftService does, from the options and the
+# OS_* environment
+def resolve_options(options=None):
+    resolved = dict(_default_global_options, **_default_local_options)
+    resolved.update(options or {})
+    process_options(resolved)
+    return resolved
+
+
+# save a token in the cache; a cache write failure is logged
+def _cache_token(token_cache, identity, storage_url, token):
+    try:
+        token_cache.store(identity, storage_url, token)
+    except OSError as e:
+        logging.error(f"swift token cache - [{token_cache.path}] - {e}")
+
+
+# (storage URL, token) of the resolved options from the cache or a single
+# authentication; None (each connection authenticates itself) if authentication fails
+def authenticate(options, token_cache=None):
+    identity = auth_identity(options)
+    cached = token_cache.load(identity) if token_cache else None
+    if cached:
+        metricsPrometheus.inc("swift_auth_total", source="cache")
+        return cached
+    try:
+        storage_url, token = get_conn(options).get_auth()
+    except Exception as e:
+        logging.error(f"swift auth - {e}")
+        return None
+    metricsPrometheus.inc("swift_auth_total", source="keystone")
+    if token_cache:
+        _cache_token(token_cache, identity, storage_url, token)
+    return storage_url, token
+
+
+# SwiftService whose connections start from the given (storage URL, token), if any;
+# a connection re-authenticating (e.g., after a 401) replaces the token for later
+# connections and in the token cache
+class SharedService(SwiftService):
+
+    def __init__(self, options=None, auth=None, token_cache=None):
+        super().__init__(options)
+        self.connection_options = resolve_options(options)
+        self.auth = auth
+        self.token_cache = token_cache
+        self._identity = auth_identity(self.connection_options)
+        self.thread_manager = MultiThreadingManager(
+            self.new_connection,
+            segment_threads=self.connection_options["segment_threads"],
+            object_dd_threads=self.connection_options["object_dd_threads"],
+            object_uu_threads=self.connection_options["object_uu_threads"],
+            container_threads=self.connection_options["container_threads"],
+        )
+
+    # a swiftclient Connection (one per thread; not thread-safe)
+    def new_connection(self):
+        conn = get_conn(self.connection_options)
+        if self.auth:
+            conn.url, conn.token = self.auth
+        get_auth = conn.get_auth
+
+        def reauthenticate():
+            try:
+                storage_url, token = get_auth()
+            except Exception:
+                if self.token_cache:
+                    self.token_cache.invalidate(self._identity)
+                raise
+            metricsPrometheus.inc("swift_auth_total", source="reauth")
+            self.auth = (storage_url, token)
+            if self.token_cache:
+                _cache_token(self.token_cache, self._identity, storage_url, token)
+            return storage_url, token
+
+        conn.get_auth = reauthenticate
+        return conn
+
+
+# open the process-wide Swift service; swift.utilities.swift_service returns it until closed
+@contextlib.contextmanager
+def open_service(options=None, token_cache_path=None, token_ttl=DEFAULT_TOKEN_TTL):
+    global _shared
+    token_cache = TokenCache(token_cache_path, token_ttl) if token_cache_path else None
+    auth = authenticate(resolve_options(options), token_cache)
+    with SharedService(options, auth, token_cache) as service:
+        with _shared_lock:
+            _shared = service
+        try:
+            yield service
+        finally:
+            with _shared_lock:
+                _shared = None
+
+
+# the Swift service opened by open_service; None outside of it
+def shared_service():
+    with _shared_lock:
+        return _shared
+
+
+# a swiftclient Connection with the options (and pre-authentication) of the service
+# for streaming requests the service does not offer (one per thread; not thread-safe)
+def new_connection(service):
+    return service.new_connection()
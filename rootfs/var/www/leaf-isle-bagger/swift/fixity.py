@@ -0,0 +1,109 @@
+"""
+Persistent fixity (checksum) cache
+
+Checksums of local AIPs are stored in a small SQLite database keyed on the file path
+and validated against the file size, mtime_ns and inode so an unchanged AIP is not
+re-read; a cache hit costs a stat() call.
+"""
+
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+
+
+#
+class FixityCache:
+
+    # rehash_older_than: seconds after which a cached checksum is recomputed
+    #   (a rotating fixity check); None to trust the cache indefinitely
+    def __init__(self, path, rehash_older_than=None):
+        self.path = path
+        self.rehash_older_than = rehash_older_than
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS fixity (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    md5sum TEXT NOT NULL,
+                    sha256sum TEXT NOT NULL,
+                    hashed_at REAL NOT NULL
+                )
+                """)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # cached checksums if the file is unchanged and the entry is not due a rehash
+    def lookup(self, path, stat_result):
+        row = self._get(path)
+        if row is None or not self._matches(row, stat_result):
+            return None
+        if (
+            self.rehash_older_than is not None
+            and time.time() - row[6] > self.rehash_older_than
+        ):
+            return None
+        return {"md5sum": row[4], "sha256sum": row[5]}
+
+    # store checksums computed for the file as described by stat_result
+    def store(self, path, stat_result, checksums):
+        row = self._get(path)
+        if (
+            row is not None
+            and self._matches(row, stat_result)
+            and row[5] != checksums["sha256sum"]
+        ):
+            # same size, mtime and inode but different content
+            logging.error(
+                f"fixity change: [{path}] - cached [{row[5]}] : current [{checksums['sha256sum']}]"
+            )
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fixity VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    stat_result.st_size,
+                    stat_result.st_mtime_ns,
+                    stat_result.st_ino,
+                    checksums["md5sum"],
+                    checksums["sha256sum"],
+                    time.time(),
+                ),
+            )
+
+    def _get(self, path):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT * FROM fixity WHERE path = ?", (path,)
+            ).fetchone()
+
+    @staticmethod
+    def _matches(row, stat_result):
+        return (row[1], row[2], row[3]) == (
+            stat_result.st_size,
+            stat_result.st_mtime_ns,
+            stat_result.st_ino,
+        )
+
+
+# open the fixity cache if a path is given; a context manager yielding None otherwise
+def open_cache(path, rehash_older_than_days=None):
+    if not path:
+        return contextlib.nullcontext(None)
+    rehash_older_than = (
+        rehash_older_than_days * 86400 if rehash_older_than_days is not None else None
+    )
+    return FixityCache(path, rehash_older_than)
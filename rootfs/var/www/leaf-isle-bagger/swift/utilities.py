@@ -2,20 +2,63 @@
 Script utility functions
 """
 
+import concurrent.futures
+import contextlib
 import csv
 import hashlib
 import logging
 import os
+import threading
 import time
+import zipfile
+import zlib
 
+from collections import namedtuple
 from datetime import datetime
+from drupal import inventory as drupalInventory
+from metrics import prometheus as metricsPrometheus
+from swift import connection as swiftConnection
 from swiftclient.service import (
     ClientException,
     SwiftError,
-    SwiftService,
+    SwiftPostObject,
     SwiftUploadObject,
 )
 
+_log_lock = threading.Lock()
+_audit_lock = threading.Lock()
+
+# read size when hashing AIPs
+_CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+# size-aware upload tuning: AIPs larger than segment_threshold (bytes) are uploaded as
+# segmented large objects (SLO or DLO) of at least segment_size bytes with the segments
+# sent in parallel; the segment size grows so an AIP never exceeds max_segments
+UploadTuning = namedtuple(
+    "UploadTuning", ["segment_threshold", "segment_size", "max_segments", "use_slo"]
+)
+_GIB = 1024 * 1024 * 1024
+DEFAULT_UPLOAD_TUNING = UploadTuning(_GIB, _GIB // 4, 1000, True)
+
+# deep fixity audit: number of concurrent object downloads and a bandwidth cap shared
+# by the downloads in bytes per second (None for no cap)
+DeepAudit = namedtuple("DeepAudit", ["workers", "bytes_per_second"])
+
+# BagIt payload manifest within the AIP zip and the Swift metadata holding its digest
+PAYLOAD_MANIFEST = "manifest-sha256.txt"
+PAYLOAD_HEADER = "x-object-meta-payload-sha256"
+# Swift metadata recording the SHA-256 of the local AIP whose upload was skipped as
+# its payload matched the Swift copy; a later upload (PUT) replaces it
+DEDUPE_HEADER = "x-object-meta-dedupe-sha256sum"
+
+
+# the process's shared Swift service (see swift.connection) if open; a new one otherwise
+def swift_service(options=None):
+    shared = swiftConnection.shared_service()
+    if shared is not None:
+        return contextlib.nullcontext(shared)
+    return swiftConnection.SharedService(options)
+
 
 # Build the Swift ID - based on Islandora Bagger settings
 def generate_aip_id(id):
@@ -31,77 +74,347 @@ def aip_exists(aip_path):
     return os.path.exists(aip_path)
 
 
+# True if the AIP exists and is not older than the Drupal changed timestamp of the node
+# (the audit's filesystem date test), i.e., regenerating it would yield the same content
+def aip_current(aip_path, item_values):
+    try:
+        return int(os.path.getmtime(aip_path)) >= item_values.changed
+    except OSError:
+        return False
+
+
+# hash a single AIP ahead of upload; None if the AIP is missing
+def hash_aip(key, aip_dir, fixity_cache=None):
+    aip_path = generate_aip_path(aip_dir, key)
+    if not aip_exists(aip_path):
+        logging.error(f"  Failed to find: {aip_path}")
+        return None
+    return file_checksum(aip_path, fixity_cache)
+
+
+# upload a single AIP; returns the upload details (see upload) if verified, otherwise None
+# with dedupe, an AIP whose payload digest matches the Swift copy is not uploaded again
+def upload_aip_node(
+    swift_conn_dst,
+    key,
+    item_values,
+    checksums,
+    aip_dir,
+    swift_options,
+    container_dst,
+    db_writer=None,
+    fixity_cache=None,
+    tuning=DEFAULT_UPLOAD_TUNING,
+    dedupe=False,
+):
+    aip_path = generate_aip_path(aip_dir, key)
+    payload = payload_digest(aip_path)
+    if dedupe and payload:
+        reused = reuse_swift_payload(
+            swift_conn_dst,
+            key,
+            item_values,
+            payload,
+            checksums,
+            container_dst,
+            db_writer,
+        )
+        if reused:
+            return reused
+    logging.info(f"  adding to upload: {aip_path}")
+    dst_obj = build_aip_upload_object(
+        key, item_values, aip_path, checksums, swift_options, payload
+    )
+    options = upload_options(os.path.getsize(aip_path), tuning)
+    with metricsPrometheus.timer("upload"):
+        uploaded = upload(
+            swift_conn_dst,
+            [dst_obj],
+            container_dst,
+            db_writer,
+            fixity_cache,
+            options,
+        )
+    return uploaded.get(generate_aip_id(key))
+
+
 #
-def upload_aip(node_list, aip_dir, swift_options, container_dst, database_csv):
-
-    with SwiftService() as swift_conn_dst:
-        with open(database_csv, "w", newline="") as db_file:
-            dst_objs = []
-            db_writer = log_init(db_file)
-            for key, item_values in node_list.items():
-                aip_path = generate_aip_path(aip_dir, key)
-                aip_id = generate_aip_id(key)
-                if aip_exists(aip_path):
-                    logging.info(f"  adding to upload: {aip_path}")
-                    checksums = file_checksum(aip_path)
-                    item_options = {
-                        "header": {
-                            "x-object-meta-sha256sum": checksums["sha256sum"],
-                            "x-object-meta-last-mod-timestamp": item_values["changed"],
-                            "content-type": item_values["content_type"],
-                        }
-                    }
-                    dst_objs.append(
-                        build_swift_upload_object(
-                            aip_id, aip_path, swift_options, item_options
-                        )
-                    )
-                else:
-                    logging.error(f"  Failed to find: {aip_path}")
-                    # delete from the nodelist so not used in subsequent steps
-                    node_list[key] = None
+def build_aip_upload_object(
+    key, item_values, aip_path, checksums, swift_options, payload=None
+):
+    item_options = {
+        "header": {
+            "x-object-meta-sha256sum": checksums["sha256sum"],
+            "x-object-meta-last-mod-timestamp": item_values.changed_iso,
+            "content-type": item_values.content_type,
+        }
+    }
+    if payload:
+        item_options["header"][PAYLOAD_HEADER] = payload
+    return build_swift_upload_object(
+        generate_aip_id(key), aip_path, swift_options, item_options
+    )
 
-            # May need to be split into batches of "x" if memory usage is too high
-            upload(swift_conn_dst, dst_objs, container_dst, db_writer)
-            os.fsync(db_file)
+
+# digest of the BagIt payload manifest of the AIP zip; re-bagging an unchanged node
+# yields different zip bytes (timestamps) but the same manifest lines
+# None if the AIP is not a zip or has no payload manifest
+def payload_digest(aip_path):
+    try:
+        with zipfile.ZipFile(aip_path) as aip_zip:
+            name = _payload_manifest_name(aip_zip)
+            if name is None:
+                return None
+            manifest = aip_zip.read(name)
+    except (OSError, zipfile.BadZipFile) as e:
+        logging.error(f"  payload manifest - [{aip_path}] - {e}")
+        return None
+    lines = sorted(
+        line.strip() for line in manifest.decode("utf-8").splitlines() if line.strip()
+    )
+    return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+# the bag's own manifest rather than a file of the same name in the payload
+def _payload_manifest_name(aip_zip):
+    names = [
+        name
+        for name in aip_zip.namelist()
+        if name.rsplit("/", 1)[-1] == PAYLOAD_MANIFEST
+    ]
+    return min(names, key=lambda name: name.count("/")) if names else None
+
+
+# True if every zip member passes its CRC check and the bag payload (data/) is
+# exactly the files of the payload manifest with the listed SHA-256 digests
+def payload_valid(aip_path):
+    try:
+        with zipfile.ZipFile(aip_path) as aip_zip:
+            bad = aip_zip.testzip()
+            if bad is not None:
+                logging.error(f"  payload - [{aip_path}] - bad CRC [{bad}]")
+                return False
+            name = _payload_manifest_name(aip_zip)
+            if name is None:
+                return False
+            root = name[: -len(PAYLOAD_MANIFEST)]
+            expected = {}
+            for line in aip_zip.read(name).decode("utf-8").splitlines():
+                if line.strip():
+                    digest, path = line.strip().split(None, 1)
+                    expected[root + path] = digest.lower()
+            payload = {
+                info.filename
+                for info in aip_zip.infolist()
+                if info.filename.startswith(f"{root}data/") and not info.is_dir()
+            }
+            if payload != set(expected):
+                logging.error(f"  payload - [{aip_path}] - files differ from manifest")
+                return False
+            for path, digest in expected.items():
+                hash_sha256 = hashlib.sha256()
+                with aip_zip.open(path) as f:
+                    for chunk in iter(lambda: f.read(_CHECKSUM_CHUNK_SIZE), b""):
+                        hash_sha256.update(chunk)
+                if hash_sha256.hexdigest() != digest:
+                    logging.error(f"  payload - [{aip_path}] - mismatch [{path}]")
+                    return False
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        logging.error(f"  payload - [{aip_path}] - {e}")
+        return False
+    return True
+
+
+# True if the Swift copy was kept in place of this exact local AIP (see
+# reuse_swift_payload) and the local AIP still holds the payload of the Swift copy
+def payload_deduplicated(headers, checksums, aip_path):
+    return (
+        headers.get(DEDUPE_HEADER) == checksums["sha256sum"]
+        and PAYLOAD_HEADER in headers
+        and headers[PAYLOAD_HEADER] == payload_digest(aip_path)
+        and payload_valid(aip_path)
+    )
+
+
+# skip the upload of an AIP whose payload matches the Swift copy: update the Swift
+# metadata in place (POST) with the node changed timestamp and the checksum of the
+# local AIP it stands for (DEDUPE_HEADER) instead
+# returns the upload details (see upload) of the Swift copy; None to upload the AIP
+def reuse_swift_payload(
+    swift_conn_dst,
+    key,
+    item_values,
+    payload,
+    checksums,
+    container_dst,
+    db_writer=None,
+):
+    aip_id = generate_aip_id(key)
+    try:
+        swift_stat = list(swift_conn_dst.stat(container_dst, [aip_id]))
+        metricsPrometheus.inc("swift_requests_total", phase="dedupe")
+    except Exception as e:
+        logging.error(f"swift stat - [{aip_id}]")
+        logging.error(f"{e}")
+        return None
+    if not swift_stat or not swift_stat[0]["success"]:
+        return None
+    headers = swift_stat[0]["headers"]
+    if headers.get(PAYLOAD_HEADER) != payload:
+        return None
+
+    # a POST replaces all object metadata; carry the existing metadata over
+    post_headers = {
+        name: value
+        for name, value in headers.items()
+        if name.startswith("x-object-meta-") or name == "x-object-manifest"
+    }
+    post_headers["x-object-meta-last-mod-timestamp"] = item_values.changed_iso
+    post_headers[DEDUPE_HEADER] = checksums["sha256sum"]
+    post_headers["content-type"] = item_values.content_type
+    try:
+        for result in swift_conn_dst.post(
+            container_dst, [SwiftPostObject(aip_id, {"header": post_headers})]
+        ):
+            metricsPrometheus.inc("swift_requests_total", phase="dedupe")
+            if not result["success"]:
+                raise SwiftError(result["error"], container_dst, aip_id)
+    except Exception as e:
+        logging.error(f"swift post - [{aip_id}]")
+        logging.error(f"{e}")
+        return None
+
+    logging.info(f"  payload unchanged, metadata updated: {aip_id}")
+    metricsPrometheus.inc("uploads_deduplicated_total")
+    etag = headers.get("etag", "").strip('"')
+    large_object = "x-static-large-object" in headers or "x-object-manifest" in headers
+    swift_checksums = {
+        # the ETag of a segmented large object is not the MD5 of its content
+        "md5sum": None if large_object else etag,
+        "sha256sum": headers.get("x-object-meta-sha256sum"),
+    }
+    if db_writer:
+        log_row(
+            db_writer,
+            aip_id,
+            swift_checksums,
+            os.getenv("OS_USERNAME"),
+            headers.get("last-modified"),
+            container_dst,
+            "payload unchanged; metadata updated",
+        )
+    return {
+        "etag": etag,
+        "last_modified": headers.get("last-modified"),
+        "checksums": swift_checksums,
+    }
+
+
+# SwiftService.upload options for an AIP of the given size; empty for a single PUT
+def upload_options(size, tuning=DEFAULT_UPLOAD_TUNING):
+    if tuning is None or size <= tuning.segment_threshold:
+        return {}
+    # ceiling division keeps the segment count within the manifest limit
+    segment_size = max(tuning.segment_size, -(-size // tuning.max_segments))
+    return {"segment_size": segment_size, "use_slo": tuning.use_slo}
 
 
 #
 def validate(node_list, swift_container):
 
-    with SwiftService() as swift_conn_dst:
+    with swift_service() as swift_conn_dst:
         for key, src_value in node_list.items():
-            aip_id = generate_aip_id(key)
-            logging.info(f"  Validating: {aip_id}")
-            try:
-                swift_stat = swift_conn_dst.stat(swift_container, [aip_id])
-            except Exception as e:
-                logging.error(f"swift stat - [{aip_id}]")
-                logging.error(f"{e}")
-            finally:
-                if swift_stat:
-                    for dst in swift_stat:
-                        logging.debug(f"{dst}")
-                        if dst["success"] is False:
-                            logging.error(
-                                f"id:[{aip_id}] - preservation error [{dst['error']}]"
-                            )
-                            break
-                        elif (
-                            src_value["changed"]
-                            != dst["headers"]["x-object-meta-last-mod-timestamp"]
-                        ):
-                            logging.error(
-                                (
-                                    f"id:[{aip_id}] - mismatched modification timestamp local[{src_value['changed']}]"
-                                    f" : swift[{dst['headers']['x-object-meta-last-mod-timestamp']}]"
-                                )
-                            )
-                            break
-                else:
-                    logging.error(
-                        f"key:[{aip_id}] - not present in destination: {swift_stat}"
-                    )
+            validate_node(swift_conn_dst, key, src_value, swift_container)
+
+
+# validate a single uploaded AIP against the source; returns True if valid
+def validate_node(swift_conn_dst, key, src_value, swift_container):
+
+    aip_id = generate_aip_id(key)
+    logging.info(f"  Validating: {aip_id}")
+    swift_stat = None
+    try:
+        with metricsPrometheus.timer("validate"):
+            swift_stat = list(swift_conn_dst.stat(swift_container, [aip_id]))
+        metricsPrometheus.inc("swift_requests_total", phase="validate")
+    except Exception as e:
+        logging.error(f"swift stat - [{aip_id}]")
+        logging.error(f"{e}")
+
+    if not swift_stat:
+        logging.error(f"key:[{aip_id}] - not present in destination: {swift_stat}")
+        return False
+
+    for dst in swift_stat:
+        logging.debug(f"{dst}")
+        if dst["success"] is False:
+            logging.error(f"id:[{aip_id}] - preservation error [{dst['error']}]")
+            return False
+        elif not changed_matches(
+            src_value, dst["headers"]["x-object-meta-last-mod-timestamp"]
+        ):
+            logging.error(
+                (
+                    f"id:[{aip_id}] - mismatched modification timestamp local[{src_value.changed_iso}]"
+                    f" : swift[{dst['headers']['x-object-meta-last-mod-timestamp']}]"
+                )
+            )
+            return False
+    return True
+
+
+# ETag of the node's AIP in Swift (unquoted); None if missing or the request failed
+def object_etag(swift_conn_dst, key, swift_container):
+    aip_id = generate_aip_id(key)
+    try:
+        for dst in swift_conn_dst.stat(swift_container, [aip_id]):
+            metricsPrometheus.inc("swift_requests_total", phase="resume")
+            if dst["success"]:
+                return dst["headers"].get("etag", "").strip('"')
+    except Exception as e:
+        logging.error(f"swift stat - [{aip_id}]")
+        logging.error(f"{e}")
+    return None
+
+
+# True if the Swift last-mod-timestamp metadata matches the node changed timestamp
+def changed_matches(item_values, swift_changed):
+    try:
+        return drupalInventory.to_epoch(swift_changed) == item_values.changed
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+
+# find nodes whose Swift copy already carries the Drupal changed timestamp
+# objects are HEAD requested in concurrent batches; returns the set of current keys
+def find_current(swift_conn_dst, node_list, swift_container, batch_size=100):
+
+    keys = {generate_aip_id(key): key for key in node_list.keys()}
+    aip_ids = list(keys.keys())
+    current = set()
+    for start in range(0, len(aip_ids), batch_size):
+        end = start + batch_size
+        batch = aip_ids[start:end]
+        try:
+            with metricsPrometheus.timer("skip_current"):
+                swift_stat = list(swift_conn_dst.stat(swift_container, batch))
+            metricsPrometheus.inc(
+                "swift_requests_total", len(batch), phase="skip_current"
+            )
+            for dst in swift_stat:
+                if not dst["success"]:
+                    continue
+                key = keys[dst["object"]]
+                if changed_matches(
+                    node_list[key],
+                    dst["headers"].get("x-object-meta-last-mod-timestamp"),
+                ):
+                    current.add(key)
+        except Exception as e:
+            # treat the batch as stale; preserving again is the safe default
+            logging.error(f"swift stat - [{batch}]")
+            logging.error(f"{e}")
+    return current
 
 
 def log_init(fd):
@@ -124,16 +437,32 @@ def log_init(fd):
 
 #
 def log_upload(db_writer, dst_item, container_dst, checksums, uploaded_by):
+    log_row(
+        db_writer,
+        dst_item["object"],
+        checksums,
+        uploaded_by,
+        upload_response_headers(dst_item)["last-modified"],
+        container_dst,
+    )
+
+
+#
+def log_row(
+    db_writer, aip_id, checksums, uploaded_by, last_updated_at, container_dst, notes=""
+):
     db_dict = {
-        "id": dst_item["object"],
+        "id": aip_id,
         "md5sum": checksums["md5sum"],
         "sha256sum": checksums["sha256sum"],
         "uploaded_by": uploaded_by,
-        "last_updated_at": dst_item["response_dict"]["headers"]["last-modified"],
+        "last_updated_at": last_updated_at,
         "container_name": container_dst,
-        "notes": "",
+        "notes": notes,
     }
-    db_writer.writerow(db_dict)
+    # uploads may be logged from several pipeline workers
+    with _log_lock:
+        db_writer.writerow(db_dict)
 
 
 #
@@ -144,25 +473,59 @@ def build_swift_upload_object(item, aip_path, swift_options, item_options):
     )
 
 
-#
-def file_checksum(path):
+# checksum a file; consult the fixity cache, if given, to avoid re-reading unchanged files
+# None if the file cannot be read; a failed read is never cached
+def file_checksum(path, fixity_cache=None):
+    if fixity_cache is not None:
+        try:
+            stat_result = os.stat(path)
+        except OSError as e:
+            logging.error(f"{e}")
+            return None
+        checksums = fixity_cache.lookup(path, stat_result)
+        if checksums is None:
+            checksums = _file_checksum(path)
+            if checksums is None:
+                return None
+            # skip caching if the file changed (or vanished) while hashing
+            try:
+                unchanged = _same_file_state(stat_result, os.stat(path))
+            except OSError as e:
+                logging.error(f"{e}")
+                unchanged = False
+            if unchanged:
+                fixity_cache.store(path, stat_result, checksums)
+        return checksums
+    return _file_checksum(path)
+
+
+# None if the file cannot be read
+def _file_checksum(path):
     hash_md5 = hashlib.md5()
     hash_sha256 = hashlib.sha256()
     try:
         with open(path, "rb") as f:
             # read and buffer to prevent high memory usage
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(_CHECKSUM_CHUNK_SIZE), b""):
                 hash_md5.update(chunk)
                 hash_sha256.update(chunk)
-    except FileNotFoundError as e:
+                metricsPrometheus.inc("bytes_hashed_total", len(chunk))
+    except OSError as e:
         logging.error(f"{e}")
-    finally:
-        return {"md5sum": hash_md5.hexdigest(), "sha256sum": hash_sha256.hexdigest()}
+        return None
+    return {"md5sum": hash_md5.hexdigest(), "sha256sum": hash_sha256.hexdigest()}
+
+
+#
+def _same_file_state(a, b):
+    return (a.st_size, a.st_mtime_ns, a.st_ino) == (b.st_size, b.st_mtime_ns, b.st_ino)
 
 
 #
-def validate_checksum(path, etag, id):
-    checksums = file_checksum(path)
+def validate_checksum(path, etag, id, fixity_cache=None):
+    checksums = file_checksum(path, fixity_cache)
+    if checksums is None:
+        raise ClientException(f"ERROR: id:[{id}] error: unreadable AIP [{path}]")
     if checksums["md5sum"] != etag:
         raise ClientException(
             f"ERROR: id:[{id}] error: checksum failure [{path}] - {checksums['md5sum']} <> {etag}"
@@ -170,15 +533,59 @@ def validate_checksum(path, etag, id):
     return checksums
 
 
-#
-def upload(swift_conn_dst, dst_objs, container_dst, db_writer=None):
+# verify a segmented large object: swiftclient checks each segment etag against the
+# local bytes while streaming, so confirm every segment landed and they cover the file
+def validate_segments(dst_item, fixity_cache=None):
+    segments = dst_item.get("segment_results", [])
+    size = sum(segment["segment_size"] for segment in segments)
+    if size != os.path.getsize(dst_item["path"]) or not all(
+        segment["success"] and segment.get("segment_etag") for segment in segments
+    ):
+        raise ClientException(
+            f"ERROR: id:[{dst_item['object']}] error: incomplete segments [{dst_item['path']}]"
+            f" - {len(segments)} segment(s), {size} bytes"
+        )
+    checksums = file_checksum(dst_item["path"], fixity_cache)
+    if checksums is None:
+        raise ClientException(
+            f"ERROR: id:[{dst_item['object']}] error: unreadable AIP [{dst_item['path']}]"
+        )
+    return checksums
+
 
-    for dst_item in swift_conn_dst.upload(container_dst, dst_objs):
+# response headers of an uploaded object; the manifest PUT for segmented large objects
+def upload_response_headers(dst_item):
+    if dst_item.get("large_object"):
+        return dst_item["manifest_response_dict"]["headers"]
+    return dst_item["response_dict"]["headers"]
+
+
+# returns a map of the object names uploaded and verified against the Swift etag
+# to their etag, last-modified header and checksums
+def upload(
+    swift_conn_dst,
+    dst_objs,
+    container_dst,
+    db_writer=None,
+    fixity_cache=None,
+    options=None,
+):
+
+    uploaded = {}
+    for dst_item in swift_conn_dst.upload(container_dst, dst_objs, options or None):
         try:
             # test if segmented large object: https://docs.openstack.org/swift/newton/overview_large_objects.html
             if dst_item["action"] == "upload_object":
                 logging.info(f"  uploading: {dst_item['object']}")
                 logging.debug(f"{dst_item}")
+                metricsPrometheus.inc("swift_requests_total", phase="upload")
+            elif dst_item["action"] == "upload_segment":
+                logging.debug(f"  uploading segment: {dst_item['log_line']}")
+                metricsPrometheus.inc("swift_requests_total", phase="upload")
+                if dst_item["success"]:
+                    metricsPrometheus.inc(
+                        "bytes_uploaded_total", dst_item["segment_size"]
+                    )
             if not dst_item["success"]:
                 if "object" in dst_item:
                     logging.error(f"{dst_item}")
@@ -191,19 +598,28 @@ def upload(swift_conn_dst, dst_objs, container_dst, db_writer=None):
                     raise SwiftError(
                         dst_item["error"],
                         container_dst,
-                        dst_item["object"],
+                        dst_item["for_object"],
                         dst_item["segment_index"],
                     )
 
             if dst_item["action"] == "upload_object" and os.path.isfile(
                 dst_item["path"]
             ):
-                # test upload file against Swift header etag to verify
-                checksums = validate_checksum(
-                    dst_item["path"],
-                    dst_item["response_dict"]["headers"]["etag"],
-                    dst_item["object"],
-                )
+                headers = upload_response_headers(dst_item)
+                if dst_item.get("large_object"):
+                    # the manifest etag is not the file MD5; verify the segments
+                    checksums = validate_segments(dst_item, fixity_cache)
+                else:
+                    # test upload file against Swift header etag to verify
+                    checksums = validate_checksum(
+                        dst_item["path"],
+                        headers["etag"],
+                        dst_item["object"],
+                        fixity_cache,
+                    )
+                    metricsPrometheus.inc(
+                        "bytes_uploaded_total", os.path.getsize(dst_item["path"])
+                    )
                 # log upload
                 logging.debug(f"swift stat - [{dst_item}]")
                 if db_writer:
@@ -214,16 +630,25 @@ def upload(swift_conn_dst, dst_objs, container_dst, db_writer=None):
                         checksums,
                         os.getenv("OS_USERNAME"),
                     )
+                uploaded[dst_item["object"]] = {
+                    "etag": headers["etag"].strip('"'),
+                    "last_modified": headers.get("last-modified"),
+                    "checksums": checksums,
+                }
         except Exception as e:
             logging.error(f"swift upload - [{dst_item}]")
             logging.error(f"{e}")
 
+    return uploaded
 
-#
+
+# Last-Modified header (RFC 1123) or container listing (ISO-8601, UTC) timestamp
 def swift_timestamp_to_iso8601(ts):
-    return datetime.strptime(ts, "%a, %d %b %Y %H:%M:%S %Z").strftime(
-        "%Y-%m-%dT%H:%M:%S%z"
-    )
+    try:
+        parsed = datetime.strptime(ts, "%a, %d %b %Y %H:%M:%S %Z")
+    except ValueError:
+        parsed = datetime.fromisoformat(ts)
+    return parsed.strftime("%Y-%m-%dT%H:%M:%S%z")
 
 
 #
@@ -245,6 +670,33 @@ def audit_init(fd):
     return audit_writer
 
 
+# nodes of shard index (0-based) of count, partitioned by a stable hash of the node id
+# so every process or host computes the same split of the same node list
+def audit_shard(node_list, index, count):
+    return node_list.filtered(
+        lambda key: zlib.crc32(str(key).encode("utf-8")) % count == index
+    )
+
+
+# combine shard audit reports into one report ordered by node id; returns the row count
+def audit_merge(audit_writer, paths):
+    rows = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8", newline="") as fd:
+            reader = csv.DictReader(fd)
+            if reader.fieldnames != audit_writer.fieldnames:
+                raise ValueError(f"Unexpected audit report columns: {path}")
+            rows.extend(reader)
+    rows.sort(key=lambda row: _node_sort_key(row["drupal_id"]))
+    audit_writer.writerows(rows)
+    return len(rows)
+
+
+#
+def _node_sort_key(node_id):
+    return (0, int(node_id), "") if node_id.isdigit() else (1, 0, node_id)
+
+
 #
 def audit_record(
     audit_writer,
@@ -267,22 +719,254 @@ def audit_record(
         "swift_bytes": swift_bytes,
         "status": status,
     }
-    audit_writer.writerow(db_dict)
+    # rows may be written by the deep fixity workers
+    with _audit_lock:
+        audit_writer.writerow(db_dict)
+    metricsPrometheus.inc("audit_records_total", status=status or "ok")
 
 
 _AUDIT_STATUS_OK = ""
 _AUDIT_STATUS_WARN_AIP_MISSING = "xm"
 _AUDIT_STATUS_WARN_AIP_DATE = "xd"
+_AUDIT_STATUS_WARN_AIP_READ = "xr"
 _AUDIT_STATUS_WARN_SWIFT_MISSING = "sm"
 _AUDIT_STATUS_WARN_SWIFT_TIMESTAMP = "st"
 _AUDIT_STATUS_WARN_SWIFT_CHECKSUM = "sw"
+_AUDIT_STATUS_WARN_SWIFT_READ = "sr"
+
+
+# index of a container listing keyed by object name; built in a background thread
+class ContainerIndex:
+
+    def __init__(self, swift_conn, container, prefix="aip_"):
+        self.swift_conn = swift_conn
+        self.container = container
+        self.prefix = prefix
+        self.objects = {}
+        self.success = False
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._build, name="container-index", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _build(self):
+        try:
+            for page in self.swift_conn.list(
+                container=self.container, options={"prefix": self.prefix}
+            ):
+                metricsPrometheus.inc("swift_requests_total", phase="listing")
+                if not page["success"]:
+                    raise page["error"]
+                for item in page["listing"]:
+                    self.objects[item["name"]] = {
+                        "bytes": item.get("bytes"),
+                        "hash": item.get("hash"),
+                        "last_modified": item.get("last_modified"),
+                    }
+            self.success = True
+            logging.info(
+                f"  Container index: {self.container} - {len(self.objects)} objects"
+            )
+        except Exception as e:
+            # fallback: callers query Swift per object
+            logging.warning(f"  Container index unavailable: {self.container} - {e}")
+        finally:
+            self._ready.set()
+
+    # wait for the listing; False if the listing failed
+    def wait(self):
+        self._ready.wait()
+        return self.success
+
+    # None if the listing does not contain the object
+    def get(self, name):
+        self.wait()
+        return self.objects.get(name)
+
+    def __contains__(self, name):
+        # assume present if the listing failed so a HEAD request decides
+        return not self.wait() or name in self.objects
+
+
+# pace a byte stream, or several sharing the limiter, to a maximum rate
+class BandwidthLimiter:
+
+    def __init__(self, bytes_per_second=None):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    # reserve the transfer time of n bytes; sleep until the reservation starts
+    def consume(self, n):
+        if not self.bytes_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + n / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+# deep fixity audit: stream Swift objects through MD5 and SHA-256 (no temporary files)
+# with a bounded number of concurrent downloads; the audit row of an object is written
+# once its bytes are verified against the recorded x-object-meta-sha256sum (else the
+# local AIP checksum) and, for objects that are not segmented, the ETag
+class DeepFixityCheck:
+
+    def __init__(self, swift_conn, container, deep, chunk_size=_CHECKSUM_CHUNK_SIZE):
+        self.swift_conn = swift_conn
+        self.container = container
+        self.chunk_size = chunk_size
+        self.limiter = BandwidthLimiter(deep.bytes_per_second)
+        self.objects = 0
+        self.bytes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        workers = max(1, deep.workers)
+        # bound the queued downloads so the audit does not run ahead of the workers
+        self._slots = threading.BoundedSemaphore(2 * workers)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="deep-fixity"
+        )
+        self._start = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # wait for the queued downloads and log the throughput
+    def close(self):
+        self._executor.shutdown(wait=True)
+        elapsed = time.monotonic() - self._start
+        rate = self.bytes / 1e6 / elapsed if elapsed > 0 else 0.0
+        logging.info(
+            f"Audit: deep fixity {self.objects} object(s), {self.bytes / 1e6:.1f} MB"
+            f" in {elapsed:.1f}s ({rate:.1f} MB/s)"
+        )
+
+    # queue the verification of an object; record holds the audit_record arguments but status
+    def submit(self, item_id, aip_id, headers, checksums, record):
+        self._slots.acquire()
+        self._executor.submit(self._check, item_id, aip_id, headers, checksums, record)
+
+    def _check(self, item_id, aip_id, headers, checksums, record):
+        try:
+            status = self.verify(item_id, aip_id, headers, checksums)
+        except Exception as e:
+            logging.error(f"id:[{item_id}] - deep fixity error [{aip_id}] - {e}")
+            status = _AUDIT_STATUS_WARN_SWIFT_READ
+        finally:
+            self._slots.release()
+        audit_record(*record, status=status)
+
+    # audit status of the object bytes
+    def verify(self, item_id, aip_id, headers, checksums):
+        try:
+            with metricsPrometheus.timer("deep"):
+                streamed = self.stream_checksum(aip_id)
+        except Exception as e:
+            logging.error(f"id:[{item_id}] - deep fixity read error [{aip_id}] - {e}")
+            return _AUDIT_STATUS_WARN_SWIFT_READ
+        expected = headers.get("x-object-meta-sha256sum") or checksums["sha256sum"]
+        large_object = (
+            "x-static-large-object" in headers or "x-object-manifest" in headers
+        )
+        etag = headers.get("etag", "").strip('"')
+        if streamed["sha256sum"] != expected or (
+            not large_object and streamed["md5sum"] != etag
+        ):
+            logging.error(
+                f"id:[{item_id}] - deep fixity mismatch [{aip_id}]"
+                f" sha256 [{streamed['sha256sum']}] : [{expected}]"
+                f" md5 [{streamed['md5sum']}] : [{etag}]"
+            )
+            return _AUDIT_STATUS_WARN_SWIFT_CHECKSUM
+        logging.info(f"  Deep fixity success: {item_id} - {aip_id}")
+        return _AUDIT_STATUS_OK
+
+    # MD5 and SHA-256 of the Swift object, hashed as it streams
+    def stream_checksum(self, aip_id):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = swiftConnection.new_connection(self.swift_conn)
+        _, body = conn.get_object(
+            self.container, aip_id, resp_chunk_size=self.chunk_size
+        )
+        metricsPrometheus.inc("swift_requests_total", phase="deep")
+        hash_md5 = hashlib.md5()
+        hash_sha256 = hashlib.sha256()
+        size = 0
+        for chunk in body:
+            self.limiter.consume(len(chunk))
+            hash_md5.update(chunk)
+            hash_sha256.update(chunk)
+            size += len(chunk)
+        metricsPrometheus.inc("bytes_downloaded_total", size)
+        with self._lock:
+            self.objects += 1
+            self.bytes += size
+        return {"md5sum": hash_md5.hexdigest(), "sha256sum": hash_sha256.hexdigest()}
 
 
 #
-def audit(audit_writer, node_list, aip_dir, swift_container):
+def audit(
+    audit_writer,
+    node_list,
+    aip_dir,
+    swift_container,
+    batch_size=100,
+    head_threads=10,
+    fixity_cache=None,
+    deep=None,
+    state_store=None,
+):
+    audit_stream(
+        audit_writer,
+        [node_list],
+        aip_dir,
+        swift_container,
+        batch_size,
+        head_threads,
+        fixity_cache,
+        deep,
+        state_store,
+    )
+
+
+# audit node lists as they arrive (e.g., pages of the Drupal Node view) so crawling
+# overlaps the local and Swift checks and report rows are written progressively
+# with a state store, AIPs whose verified Swift copy is unchanged skip the HEAD request
+def audit_stream(
+    audit_writer,
+    node_lists,
+    aip_dir,
+    swift_container,
+    batch_size=100,
+    head_threads=10,
+    fixity_cache=None,
+    deep=None,
+    state_store=None,
+):
 
-    with SwiftService() as swift_conn_dst:
-        for item_id, item_values in node_list.items():
+    with swift_service(
+        {"object_dd_threads": head_threads}
+    ) as swift_conn_dst, contextlib.ExitStack() as stack:
+        # page through the container listing while local AIPs are inspected
+        index = ContainerIndex(swift_conn_dst, swift_container).start()
+        deep_check = (
+            stack.enter_context(DeepFixityCheck(swift_conn_dst, swift_container, deep))
+            if deep
+            else None
+        )
+        batch = []
+        for item_id, item_values in _stream_items(node_lists):
 
             aip_id = generate_aip_id(item_id)
             aip_path = generate_aip_path(aip_dir, item_id)
@@ -294,82 +978,209 @@ def audit(audit_writer, node_list, aip_dir, swift_container):
                 audit_record(
                     audit_writer,
                     item_id,
-                    item_values["changed"],
+                    item_values.changed_iso,
                     status=_AUDIT_STATUS_WARN_AIP_MISSING,
                 )
                 continue
 
+            checksums = file_checksum(aip_path, fixity_cache)
+            if checksums is None:
+                logging.error(f"id:[{item_id}] - unreadable AIP [{aip_path}]")
+                audit_record(
+                    audit_writer,
+                    item_id,
+                    item_values.changed_iso,
+                    status=_AUDIT_STATUS_WARN_AIP_READ,
+                )
+                continue
+
             # test Drupal and filesystem timestamps
-            checksums = file_checksum(aip_path)
             aip_mtime = os.path.getmtime(aip_path)
             aip_time = time.gmtime(aip_mtime)
-            if aip_time < time.strptime(item_values["changed"], "%Y-%m-%dT%H:%M:%S%z"):
+            if int(aip_mtime) < item_values.changed:
                 logging.error(
-                    f"id:[{item_id}] - filesystem date older than source date [{aip_time}] - [{item_values['changed']}]"
+                    f"id:[{item_id}] - filesystem date older than source date [{aip_time}]"
+                    f" - [{item_values.changed_iso}]"
                 )
                 audit_record(
                     audit_writer,
                     item_id,
-                    item_values["changed"],
+                    item_values.changed_iso,
                     status=_AUDIT_STATUS_WARN_AIP_DATE,
                 )
                 continue
 
-            # stat requires a list argument; only adding one;
-            swift_stat = swift_conn_dst.stat(swift_container, [aip_id])
-            if swift_stat:
-                for dst in swift_stat:
-
-                    logging.debug(f"{dst}")
-
-                    status = ""
-                    if dst["success"] is False:
-                        # test if AIP in OLRC
-                        logging.error(
-                            f"id:[{item_id}] - preservation error [{dst['error']}]"
-                        )
-                        logging.error(f"id:[{item_id}] - swift stat - [{dst}]")
-                        audit_record(
-                            audit_writer,
-                            item_id,
-                            item_values["changed"],
-                            status=_AUDIT_STATUS_WARN_SWIFT_MISSING,
-                        )
-                    else:
-                        # Swift record found, test properties
-                        status = audit_swift_properties(
-                            item_id, item_values, dst, checksums, aip_id, aip_path
-                        )
-                        audit_record(
-                            audit_writer,
-                            item_id,
-                            item_values["changed"],
-                            dst["object"],
-                            dst["headers"]["last-modified"],
-                            dst["headers"]["x-object-meta-last-mod-timestamp"],
-                            dst["headers"]["content-length"],
-                            status,
-                        )
+            batch.append((item_id, item_values, checksums, aip_id, aip_path))
+            if len(batch) >= batch_size:
+                audit_swift_batch(
+                    audit_writer,
+                    swift_conn_dst,
+                    index,
+                    swift_container,
+                    batch,
+                    deep_check,
+                    state_store,
+                )
+                batch = []
+
+        if batch:
+            audit_swift_batch(
+                audit_writer,
+                swift_conn_dst,
+                index,
+                swift_container,
+                batch,
+                deep_check,
+                state_store,
+            )
+
+
+#
+def _stream_items(node_lists):
+    for node_list in node_lists:
+        yield from node_list.items()
+
+
+# audit a batch of AIPs against Swift; objects absent from the container listing
+# are reported without a request and the rest are HEAD requested concurrently
+# for the metadata (x-object-meta-*) the listing does not carry
+# with a deep fixity check, objects passing the metadata tests are verified byte-wise
+# with a state store, objects answered by audit_from_store are not requested
+def audit_swift_batch(
+    audit_writer,
+    swift_conn_dst,
+    index,
+    swift_container,
+    batch,
+    deep_check=None,
+    state_store=None,
+):
+
+    # the deep fixity check needs the object metadata of a HEAD request
+    states = (
+        state_store.get_many(item[0] for item in batch)
+        if state_store is not None and deep_check is None
+        else {}
+    )
+    pending = {}
+    for item_id, item_values, checksums, aip_id, aip_path in batch:
+        listing = index.get(aip_id) if item_id in states else None
+        if listing and audit_from_store(
+            states[item_id], listing, item_values, checksums
+        ):
+            logging.info(f"  Audit success (state store): {item_id} - {aip_id}")
+            audit_record(
+                audit_writer,
+                item_id,
+                item_values.changed_iso,
+                aip_id,
+                listing["last_modified"],
+                states[item_id]["preserved_changed"],
+                listing["bytes"],
+                status=_AUDIT_STATUS_OK,
+            )
+        elif aip_id in index:
+            pending[aip_id] = (item_id, item_values, checksums, aip_path)
+        else:
+            # test if AIP in OLRC
+            logging.error(
+                f"id:[{item_id}] - preservation error [not in container listing]"
+            )
+            audit_record(
+                audit_writer,
+                item_id,
+                item_values.changed_iso,
+                status=_AUDIT_STATUS_WARN_SWIFT_MISSING,
+            )
+
+    if not pending:
+        return
+
+    try:
+        with metricsPrometheus.timer("audit"):
+            swift_stat = list(
+                swift_conn_dst.stat(swift_container, list(pending.keys()))
+            )
+        metricsPrometheus.inc("swift_requests_total", len(pending), phase="audit")
+    except Exception as e:
+        logging.error(f"swift stat - [{list(pending.keys())}]")
+        logging.error(f"{e}")
+        swift_stat = []
+
+    for dst in swift_stat:
+
+        logging.debug(f"{dst}")
 
+        if dst.get("object") not in pending:
+            continue
+        aip_id = dst["object"]
+        item_id, item_values, checksums, aip_path = pending.pop(aip_id)
+
+        status = ""
+        if dst["success"] is False:
+            # test if AIP in OLRC
+            logging.error(f"id:[{item_id}] - preservation error [{dst['error']}]")
+            logging.error(f"id:[{item_id}] - swift stat - [{dst}]")
+            audit_record(
+                audit_writer,
+                item_id,
+                item_values.changed_iso,
+                status=_AUDIT_STATUS_WARN_SWIFT_MISSING,
+            )
+        else:
+            # Swift record found, test properties
+            status = audit_swift_properties(
+                item_id, item_values, dst, checksums, aip_id, aip_path
+            )
+            record = (
+                audit_writer,
+                item_id,
+                item_values.changed_iso,
+                dst["object"],
+                dst["headers"]["last-modified"],
+                dst["headers"]["x-object-meta-last-mod-timestamp"],
+                dst["headers"]["content-length"],
+            )
+            if deep_check is not None and status == _AUDIT_STATUS_OK:
+                deep_check.submit(item_id, aip_id, dst["headers"], checksums, record)
             else:
-                # Connection failure
-                logging.error(f"key:[{item_id}] - connection error: {swift_stat}")
+                audit_record(*record, status=status)
+
+    for aip_id, (item_id, item_values, checksums, aip_path) in pending.items():
+        # Connection failure
+        logging.error(f"key:[{item_id}] - connection error: {aip_id}")
+
+
+# True if the state store vouches for the Swift copy: it was verified for the node's
+# changed timestamp, still has the ETag of that upload (container listing hash) and
+# was uploaded from an AIP with the local checksum; otherwise Swift is asked
+def audit_from_store(state, listing, item_values, checksums):
+    return (
+        bool(listing.get("hash"))
+        and state.get("preserved_changed") == item_values.changed_iso
+        and state.get("swift_etag") == listing["hash"].strip('"')
+        and state.get("sha256sum") == checksums["sha256sum"]
+    )
 
 
 def audit_swift_properties(item_id, item_values, dst, checksums, aip_id, aip_path):
 
-    if item_values["changed"] != dst["headers"]["x-object-meta-last-mod-timestamp"]:
+    if not changed_matches(
+        item_values, dst["headers"]["x-object-meta-last-mod-timestamp"]
+    ):
         # test Drupal and Swift timestamps
         status = _AUDIT_STATUS_WARN_SWIFT_TIMESTAMP
         logging.error(
             (
-                f"id:[{item_id}] - mismatched modification timestamp [{item_values['changed']}]"
+                f"id:[{item_id}] - mismatched modification timestamp [{item_values.changed_iso}]"
                 f" : [{dst['headers']['x-object-meta-last-mod-timestamp']}]"
             )
         )
     elif (
         "x-object-meta-sha256sum" in dst["headers"]
         and checksums["sha256sum"] != dst["headers"]["x-object-meta-sha256sum"]
+        # a re-bagged AIP with the payload of the Swift copy was not uploaded again
+        and not payload_deduplicated(dst["headers"], checksums, aip_path)
     ):
         # test filesystem and Swift checksums
         status = _AUDIT_STATUS_WARN_SWIFT_CHECKSUM
@@ -3,10 +3,15 @@ Test the Drupal integration module
 """
 
 import argparse
+import logging
 import os
+import pytest
 import requests
 import requests_mock
+import pathlib
 import sys
+import tempfile
+import time
 
 sys.path.append(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -14,6 +19,8 @@ sys.path.append(
 
 from drupal import utilities as drupalUtilities  # noqa:E402
 from drupal import api as drupalApi  # noqa:E402
+from drupal import cache as drupalCache  # noqa:E402
+from drupal import inventory as drupalInventory  # noqa:E402
 
 # Mock pages of request responses
 # https://github.com/jamielennox/requests-mock/tree/master
@@ -57,8 +64,8 @@ def test_drupal_node_change_view(mocker):
         text="[]",
     )
     node_list = drupalUtilities.id_list_from_nodes(_session, args)
-    assert node_list["1"]
-    assert node_list["1"]["changed"] == "2024-01-01T00:00:00+00:00"
+    assert node_list[1]
+    assert node_list[1].changed_iso == "2024-01-01T00:00:00+00:00"
 
 
 # Test the Drupal media change view reader
@@ -78,12 +85,33 @@ def test_drupal_media_change_view(mocker):
         f"{args.server}/{drupalApi.media_view_endpoint(page='1', date_filter=args.date)}",
         text="[]",
     )
-    node_list = {}
-    print(node_list)
+    node_list = drupalInventory.NodeInventory()
     drupalUtilities.id_list_merge_with_media(_session, args, node_list)
-    print(node_list)
-    assert node_list["1"]
-    assert node_list["1"]["changed"] == "2025-01-01T00:00:00+00:00"
+    assert node_list[1]
+    assert node_list[1].changed_iso == "2025-01-01T00:00:00+00:00"
+
+
+# Test media rows with a missing, null or invalid parent id are skipped
+def test_drupal_media_change_invalid_parent(mocker):
+    mocker.patch(
+        "argparse.ArgumentParser.parse_args",
+        return_value=argparse.Namespace(date="2023-02-01", server="http://example.com"),
+    )
+    args = argparse.ArgumentParser.parse_args()
+    _adapter.register_uri(
+        "GET",
+        f"{args.server}/{drupalApi.media_view_endpoint(page='0', date_filter=args.date)}",
+        text='[ { "changed": "1735689600" }, { "changed": "1735689600", "field_media_of": null }, '
+        '{ "changed": "1735689600", "field_media_of": "a" }, { "changed": "1735689600", "field_media_of": "5" } ]',
+    )
+    _adapter.register_uri(
+        "GET",
+        f"{args.server}/{drupalApi.media_view_endpoint(page='1', date_filter=args.date)}",
+        text="[]",
+    )
+    node_list = drupalInventory.NodeInventory()
+    drupalUtilities.id_list_merge_with_media(_session, args, node_list)
+    assert list(node_list) == [5]
 
 
 # When media is updated the associated node is not updated;
@@ -116,8 +144,8 @@ def test_drupal_media_change_without_node(mocker):
     )
     node_list = drupalUtilities.id_list_from_nodes(_session, args)
     drupalUtilities.id_list_merge_with_media(_session, args, node_list)
-    assert node_list["1"]
-    assert node_list["1"]["changed"] == "2025-01-01T00:00:00+00:00"
+    assert node_list[1]
+    assert node_list[1].changed_iso == "2025-01-01T00:00:00+00:00"
 
 
 # When node is updated the associated media is not updated;
@@ -150,20 +178,15 @@ def test_drupal_node_change_without_media(mocker):
     )
     node_list = drupalUtilities.id_list_from_nodes(_session, args)
     drupalUtilities.id_list_merge_with_media(_session, args, node_list)
-    assert node_list["1"]
-    assert node_list["1"]["changed"] == "2025-01-02T00:00:00+00:00"
+    assert node_list[1]
+    assert node_list[1].changed_iso == "2025-01-02T00:00:00+00:00"
 
 
 # Test the update of a single node with associated media
 # test that the date list captures the media date not the node date
 def test_single_drupal_node_change_without_media(mocker):
     node_id = 9999
-    node_list = {
-        9999: {
-            "changed": "2022-05-18T13:35:49+00:00",
-            "content_type": "application/zip",
-        }
-    }
+    node_list = drupalInventory.NodeInventory([(9999, "2022-05-18T13:35:49+00:00")])
     mocker.patch(
         "argparse.ArgumentParser.parse_args",
         return_value=argparse.Namespace(
@@ -180,4 +203,381 @@ def test_single_drupal_node_change_without_media(mocker):
         _session, args.server, node_list, args.force_single_node
     )
     assert node_list[node_id]
-    assert node_list[node_id]["changed"] == "2022-05-18T13:35:52+00:00"
+    assert node_list[node_id].changed_iso == "2022-05-18T13:35:52+00:00"
+
+
+# Fake islandora-bagger console: fail on node 2, hang on node 3
+def _fake_bagger_app(tmpdir):
+    bin_dir = tmpdir.mkdir("bin")
+    console = bin_dir / "console"
+    console.write(
+        "#!/bin/sh\n"
+        'node="${3#--node=}"\n'
+        'echo "bagging ${node}"\n'
+        'if [ "${node}" = "2" ]; then exit 1; fi\n'
+        'if [ "${node}" = "3" ]; then sleep 30; fi\n'
+        "exit 0\n"
+    )
+    console.chmod(0o755)
+    return str(tmpdir)
+
+
+# Test the parallel AIP generation returns a per-node success map
+def test_create_aip_status(caplog, tmpdir):
+    bagger_app_dir = _fake_bagger_app(tmpdir)
+    node_list = {1: {}, 2: {}}
+    with caplog.at_level(logging.INFO):
+        aip_status = drupalUtilities.create_aip(node_list, bagger_app_dir, workers=2)
+    assert aip_status == {1: True, 2: False}
+    assert "AIP [1]: bagging 1" in caplog.text
+
+
+# Test a hung AIP generation is stopped after the timeout
+def test_create_aip_timeout(caplog, tmpdir):
+    bagger_app_dir = _fake_bagger_app(tmpdir)
+    with caplog.at_level(logging.ERROR):
+        aip_status = drupalUtilities.create_aip(
+            {1: {}, 3: {}}, bagger_app_dir, workers=2, timeout=0.5
+        )
+    assert aip_status == {1: True, 3: False}
+    assert "timeout" in caplog.text
+
+
+# Test queued AIP generation maps each node of the batches to its fresh AIP
+def test_create_aip_queued(caplog, tmpdir):
+    aip_dir = tmpdir.mkdir("aip")
+    bin_dir = tmpdir.mkdir("bin")
+    console = bin_dir / "console"
+    console.write(
+        "#!/bin/sh\n"
+        'echo "$1 $(wc -l < "${2#--queue=}")"\n'
+        "while IFS=\"$(printf '\\t')\" read -r node settings; do\n"
+        '  if [ "${node}" != "2" ]; then touch "aip/aip_${node}.zip"; fi\n'
+        'done < "${2#--queue=}"\n'
+        "exit 1\n"
+    )
+    console.chmod(0o755)
+    # a stale AIP from an earlier run is not a success
+    stale = aip_dir / "aip_2.zip"
+    stale.write("")
+    os.utime(stale, (0, 0))
+    with caplog.at_level(logging.INFO):
+        aip_status = dict(
+            drupalUtilities.create_aip_queued(
+                [1, 2, 3],
+                str(tmpdir),
+                lambda node: str(aip_dir / f"aip_{node}.zip"),
+                chunk_size=2,
+                workers=2,
+            )
+        )
+    assert aip_status == {1: True, 2: False, 3: True}
+    assert "app:islandora_bagger:process_queue 2" in caplog.text
+    assert "app:islandora_bagger:process_queue 1" in caplog.text
+    assert not list(pathlib.Path(tempfile.gettempdir()).glob("leaf_bagger_*.queue"))
+
+
+# Test the media size of a node sums the file sizes of its Drupal Media
+def test_drupal_media_bytes():
+    server = "http://example.com"
+    for node_id, response in (
+        (
+            1,
+            {
+                "text": '[{"field_file_size": [{"value": 100}]},'
+                ' {"field_file_size": [{"value": "50"}]}, {}]'
+            },
+        ),
+        (2, {"text": "[]"}),
+        (3, {"status_code": 404}),
+    ):
+        _adapter.register_uri(
+            "GET",
+            f"{server}/{drupalApi.media_associated_with_node_endpoint(node_id)}",
+            **response,
+        )
+    assert drupalUtilities.media_bytes_index(_session, server, [1, 2, 3], 2) == {
+        1: 150,
+        2: 0,
+        3: None,
+    }
+
+
+# Test concurrent pages are returned in page order even when they arrive out of order
+def test_crawl_pages_order():
+    def fetch(page):
+        # later pages return first
+        time.sleep(0.01 * (5 - page) if page < 5 else 0)
+        return [page] if page < 5 else []
+
+    pages = list(drupalUtilities.crawl_pages(fetch, window=4))
+    assert pages == [[0], [1], [2], [3], [4]]
+
+
+# Test a failed page before the end of the view is raised
+def test_crawl_pages_error():
+    def fetch(page):
+        if page == 1:
+            raise requests.exceptions.HTTPError("502")
+        return [page] if page < 3 else []
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        list(drupalUtilities.crawl_pages(fetch, window=4))
+
+
+# Test the Node and Media views crawled concurrently with probes past the last page
+def test_drupal_views_concurrent(mocker):
+    mocker.patch(
+        "argparse.ArgumentParser.parse_args",
+        return_value=argparse.Namespace(date="2023-02-01", server="http://example.com"),
+    )
+    args = argparse.ArgumentParser.parse_args()
+    for page, text in enumerate(
+        [
+            '[ { "nid" : "1", "changed" : "1704067200" } ]',
+            '[ { "nid" : "2", "changed" : "1704067200" } ]',
+            "[]",
+        ]
+    ):
+        _adapter.register_uri(
+            "GET",
+            f"{args.server}/{drupalApi.node_view_endpoint(page=page, date_filter=args.date)}",
+            text=text,
+        )
+    for page, text in enumerate(
+        [
+            '[ { "changed": "1735689600", "field_media_of": "2" } ]',
+            '[ { "changed": "1735689600", "field_media_of": "3" } ]',
+            "[]",
+        ]
+    ):
+        _adapter.register_uri(
+            "GET",
+            f"{args.server}/{drupalApi.media_view_endpoint(page=page, date_filter=args.date)}",
+            text=text,
+        )
+    node_list = drupalUtilities.id_list_from_views(_session, args, window=4)
+    assert list(node_list.keys()) == [1, 2, 3]
+    assert node_list[1].changed_iso == "2024-01-01T00:00:00+00:00"
+    assert node_list[2].changed_iso == "2025-01-01T00:00:00+00:00"
+    assert node_list[3].changed_iso == "2025-01-01T00:00:00+00:00"
+
+
+# Test the Drupal session re-authenticates when the session expires mid-run
+def test_drupal_session_reauth():
+    server = "http://example.com"
+    session = drupalApi.DrupalSession(server, "user", "pass", timeout=(1, 2))
+    adapter = requests_mock.Adapter()
+    session.mount("http://", adapter)
+    login = adapter.register_uri("POST", f"{server}/user/login?_format=json", json={})
+    adapter.register_uri(
+        "GET",
+        f"{server}/{drupalApi.node_view_endpoint(page=0)}",
+        [{"status_code": 403}, {"text": "[]"}],
+    )
+    session.login()
+    response = drupalApi.get_node_list(session, server)
+    assert response.text == "[]"
+    assert login.call_count == 2
+    assert adapter.last_request.timeout == (1, 2)
+
+
+# Test the Drupal session retries transient errors of idempotent requests
+def test_drupal_session_retry(mocker):
+    http_adapter = mocker.patch("drupal.api.HTTPAdapter", wraps=drupalApi.HTTPAdapter)
+    session = drupalApi.DrupalSession(
+        "http://example.com", "user", "pass", retries=3, pool_size=4
+    )
+    adapter = session.get_adapter("http://example.com")
+    assert adapter.max_retries.total == 3
+    assert 502 in adapter.max_retries.status_forcelist
+    assert "POST" not in adapter.max_retries.allowed_methods
+    http_adapter.assert_called_once_with(
+        max_retries=adapter.max_retries, pool_connections=4, pool_maxsize=4
+    )
+
+
+# Test cached Drupal responses are revalidated with ETags and reused on 304
+def test_drupal_http_cache_revalidate(tmpdir):
+    server = "http://example.com"
+    session = drupalApi.DrupalSession(server, "user", "pass")
+    session.cache = drupalCache.HttpCache(os.path.join(tmpdir, "cache.db"))
+    adapter = requests_mock.Adapter()
+    session.mount("http://", adapter)
+    url = f"{server}/{drupalApi.node_view_endpoint(page=0)}"
+    view = adapter.register_uri(
+        "GET",
+        url,
+        [
+            {"text": '[{"nid": "1"}]', "headers": {"ETag": '"v1"'}},
+            {"status_code": 304},
+        ],
+    )
+    assert drupalApi.get_node_list(session, server).json() == [{"nid": "1"}]
+    assert drupalApi.get_node_list(session, server).json() == [{"nid": "1"}]
+    assert view.call_count == 2
+    assert "If-None-Match" not in view.request_history[0].headers
+    assert view.request_history[1].headers["If-None-Match"] == '"v1"'
+    session.close()
+
+
+# Test responses without validators are reused within the TTL and evicted LRU
+def test_drupal_http_cache_ttl_and_eviction(tmpdir):
+    with drupalCache.HttpCache(
+        os.path.join(tmpdir, "cache.db"), ttl=60, max_bytes=10
+    ) as cache:
+        response = requests.Response()
+        response._content = b"123456"
+        cache.store("a", response)
+        entry = cache.lookup("a")
+        assert cache.fresh(entry)
+        assert cache.validators(entry) == {}
+        assert not cache.fresh(entry._replace(stored_at=time.time() - 120))
+        cache.store("b", response)
+        assert cache.lookup("a") is None
+        assert cache.lookup("b").body == b"123456"
+
+
+# Test Drupal authenticated responses (no-cache, no validators) are never reused
+def test_drupal_http_cache_no_cache(tmpdir):
+    server = "http://example.com"
+    session = drupalApi.DrupalSession(server, "user", "pass")
+    session.cache = drupalCache.HttpCache(os.path.join(tmpdir, "cache.db"), ttl=3600)
+    adapter = requests_mock.Adapter()
+    session.mount("http://", adapter)
+    url = f"{server}/{drupalApi.node_view_endpoint(page=0)}"
+    headers = {"Cache-Control": "must-revalidate, no-cache, private"}
+    view = adapter.register_uri(
+        "GET",
+        url,
+        [
+            {"text": '[{"changed": "1"}]', "headers": headers},
+            {"text": '[{"changed": "2"}]', "headers": headers},
+        ],
+    )
+    assert drupalApi.get_node_list(session, server).json() == [{"changed": "1"}]
+    assert drupalApi.get_node_list(session, server).json() == [{"changed": "2"}]
+    assert view.call_count == 2
+    assert "If-None-Match" not in view.request_history[1].headers
+    assert session.cache.lookup(url) is None
+    session.close()
+
+
+# Test max-age bounds reuse and revalidation directives override the TTL
+def test_drupal_http_cache_directives(tmpdir):
+    with drupalCache.HttpCache(os.path.join(tmpdir, "cache.db"), ttl=3600) as cache:
+        response = requests.Response()
+        response._content = b"[]"
+        response.headers["Cache-Control"] = "public, max-age=60"
+        cache.store("a", response)
+        entry = cache.lookup("a")
+        assert cache.fresh(entry)
+        assert not cache.fresh(entry._replace(stored_at=time.time() - 120))
+        response.headers["Cache-Control"] = "max-age=600, must-revalidate"
+        response.headers["ETag"] = '"v1"'
+        cache.store("b", response)
+        assert not cache.fresh(cache.lookup("b"))
+        assert cache.validators(cache.lookup("b")) == {"If-None-Match": '"v1"'}
+
+
+# Test the high-water mark stops before the first unpreserved change
+def test_preserved_high_water_mark():
+    node_list = drupalInventory.NodeInventory(
+        [
+            (1, "2024-01-03T00:00:00+00:00"),
+            (2, "2024-01-01T00:00:00+00:00"),
+            (3, "2024-01-02T00:00:00+00:00"),
+        ]
+    )
+    assert (
+        drupalUtilities.preserved_high_water_mark(node_list, {1, 2, 3})
+        == "2024-01-03T00:00:00+00:00"
+    )
+    assert (
+        drupalUtilities.preserved_high_water_mark(node_list, {1, 2})
+        == "2024-01-01T00:00:00+00:00"
+    )
+    assert drupalUtilities.preserved_high_water_mark(node_list, {1, 3}) is None
+    assert (
+        drupalUtilities.date_filter_from_mark("2024-01-02T00:30:00+00:00", 3600)
+        == "2024-01-01T23:30:00Z"
+    )
+
+
+# Test the date filter of a non-UTC mark is the same instant in UTC
+def test_date_filter_from_mark_offset():
+    assert (
+        drupalUtilities.date_filter_from_mark("2024-01-02T00:30:00-06:00", 3600)
+        == "2024-01-02T05:30:00Z"
+    )
+    assert (
+        drupalUtilities.date_filter_from_mark("2024-01-02T07:30:00+07:00")
+        == "2024-01-02T00:30:00Z"
+    )
+    assert (
+        drupalUtilities.date_filter_from_mark("2024-01-02T00:30:00")
+        == "2024-01-02T00:30:00Z"
+    )
+
+
+# Test a naive ISO-8601 changed value is read as UTC whatever the local timezone
+def test_to_epoch_naive_utc(monkeypatch):
+    monkeypatch.setenv("TZ", "America/Edmonton")
+    time.tzset()
+    try:
+        assert drupalInventory.to_epoch("2024-01-01T00:00:00") == 1704067200
+        assert drupalInventory.to_epoch("2024-01-01T00:00:00+00:00") == 1704067200
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+# Test the node inventory keeps insertion order, updates in place and drops nodes
+def test_node_inventory():
+    node_list = drupalInventory.NodeInventory(
+        [("2", "1704067200"), (1, "2024-01-01T00:00:00+00:00"), (3, 1704067200)]
+    )
+    assert list(node_list) == [2, 1, 3]
+    assert node_list[1].changed == node_list[2].changed == 1704067200
+    assert node_list[1].content_type == drupalInventory.DEFAULT_CONTENT_TYPE
+
+    node_list.add(2, 1735689600, "application/x-tar")
+    node_list.discard(3)
+    node_list.add(4, 0)
+    assert [(key, item.changed) for key, item in node_list.items()] == [
+        (2, 1735689600),
+        (1, 1704067200),
+        (4, 0),
+    ]
+    assert node_list[2].changed_iso == "2025-01-01T00:00:00+00:00"
+    assert node_list[2].content_type == "application/x-tar"
+    assert 3 not in node_list and "2" not in node_list and len(node_list) == 3
+    assert list(node_list.filtered(lambda key: key > 1)) == [2, 4]
+
+
+# Test node pages stream with media changes merged and media-only nodes last
+def test_drupal_stream_nodes_with_media(mocker):
+    mocker.patch(
+        "argparse.ArgumentParser.parse_args",
+        return_value=argparse.Namespace(date="2023-03-01", server="http://example.com"),
+    )
+    args = argparse.ArgumentParser.parse_args()
+    for page, text in enumerate(
+        [
+            '[ { "nid" : "1", "changed" : "1704067200" } ]',
+            '[ { "nid" : "2", "changed" : "1704067200" } ]',
+            "[]",
+        ]
+    ):
+        _adapter.register_uri(
+            "GET",
+            f"{args.server}/{drupalApi.node_view_endpoint(page=page, date_filter=args.date)}",
+            text=text,
+        )
+    media_index = {2: 1735689600, 3: 1735689600}
+    pages = drupalUtilities.stream_nodes_with_media(_session, args, media_index, 2)
+    assert [list(page.keys()) for page in pages] == [[1], [2], [3]]
+
+    pages = list(drupalUtilities.stream_nodes_with_media(_session, args, media_index))
+    assert pages[0][1].changed == 1704067200
+    assert pages[1][2].changed == 1735689600
@@ -0,0 +1,58 @@
+"""
+Test the Prometheus textfile metrics module
+"""
+
+import os
+import sys
+
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)  # noqa:E402
+
+from metrics import prometheus as metricsPrometheus  # noqa:E402
+
+
+# Test counters, gauges and histograms render in the text exposition format
+def test_registry_render():
+    registry = metricsPrometheus.Registry()
+    registry.const_labels = {"script": "test"}
+    registry.inc("bags_total", result="success")
+    registry.inc("bags_total", 2, result="success")
+    registry.inc("bags_total", result="failure")
+    registry.set_gauge("run_seconds", 12.5)
+    registry.observe("phase_seconds", 0.2, phase="bag")
+    registry.observe("phase_seconds", 20, phase="bag")
+
+    lines = registry.render()
+    assert "# TYPE leaf_bagger_bags_total counter" in lines
+    assert 'leaf_bagger_bags_total{script="test",result="success"} 3' in lines
+    assert 'leaf_bagger_bags_total{script="test",result="failure"} 1' in lines
+    assert 'leaf_bagger_run_seconds{script="test"} 12.5' in lines
+    assert "# TYPE leaf_bagger_phase_seconds histogram" in lines
+    assert (
+        'leaf_bagger_phase_seconds_bucket{script="test",phase="bag",le="0.25"} 1'
+        in lines
+    )
+    assert (
+        'leaf_bagger_phase_seconds_bucket{script="test",phase="bag",le="30"} 2' in lines
+    )
+    assert (
+        'leaf_bagger_phase_seconds_bucket{script="test",phase="bag",le="+Inf"} 2'
+        in lines
+    )
+    assert 'leaf_bagger_phase_seconds_count{script="test",phase="bag"} 2' in lines
+
+
+# Test the textfile is written with the run gauges
+def test_write_textfile(tmp_path):
+    path = tmp_path / "leaf_bagger.prom"
+    with metricsPrometheus.timer("crawl"):
+        metricsPrometheus.inc("drupal_pages_fetched_total", view="node")
+    metricsPrometheus.write_textfile(str(path), run_seconds=1.5)
+
+    content = path.read_text()
+    assert "leaf_bagger_drupal_pages_fetched_total" in content
+    assert 'leaf_bagger_phase_seconds_count{phase="crawl"}' in content
+    assert "leaf_bagger_run_seconds 1.5" in content
+    assert "leaf_bagger_run_timestamp_seconds" in content
+    assert os.listdir(tmp_path) == ["leaf_bagger.prom"]
@@ -0,0 +1,202 @@
+"""
+Test the staged pipeline module
+"""
+
+import os
+import pytest
+import sys
+import threading
+import time
+
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)  # noqa:E402
+
+from drupal import inventory as drupalInventory  # noqa:E402
+from pipeline import sampling as pipelineSampling  # noqa:E402
+from pipeline import schedule as pipelineSchedule  # noqa:E402
+from pipeline import utilities as pipelineUtilities  # noqa:E402
+
+
+# Test items flow through every stage and failures stop at the failed stage
+def test_pipeline_results():
+    def double(key, payload):
+        return payload * 2
+
+    def fail_odd(key, payload):
+        return None if key % 2 else payload
+
+    def fail_raise(key, payload):
+        if key == 4:
+            raise ValueError("stage error")
+        return payload
+
+    results = pipelineUtilities.run_pipeline(
+        ((key, key) for key in range(6)),
+        [
+            pipelineUtilities.Stage("double", double, 2),
+            pipelineUtilities.Stage("odd", fail_odd, 2),
+            pipelineUtilities.Stage("raise", fail_raise, 1),
+        ],
+        queue_size=1,
+    )
+    assert results[0] == {"stage": "raise", "success": True}
+    assert results[1] == {"stage": "odd", "success": False}
+    assert results[4] == {"stage": "raise", "success": False}
+    assert pipelineUtilities.summarize(results) == {
+        "success": 2,
+        "odd": 3,
+        "raise": 1,
+    }
+
+
+# Test a later stage starts before an earlier stage finishes all items
+def test_pipeline_overlap():
+    second_stage_started = threading.Event()
+
+    def slow(key, payload):
+        if key == 1:
+            # the first item must reach the next stage while this one is in progress
+            second_stage_started.wait(timeout=5)
+        return payload
+
+    def mark(key, payload):
+        second_stage_started.set()
+        return payload
+
+    start = time.monotonic()
+    results = pipelineUtilities.run_pipeline(
+        [(0, "a"), (1, "b")],
+        [
+            pipelineUtilities.Stage("slow", slow, 1),
+            pipelineUtilities.Stage("mark", mark, 1),
+        ],
+    )
+    assert time.monotonic() - start < 5
+    assert all(value["success"] for value in results.values())
+
+
+# Test an error while reading the items stops the stages and is re-raised
+def test_pipeline_items_error():
+    processed = []
+
+    def items():
+        yield (0, "a")
+        raise ValueError("items error")
+
+    def record(key, payload):
+        processed.append(key)
+        return payload
+
+    with pytest.raises(ValueError):
+        pipelineUtilities.run_pipeline(
+            items(), [pipelineUtilities.Stage("record", record, 2)]
+        )
+    assert processed == [0]
+    assert not [t for t in threading.enumerate() if t.name.startswith("record-")]
+
+
+# Test largest-first ordering shortens the makespan and the cost model fits the history
+def test_lpt_schedule(tmpdir):
+    costs = {1: 1.0, 2: 1.0, 3: 1.0, 4: 1.0, 5: 4.0}
+    order = pipelineSchedule.lpt_order(costs)
+    assert order == [5, 1, 2, 3, 4]
+    assert pipelineSchedule.makespan(costs, list(costs), 2) == 6.0
+    assert pipelineSchedule.makespan(costs, order, 2) == 4.0
+
+    # bag seconds = 2 + bytes / 100
+    samples = [(0, 2.0), (100, 3.0), (1000, 12.0)]
+    stats = (
+        len(samples),
+        sum(x for x, _ in samples),
+        sum(y for _, y in samples),
+        sum(x * x for x, _ in samples),
+        sum(x * y for x, y in samples),
+    )
+    model = pipelineSchedule.fit_cost_model(stats)
+    assert abs(model.overhead - 2.0) < 1e-9
+    assert abs(model.seconds_per_byte - 0.01) < 1e-9
+    assert pipelineSchedule.estimate_cost(model, 500) == 7.0
+    assert pipelineSchedule.estimate_cost(model, 500, history=30.0) == 30.0
+    assert (
+        pipelineSchedule.fit_cost_model((1, 100, 3.0, 10000, 300.0))
+        == pipelineSchedule.DEFAULT_BAG_COST_MODEL
+    )
+
+
+# Test the sample is sized from the confidence and margin and oversamples risky strata
+def test_sampling_allocation():
+    assert pipelineSampling.sample_size(500000, 0.95, 0.02) == 2390
+    assert pipelineSampling.sample_size(100, 0.95, 0.02) == 97
+    assert pipelineSampling.sample_size(0) == 0
+
+    node_list = drupalInventory.NodeInventory(
+        (key, 1000 if key <= 100 else 0) for key in range(1, 1001)
+    )
+    verified = set(range(1, 901))
+    strata = pipelineSampling.stratify(node_list, verified, 1000)
+    sizes = {name: len(keys) for name, keys in strata.items()}
+    assert sizes == {"unverified": 100, "recent": 100, "settled": 800}
+    allocation = pipelineSampling.allocate(sizes, 200)
+    assert sum(allocation.values()) == 200
+    assert allocation["unverified"] > allocation["recent"] > sizes["recent"] * 0.2
+    assert allocation["settled"] < sizes["settled"] * 0.2
+    assert pipelineSampling.allocate({"unverified": 3, "settled": 1000}, 50) == {
+        "unverified": 3,
+        "settled": 47,
+    }
+
+    sample = pipelineSampling.draw(strata, allocation)
+    for name, keys in sample.items():
+        assert len(set(keys)) == allocation[name]
+        assert set(keys) <= set(strata[name])
+
+
+# Test the failure-rate estimate weights strata by population share
+def test_sampling_failure_rate():
+    sizes = {"unverified": 100, "settled": 900}
+    rate = pipelineSampling.failure_rate(
+        sizes, {"unverified": ["xm"] * 10 + [""] * 40, "settled": [""] * 100}
+    )
+    assert round(rate.estimate, 6) == 0.02
+    assert rate.lower < rate.estimate < rate.upper
+    assert (rate.sampled, rate.failures) == (150, 10)
+
+    rate = pipelineSampling.failure_rate(sizes, {"settled": [""] * 100}, 0.95)
+    assert rate.estimate == 0.0
+    assert 0.03 < rate.upper < 0.04
+
+    # sampled nodes without an audit row are failures and leave the rate unbounded
+    rate = pipelineSampling.failure_rate(sizes, {"settled": [""] * 98 + [None] * 2})
+    assert (rate.sampled, rate.failures, rate.unaudited) == (100, 2, 2)
+    assert rate.estimate > 0 and rate.upper == 1.0
+    rate = pipelineSampling.failure_rate(sizes, {"settled": []})
+    assert (rate.sampled, rate.upper) == (0, 1.0)
+
+
+# Test the sample size grows with the design effect of the stratum weights
+def test_sampling_design_effect():
+    assert pipelineSampling.design_effect({"settled": 1000}) == 1.0
+    assert pipelineSampling.design_effect({"unverified": 0, "settled": 1000}) == 1.0
+    sizes = {"unverified": 100, "recent": 100, "settled": 800}
+    deff = pipelineSampling.design_effect(sizes)
+    # (0.1 / 4 + 0.1 / 2 + 0.8) * (0.1 * 4 + 0.1 * 2 + 0.8)
+    assert abs(deff - 0.875 * 1.4) < 1e-9
+    n = pipelineSampling.sample_size(500000, 0.95, 0.02, design_effect=deff)
+    assert n > pipelineSampling.sample_size(500000, 0.95, 0.02)
+
+    # the allocated stratified sample reaches the margin of error at p = 0.5 only
+    # with the design effect applied
+    sizes = {name: size * 1000 for name, size in sizes.items()}
+
+    def half_width(n):
+        allocation = pipelineSampling.allocate(sizes, n)
+        variance = sum(
+            (sizes[name] / 10**6) ** 2 * 0.25 / allocation[name] for name in sizes
+        )
+        return pipelineSampling.z_score(0.95) * variance**0.5
+
+    n = pipelineSampling.sample_size(10**6, 0.95, 0.05, design_effect=deff)
+    # within the rounding of the allocation
+    assert half_width(n) < 0.0505
+    assert half_width(pipelineSampling.sample_size(10**6, 0.95, 0.05)) > 0.05
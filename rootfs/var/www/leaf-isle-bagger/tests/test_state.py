@@ -0,0 +1,162 @@
+"""
+Test the preservation state store
+"""
+
+import csv
+import io
+import os
+import sys
+
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)  # noqa:E402
+
+from drupal import inventory as drupalInventory  # noqa:E402
+from state import journal as stateJournal  # noqa:E402
+from state import store as stateStore  # noqa:E402
+from swift import utilities as swiftUtilities  # noqa:E402
+
+_checksums = {"md5sum": "a", "sha256sum": "b"}
+
+
+# Test a verified upload marks the node current for its changed timestamp
+def test_state_store_current(tmpdir):
+    node_list = drupalInventory.NodeInventory(
+        [(1, "2024-01-01T01:01:01+00:00"), (2, "2024-01-01T01:01:01+00:00")]
+    )
+    with stateStore.StateStore(str(tmpdir / "state.sqlite")) as state_store:
+        state_store.record_discovered(node_list)
+        state_store.record_upload(
+            1,
+            node_list[1].changed_iso,
+            "aip_1.zip",
+            158,
+            _checksums,
+            "CWRC",
+            "user",
+            {"etag": "a", "last_modified": "Wed, 29 May 2024 22:29:37 GMT"},
+        )
+        state_store.record_verified(1, node_list[1].changed_iso)
+        assert state_store.find_current(node_list) == {1}
+        assert state_store.get(1)["swift_etag"] == "a"
+
+        # a newer Drupal change makes the node stale
+        node_list.add(1, "2025-01-01T01:01:01+00:00")
+        assert state_store.find_current(node_list) == set()
+
+        # the upload report is a view of the store
+        fd = io.StringIO()
+        state_store.export_uploads(swiftUtilities.log_init(fd))
+        rows = list(csv.DictReader(io.StringIO(fd.getvalue())))
+        assert [row["id"] for row in rows] == ["aip_1.zip"]
+        assert rows[0]["sha256sum"] == "b"
+
+        # exported in node id order
+        for key in (10, 2):
+            state_store.record_upload(
+                key,
+                "",
+                "",
+                0,
+                _checksums,
+                "CWRC",
+                "user",
+                {"etag": "", "last_modified": ""},
+            )
+        fd = io.StringIO()
+        state_store.export_uploads(swiftUtilities.log_init(fd))
+        rows = list(csv.DictReader(io.StringIO(fd.getvalue())))
+        assert [row["id"] for row in rows] == ["aip_1.zip", "aip_2.zip", "aip_10.zip"]
+        assert set(state_store.get_many([1, 2, 3])) == {1, 2}
+
+
+# Test audit rows are recorded in the store and exported unchanged
+def test_state_store_audit(tmpdir):
+    with stateStore.StateStore(str(tmpdir / "state.sqlite")) as state_store:
+        fd = io.StringIO()
+        audit_writer = stateStore.AuditRecorder(
+            swiftUtilities.audit_init(fd), state_store
+        )
+        swiftUtilities.audit_record(
+            audit_writer,
+            1,
+            "2024-01-01T01:01:01+00:00",
+            "aip_1.zip",
+            "Wed, 29 May 2024 22:29:37 GMT",
+            "2024-01-01T01:01:01+00:00",
+            "158",
+            "",
+        )
+        swiftUtilities.audit_record(
+            audit_writer, 2, "2024-01-01T01:01:01+00:00", status="xm"
+        )
+        assert state_store.get(1)["last_verified_at"] is not None
+        assert state_store.get(2)["audit_status"] == "xm"
+
+        exported = io.StringIO()
+        state_store.export_audit(swiftUtilities.audit_init(exported))
+        assert exported.getvalue() == fd.getvalue()
+
+
+# Test named marks persist across connections
+def test_state_store_marks(tmpdir):
+    path = str(tmpdir / "state.sqlite")
+    with stateStore.StateStore(path) as state_store:
+        assert state_store.get_mark("preserved_changed") is None
+        state_store.set_mark("preserved_changed", "a")
+        state_store.set_mark("preserved_changed", "b")
+    with stateStore.StateStore(path) as state_store:
+        assert state_store.get_mark("preserved_changed") == "b"
+
+
+# Test bag times are recorded per node and summarized for the cost model
+def test_state_store_bag_history(tmpdir):
+    with stateStore.StateStore(str(tmpdir / "state.sqlite")) as state_store:
+        state_store.record_bag_time(1, 100, 3.0)
+        state_store.record_bag_time(2, None, 5.0)
+        state_store.record_bag_time(1, 200, 4.0)
+        state_store.record_bag_time(1, None, 4.0)
+        assert state_store.bag_times([1, 2, 3]) == {1: 4.0, 2: 5.0}
+        assert state_store.bag_history_stats() == (1, 200.0, 4.0, 40000.0, 800.0)
+
+
+# Test an unfinished run resumes with its node list and recorded stages
+def test_run_journal_resume(tmpdir):
+    aip_path = tmpdir / "aip_1.zip"
+    aip_path.write_binary(b"aip")
+    node_list = drupalInventory.NodeInventory(
+        [(1, "2024-01-01T01:01:01+00:00"), (2, "2024-01-01T01:01:01+00:00")]
+    )
+    path = str(tmpdir / "journal.sqlite")
+    with stateJournal.RunJournal(path) as journal:
+        assert journal.resume() is None
+        journal.start(node_list)
+        journal.record_bagged(1, str(aip_path))
+        journal.record_hashed(1, _checksums)
+        journal.record_uploaded(1, "etag")
+
+    with stateJournal.RunJournal(path) as journal:
+        assert journal.resume() == node_list
+        assert journal.done(1, "hashed")
+        assert journal.done(1, "uploaded")
+        assert not journal.done(1, "validated")
+        assert not journal.done(2, "bagged")
+        assert journal.done_with_aip(1, "hashed", str(aip_path))
+        assert journal.get(1)["swift_etag"] == "etag"
+
+        # a rewritten AIP invalidates the recorded local stages
+        aip_path.write_binary(b"new aip")
+        assert not journal.done_with_aip(1, "bagged", str(aip_path))
+
+        journal.finish()
+        assert journal.resume() is None
+
+
+# Test a new run abandons an earlier unfinished run
+def test_run_journal_abandon(tmpdir):
+    node_list = drupalInventory.NodeInventory([(1, 1)])
+    with stateJournal.RunJournal(str(tmpdir / "journal.sqlite")) as journal:
+        first = journal.start(node_list)
+        second = journal.start(drupalInventory.NodeInventory([(2, 2)]))
+        assert second != first
+        assert list(journal.resume().keys()) == [2]
@@ -3,13 +3,17 @@ Test the OpenStack Swift integration module
 """
 
 import csv
+import hashlib
 import logging
 import os
+import pytest
 import shutil
 import sys
+import zipfile
 
+from swiftclient.client import Connection
 from swiftclient.service import (
-    # ClientException,
+    ClientException,
     # SwiftError,
     SwiftService,
     # SwiftUploadObject,
@@ -19,6 +23,10 @@ sys.path.append(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 )  # noqa:E402
 
+from drupal import inventory as drupalInventory  # noqa:E402
+from state import store as stateStore  # noqa:E402
+from swift import connection as swiftConnection  # noqa:E402
+from swift import fixity as swiftFixity  # noqa:E402
 from swift import utilities as swiftUtilities  # noqa:E402
 
 _object_id = "a:1"
@@ -41,6 +49,22 @@ _swift_download_response = {
 _aip_dir = "rootfs/var/www/leaf-isle-bagger/tests/assets/fixtures"
 
 
+# Mock the Swift container listing used to index the audit
+def _mock_swift_listing(mocker, names=("aip_1.zip",)):
+    return mocker.patch(
+        f"{__name__}.SwiftService.list",
+        return_value=[
+            {
+                "success": True,
+                "listing": [
+                    {"name": name, "bytes": 158, "hash": "", "last_modified": ""}
+                    for name in names
+                ],
+            }
+        ],
+    )
+
+
 def test_upload_to_destination(tmpdir, mocker):
     # test AIP
     t = {"path": f"{tmpdir}/aip_{_object_id}.zip"}
@@ -70,19 +94,108 @@ def test_upload_to_destination(tmpdir, mocker):
                 }
             ],
         )
-        swiftUtilities.upload(SwiftService, upload_obj, "CWRC", csv_obj)
+        uploaded = swiftUtilities.upload(SwiftService, upload_obj, "CWRC", csv_obj)
+        assert uploaded[_object_id]["etag"] == "94813657ffbc76defd96ac21ff4061ca"
     with open(csv_path, "r", newline="") as tmp_fd:
         dr = csv.DictReader(tmp_fd)
         for row in dr:
             assert row["id"] == _object_id
 
 
+# Test upload options follow the AIP size
+def test_upload_options():
+    tuning = swiftUtilities.UploadTuning(100, 10, 5, True)
+    assert swiftUtilities.upload_options(100, tuning) == {}
+    assert swiftUtilities.upload_options(101, tuning) == {
+        "segment_size": 21,
+        "use_slo": True,
+    }
+    assert swiftUtilities.upload_options(40, tuning._replace(segment_threshold=0)) == {
+        "segment_size": 10,
+        "use_slo": True,
+    }
+
+
+# Test a segmented large object is verified by its segments and logged
+def test_upload_segmented(tmpdir, mocker):
+    t = {"path": f"{tmpdir}/aip_{_object_id}.zip"}
+    shutil.copy(
+        "rootfs/var/www/leaf-isle-bagger/tests/assets/fixtures/aip_1.zip", t["path"]
+    )
+    size = os.path.getsize(t["path"])
+    upload_obj = [
+        swiftUtilities.build_swift_upload_object(t["path"], _object_id, {}, {})
+    ]
+    segments = [
+        {
+            "action": "upload_segment",
+            "success": True,
+            "for_object": _object_id,
+            "segment_index": index,
+            "segment_size": segment_size,
+            "segment_etag": f"etag{index}",
+            "log_line": f"{_object_id} segment {index}",
+        }
+        for index, segment_size in enumerate((100, size - 100))
+    ]
+    csv_path = tmpdir / "csv"
+    with open(csv_path, "w", newline="") as csv_fd:
+        csv_obj = swiftUtilities.log_init(csv_fd)
+        mock_upload = mocker.patch(
+            f"{__name__}.SwiftService.upload",
+            return_value=segments
+            + [
+                {
+                    "action": "upload_object",
+                    "success": True,
+                    "path": t["path"],
+                    "object": _object_id,
+                    "large_object": True,
+                    "segment_results": segments,
+                    "manifest_response_dict": {
+                        "headers": {"etag": '"manifest"', "last-modified": "a"}
+                    },
+                }
+            ],
+        )
+        options = {"segment_size": 100, "use_slo": True}
+        uploaded = swiftUtilities.upload(
+            SwiftService, upload_obj, "CWRC", csv_obj, options=options
+        )
+        mock_upload.assert_called_once_with("CWRC", upload_obj, options)
+        assert uploaded[_object_id]["etag"] == "manifest"
+        assert uploaded[_object_id]["checksums"]["md5sum"]
+    with open(csv_path, "r", newline="") as tmp_fd:
+        rows = list(csv.DictReader(tmp_fd))
+        assert [row["id"] for row in rows] == [_object_id]
+        assert rows[0]["last_updated_at"] == "a"
+
+    # a missing segment fails verification
+    mocker.patch(
+        f"{__name__}.SwiftService.upload",
+        return_value=[
+            {
+                "action": "upload_object",
+                "success": True,
+                "path": t["path"],
+                "object": _object_id,
+                "large_object": True,
+                "segment_results": segments[:1],
+                "manifest_response_dict": {
+                    "headers": {"etag": "", "last-modified": ""}
+                },
+            }
+        ],
+    )
+    assert swiftUtilities.upload(SwiftService, upload_obj, "CWRC") == {}
+
+
 # Test validation
 # https://docs.pytest.org/en/latest/how-to/logging.html#caplog-fixture
 def test_validation(caplog, mocker):
-    node_list = {1: {"changed": "2025-01-01", "content_type": "application/zip"}}
+    node_list = drupalInventory.NodeInventory([(1, "2025-01-01")])
     mocker.patch(
-        f"{__name__}.swiftUtilities.SwiftService.stat",
+        f"{__name__}.SwiftService.stat",
         return_value=[
             {
                 "headers": {"x-object-meta-last-mod-timestamp": "2025-01-01"},
@@ -98,7 +211,7 @@ def test_validation(caplog, mocker):
 
 # Test validation: fail on date
 def test_validation_date_mismatch(caplog, mocker):
-    node_list = {1: {"changed": "2025-01-01", "content_type": "application/zip"}}
+    node_list = drupalInventory.NodeInventory([(1, "2025-01-01")])
     mocker.patch(
         f"{__name__}.SwiftService.stat",
         return_value=[
@@ -115,9 +228,28 @@ def test_validation_date_mismatch(caplog, mocker):
         assert "mismatched modification timestamp" in caplog.text
 
 
+# Test single node validation reports the result
+def test_validate_node(mocker):
+    mocker.patch(
+        f"{__name__}.SwiftService.stat",
+        return_value=[
+            {
+                "headers": {"x-object-meta-last-mod-timestamp": "2024-01-01"},
+                "success": True,
+            }
+        ],
+    )
+    with SwiftService() as swift_conn:
+        node_list = drupalInventory.NodeInventory(
+            [(1, "2024-01-01"), (2, "2025-01-01")]
+        )
+        assert swiftUtilities.validate_node(swift_conn, 1, node_list[1], "")
+        assert not swiftUtilities.validate_node(swift_conn, 2, node_list[2], "")
+
+
 # Test validation: fail on missing id
 def test_validation_id_mismatch(caplog, mocker):
-    node_list = {1: {"changed": "2025-01-01", "content_type": "application/zip"}}
+    node_list = drupalInventory.NodeInventory([(1, "2025-01-01")])
     mocker.patch(f"{__name__}.SwiftService.stat", return_value=[])
     with caplog.at_level(logging.ERROR):
         swiftUtilities.validate(node_list, "")
@@ -128,9 +260,8 @@ def test_validation_id_mismatch(caplog, mocker):
 
 # Test Audit
 def test_audit(caplog, mocker, tmpdir):
-    node_list = {
-        1: {"changed": "2024-01-01T01:01:01+00:00", "content_type": "application/zip"}
-    }
+    node_list = drupalInventory.NodeInventory([(1, "2024-01-01T01:01:01+00:00")])
+    _mock_swift_listing(mocker)
     mocker.patch(
         f"{__name__}.SwiftService.stat",
         return_value=[
@@ -156,11 +287,63 @@ def test_audit(caplog, mocker, tmpdir):
                 assert record.levelname != "ERROR"
 
 
+# Test the audit answers a verified, unchanged Swift copy from the state store
+def test_audit_state_store(mocker, tmpdir):
+    node_list = drupalInventory.NodeInventory(
+        [(1, "2024-01-01T01:01:01+00:00"), (2, "2024-01-01T01:01:01+00:00")]
+    )
+    checksums = swiftUtilities.file_checksum(f"{_aip_dir}/aip_1.zip")
+    mocker.patch(
+        f"{__name__}.SwiftService.list",
+        return_value=[
+            {
+                "success": True,
+                "listing": [
+                    {
+                        "name": "aip_1.zip",
+                        "bytes": 158,
+                        "hash": checksums["md5sum"],
+                        "last_modified": "2024-05-29T22:29:37.000000",
+                    }
+                ],
+            }
+        ],
+    )
+    stat = mocker.patch(f"{__name__}.SwiftService.stat", return_value=[])
+    with stateStore.StateStore(str(tmpdir / "state.sqlite")) as state_store:
+        state_store.record_upload(
+            1,
+            node_list[1].changed_iso,
+            f"{_aip_dir}/aip_1.zip",
+            158,
+            checksums,
+            "",
+            "user",
+            {"etag": checksums["md5sum"], "last_modified": ""},
+        )
+        state_store.record_verified(1, node_list[1].changed_iso)
+        audit_path = tmpdir / "csv"
+        with open(audit_path, "w", newline="") as audit_fd:
+            audit_obj = swiftUtilities.audit_init(audit_fd)
+            swiftUtilities.audit(
+                audit_obj, node_list, _aip_dir, "", state_store=state_store
+            )
+    # no HEAD request for the node vouched for by the store
+    stat.assert_not_called()
+    with open(audit_path, "r", newline="") as audit_fd:
+        rows = sorted(csv.DictReader(audit_fd), key=lambda row: row["drupal_id"])
+    assert [(row["drupal_id"], row["status"]) for row in rows] == [
+        ("1", ""),
+        ("2", "xm"),
+    ]
+    assert rows[0]["swift_timestamp"] == "2024-05-29T22:29:37"
+    assert rows[0]["swift_bytes"] == "158"
+
+
 # Test validation: fail on preservation date
 def test_audit_date_mismatch(caplog, mocker, tmpdir):
-    node_list = {
-        1: {"changed": "2024-01-01T01:01:01+00:00", "content_type": "application/zip"}
-    }
+    node_list = drupalInventory.NodeInventory([(1, "2024-01-01T01:01:01+00:00")])
+    _mock_swift_listing(mocker)
     mocker.patch(
         f"{__name__}.SwiftService.stat",
         return_value=[
@@ -189,9 +372,8 @@ def test_audit_date_mismatch(caplog, mocker, tmpdir):
 
 # Test validation: fail on file date
 def test_audit_date_mismatch_file(caplog, mocker, tmpdir):
-    node_list = {
-        1: {"changed": "9999-01-01T01:01:01+00:00", "content_type": "application/zip"}
-    }
+    node_list = drupalInventory.NodeInventory([(1, "9999-01-01T01:01:01+00:00")])
+    _mock_swift_listing(mocker)
     mocker.patch(
         f"{__name__}.SwiftService.stat",
         return_value=[
@@ -220,9 +402,8 @@ def test_audit_date_mismatch_file(caplog, mocker, tmpdir):
 
 # Test validation: fail on file checksum
 def test_audit_checksum(caplog, mocker, tmpdir):
-    node_list = {
-        1: {"changed": "2024-01-01T01:01:01+00:00", "content_type": "application/zip"}
-    }
+    node_list = drupalInventory.NodeInventory([(1, "2024-01-01T01:01:01+00:00")])
+    _mock_swift_listing(mocker)
     mocker.patch(
         f"{__name__}.SwiftService.stat",
         return_value=[
@@ -251,12 +432,11 @@ def test_audit_checksum(caplog, mocker, tmpdir):
 
 # Test validation: fail on missing id
 def test_audit_id_mismatch(caplog, mocker, tmpdir):
-    node_list = {
-        1: {"changed": "2024-01-01T01:01:01+00:00", "content_type": "application/zip"}
-    }
+    node_list = drupalInventory.NodeInventory([(1, "2024-01-01T01:01:01+00:00")])
+    _mock_swift_listing(mocker)
     mocker.patch(
         f"{__name__}.SwiftService.stat",
-        return_value=[{"success": False, "error": ""}],
+        return_value=[{"success": False, "error": "", "object": "aip_1.zip"}],
     )
     with caplog.at_level(logging.ERROR):
         audit_path = tmpdir / "csv"
@@ -266,3 +446,362 @@ def test_audit_id_mismatch(caplog, mocker, tmpdir):
             for record in caplog.records:
                 assert record.levelname == "ERROR"
             assert "preservation error" in caplog.text
+
+
+# Test audit: objects absent from the container listing are not requested
+def test_audit_listing_missing(caplog, mocker, tmpdir):
+    node_list = drupalInventory.NodeInventory([(1, "2024-01-01T01:01:01+00:00")])
+    _mock_swift_listing(mocker, names=[])
+    stat = mocker.patch(f"{__name__}.SwiftService.stat", return_value=[])
+    with caplog.at_level(logging.ERROR):
+        audit_path = tmpdir / "csv"
+        with open(audit_path, "w", newline="") as audit_fd:
+            audit_obj = swiftUtilities.audit_init(audit_fd)
+            swiftUtilities.audit(audit_obj, node_list, _aip_dir, "")
+        assert "not in container listing" in caplog.text
+    stat.assert_not_called()
+    with open(audit_path, "r", newline="") as audit_fd:
+        rows = list(csv.DictReader(audit_fd))
+    assert rows[0]["status"] == "sm"
+
+
+# Test the fixity cache avoids re-reading unchanged files
+def test_fixity_cache(mocker, tmpdir):
+    aip_path = str(tmpdir / "aip_1.zip")
+    shutil.copy(f"{_aip_dir}/aip_1.zip", aip_path)
+    expected = swiftUtilities.file_checksum(aip_path)
+    with swiftFixity.FixityCache(str(tmpdir / "fixity.sqlite")) as fixity_cache:
+        assert swiftUtilities.file_checksum(aip_path, fixity_cache) == expected
+        spy = mocker.spy(swiftUtilities, "_file_checksum")
+        assert swiftUtilities.file_checksum(aip_path, fixity_cache) == expected
+        spy.assert_not_called()
+        # a changed file is rehashed
+        with open(aip_path, "ab") as f:
+            f.write(b"0")
+        assert swiftUtilities.file_checksum(aip_path, fixity_cache) != expected
+        spy.assert_called_once()
+
+
+# Test the fixity cache rehash policy
+def test_fixity_cache_rehash(mocker, tmpdir):
+    aip_path = str(tmpdir / "aip_1.zip")
+    shutil.copy(f"{_aip_dir}/aip_1.zip", aip_path)
+    with swiftFixity.FixityCache(
+        str(tmpdir / "fixity.sqlite"), rehash_older_than=0
+    ) as fixity_cache:
+        swiftUtilities.file_checksum(aip_path, fixity_cache)
+        spy = mocker.spy(swiftUtilities, "_file_checksum")
+        swiftUtilities.file_checksum(aip_path, fixity_cache)
+        spy.assert_called_once()
+
+
+# Test a failed read yields no checksum and is not cached
+def test_fixity_cache_read_error(mocker, tmpdir):
+    aip_path = str(tmpdir / "aip_1.zip")
+    shutil.copy(f"{_aip_dir}/aip_1.zip", aip_path)
+    expected = swiftUtilities.file_checksum(aip_path)
+    with swiftFixity.FixityCache(str(tmpdir / "fixity.sqlite")) as fixity_cache:
+        mocker.patch.object(
+            swiftUtilities, "open", create=True, side_effect=OSError(5, "EIO")
+        )
+        assert swiftUtilities.file_checksum(aip_path, fixity_cache) is None
+        assert fixity_cache.lookup(aip_path, os.stat(aip_path)) is None
+        mocker.stopall()
+        assert swiftUtilities.file_checksum(aip_path, fixity_cache) == expected
+        missing = str(tmpdir / "aip_2.zip")
+        assert swiftUtilities.file_checksum(missing, fixity_cache) is None
+
+
+# Test nodes preserved with the current changed timestamp are found
+def test_find_current(mocker):
+    node_list = drupalInventory.NodeInventory(
+        [
+            (1, "2024-01-01T01:01:01+00:00"),
+            (2, "2025-01-01T01:01:01+00:00"),
+            (3, "2025-01-01T01:01:01+00:00"),
+        ]
+    )
+    mocker.patch(
+        f"{__name__}.SwiftService.stat",
+        return_value=[
+            {
+                "object": "aip_1.zip",
+                "success": True,
+                "headers": {
+                    "x-object-meta-last-mod-timestamp": "2024-01-01T01:01:01+00:00"
+                },
+            },
+            {
+                "object": "aip_2.zip",
+                "success": True,
+                "headers": {
+                    "x-object-meta-last-mod-timestamp": "2024-01-01T01:01:01+00:00"
+                },
+            },
+            {"object": "aip_3.zip", "success": False, "error": ""},
+        ],
+    )
+    with SwiftService() as swift_conn:
+        assert swiftUtilities.find_current(swift_conn, node_list, "") == {1}
+
+
+# Test a local AIP is current unless older than the Drupal changed timestamp
+def test_aip_current(tmpdir):
+    aip_path = str(tmpdir / "aip_1.zip")
+    shutil.copy(f"{_aip_dir}/aip_1.zip", aip_path)
+    os.utime(aip_path, (1704070861, 1704070861))
+    node = drupalInventory.NodeRecord(1, 1704070861, "application/zip")
+    assert swiftUtilities.aip_current(aip_path, node)
+    node.changed += 1
+    assert not swiftUtilities.aip_current(aip_path, node)
+    assert not swiftUtilities.aip_current(str(tmpdir / "aip_2.zip"), node)
+
+
+# Write a bag zip whose payload manifest lists the given lines
+def _write_bag(path, manifest_lines, date_time):
+    with zipfile.ZipFile(path, "w") as bag:
+        for name, content in (
+            ("aip_1/bag-info.txt", f"Bagging-Date: {date_time[:3]}\n"),
+            ("aip_1/manifest-sha256.txt", "\n".join(manifest_lines) + "\n"),
+        ):
+            bag.writestr(zipfile.ZipInfo(name, date_time), content)
+
+
+# Test the payload digest ignores zip timestamps and manifest order
+def test_payload_digest(tmpdir):
+    lines = ["aa  data/a.xml", "bb  data/b.jpg"]
+    _write_bag(str(tmpdir / "a.zip"), lines, (2024, 1, 1, 0, 0, 0))
+    _write_bag(str(tmpdir / "b.zip"), lines[::-1], (2025, 1, 1, 0, 0, 0))
+    _write_bag(str(tmpdir / "c.zip"), ["cc  data/a.xml"], (2024, 1, 1, 0, 0, 0))
+    digest = swiftUtilities.payload_digest(str(tmpdir / "a.zip"))
+    assert digest is not None
+    assert swiftUtilities.payload_digest(str(tmpdir / "b.zip")) == digest
+    assert swiftUtilities.payload_digest(str(tmpdir / "c.zip")) != digest
+    assert swiftUtilities.payload_digest(f"{_aip_dir}/aip_1.zip") is None
+
+
+# Test an AIP with the payload of the Swift copy is not uploaded again
+def test_upload_dedupe_payload(tmpdir, mocker):
+    _write_bag(str(tmpdir / "aip_1.zip"), ["aa  data/a.xml"], (2024, 1, 1, 0, 0, 0))
+    payload = swiftUtilities.payload_digest(str(tmpdir / "aip_1.zip"))
+    node = drupalInventory.NodeRecord(1, 1735693261, "application/zip")
+    mocker.patch(
+        f"{__name__}.SwiftService.stat",
+        return_value=[
+            {
+                "object": "aip_1.zip",
+                "success": True,
+                "headers": {
+                    "etag": '"94813657ffbc76defd96ac21ff4061ca"',
+                    "last-modified": "Wed, 29 May 2024 22:29:37 GMT",
+                    "x-object-meta-last-mod-timestamp": "2024-01-01T01:01:01+00:00",
+                    "x-object-meta-sha256sum": "4e7c",
+                    "x-object-meta-project": "c",
+                    "x-object-meta-payload-sha256": payload,
+                },
+            }
+        ],
+    )
+    post = mocker.patch(
+        f"{__name__}.SwiftService.post", return_value=[{"success": True}]
+    )
+    upload = mocker.patch(f"{__name__}.SwiftService.upload")
+    checksums = swiftUtilities.file_checksum(str(tmpdir / "aip_1.zip"))
+    with SwiftService() as swift_conn:
+        uploaded = swiftUtilities.upload_aip_node(
+            swift_conn, 1, node, checksums, str(tmpdir), {}, "", dedupe=True
+        )
+    upload.assert_not_called()
+    assert uploaded["etag"] == "94813657ffbc76defd96ac21ff4061ca"
+    assert uploaded["checksums"]["sha256sum"] == "4e7c"
+    headers = post.call_args.args[1][0].options["header"]
+    assert headers["x-object-meta-last-mod-timestamp"] == node.changed_iso
+    assert headers["x-object-meta-project"] == "c"
+    assert headers["x-object-meta-payload-sha256"] == payload
+    assert headers["x-object-meta-dedupe-sha256sum"] == checksums["sha256sum"]
+
+
+# Write a bag zip of the given payload files with a matching payload manifest
+def _write_payload_bag(path, files, manifest=None):
+    manifest = manifest or files
+    with zipfile.ZipFile(path, "w") as bag:
+        bag.writestr(
+            "aip_1/manifest-sha256.txt",
+            "".join(
+                f"{hashlib.sha256(content).hexdigest()}  {name}\n"
+                for name, content in manifest.items()
+            ),
+        )
+        for name, content in files.items():
+            bag.writestr(f"aip_1/{name}", content)
+
+
+# Test a checksum mismatch is excused only for a recorded dedupe of a valid local bag
+def test_audit_dedupe_payload(tmpdir):
+    aip_path = str(tmpdir / "aip_1.zip")
+    files = {"data/a.xml": b"<a/>", "data/b.jpg": b"jpg"}
+    _write_payload_bag(aip_path, files)
+    assert swiftUtilities.payload_valid(aip_path)
+    node = drupalInventory.NodeRecord(1, 1704070861, "application/zip")
+    checksums = swiftUtilities.file_checksum(aip_path)
+    headers = {
+        "x-object-meta-last-mod-timestamp": node.changed_iso,
+        "x-object-meta-sha256sum": "0",
+        "x-object-meta-payload-sha256": swiftUtilities.payload_digest(aip_path),
+    }
+
+    def status(headers, checksums=checksums):
+        return swiftUtilities.audit_swift_properties(
+            1, node, {"headers": headers}, checksums, "aip_1.zip", aip_path
+        )
+
+    # the same payload manifest alone does not excuse the mismatch
+    assert status(headers) == "sw"
+    deduped = dict(
+        headers, **{"x-object-meta-dedupe-sha256sum": checksums["sha256sum"]}
+    )
+    assert status(deduped) == ""
+    # nor does a dedupe recorded for other local AIP bytes
+    assert status(deduped, {"md5sum": "", "sha256sum": "1"}) == "sw"
+
+    # a local payload file that no longer matches the manifest
+    _write_payload_bag(aip_path, dict(files, **{"data/b.jpg": b"jpG"}), files)
+    assert not swiftUtilities.payload_valid(aip_path)
+    checksums = swiftUtilities.file_checksum(aip_path)
+    deduped["x-object-meta-dedupe-sha256sum"] = checksums["sha256sum"]
+    assert status(deduped, checksums) == "sw"
+    # a payload file missing from the manifest
+    _write_payload_bag(aip_path, dict(files, **{"data/c.txt": b"c"}), files)
+    assert not swiftUtilities.payload_valid(aip_path)
+
+
+# Test the token cache is private, per account and reused until near expiry
+def test_swift_token_cache(tmpdir, mocker):
+    path = str(tmpdir / "token.json")
+    get_conn = mocker.patch.object(swiftConnection, "get_conn")
+    get_conn.return_value.get_auth.return_value = ("http://swift/v1/a", "t1")
+    options = {"auth": "http://auth/v1.0", "user": "u", "key": "k"}
+
+    token_cache = swiftConnection.TokenCache(path, ttl=3600)
+    assert swiftConnection.authenticate(options, token_cache) == (
+        "http://swift/v1/a",
+        "t1",
+    )
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert swiftConnection.authenticate(options, token_cache)[1] == "t1"
+    assert get_conn.return_value.get_auth.call_count == 1
+
+    # another account or a token within the expiry margin is not reused
+    get_conn.return_value.get_auth.return_value = ("http://swift/v1/b", "t2")
+    assert swiftConnection.authenticate(dict(options, user="v"), token_cache)[1] == "t2"
+    token_cache = swiftConnection.TokenCache(path, ttl=60)
+    token_cache.store("a", "http://swift/v1/a", "t3")
+    assert token_cache.load("a") is None
+
+
+# Test a connection re-authenticating after a 401 replaces the cached token
+def test_swift_token_reauth(tmpdir, mocker):
+    token_cache = swiftConnection.TokenCache(str(tmpdir / "token.json"))
+    options = {"auth": "http://auth/v1.0", "user": "u", "key": "k"}
+    service = swiftConnection.SharedService(
+        options, ("http://swift/v1/a", "t1"), token_cache
+    )
+    identity = swiftConnection.auth_identity(service.connection_options)
+    token_cache.store(identity, "http://swift/v1/a", "t1")
+    get_auth = mocker.patch.object(
+        Connection,
+        "get_auth",
+        return_value=("http://swift/v1/a", "t2"),
+    )
+
+    conn = swiftConnection.new_connection(service)
+    assert (conn.url, conn.token) == ("http://swift/v1/a", "t1")
+    assert conn.get_auth() == ("http://swift/v1/a", "t2")
+    assert token_cache.load(identity) == ("http://swift/v1/a", "t2")
+    assert swiftConnection.new_connection(service).token == "t2"
+
+    # a failed re-authentication drops the revoked token
+    get_auth.side_effect = ClientException("Unauthorized")
+    with pytest.raises(ClientException):
+        conn.get_auth()
+    assert token_cache.load(identity) is None
+
+
+# Test phases share the Swift service opened for the process
+def test_swift_shared_service(mocker):
+    mocker.patch.object(swiftConnection, "authenticate", return_value={})
+    with swiftConnection.open_service() as service:
+        with swiftUtilities.swift_service() as shared:
+            assert shared is service
+    assert swiftConnection.shared_service() is None
+    with swiftUtilities.swift_service() as other:
+        assert other is not service
+
+
+# Test shards partition the node list and merge back into one report
+def test_audit_shard_merge(tmpdir):
+    node_list = drupalInventory.NodeInventory((key, 0) for key in range(1, 51))
+    shards = [swiftUtilities.audit_shard(node_list, index, 3) for index in range(3)]
+    assert sum(len(shard) for shard in shards) == len(node_list)
+    assert set().union(*(set(shard) for shard in shards)) == set(node_list)
+    assert shards[0] == swiftUtilities.audit_shard(node_list, 0, 3)
+
+    paths = []
+    for index, shard in enumerate(shards):
+        paths.append(str(tmpdir / f"audit_{index}.csv"))
+        with open(paths[-1], "w", newline="") as fd:
+            audit_writer = swiftUtilities.audit_init(fd)
+            for key in shard:
+                swiftUtilities.audit_record(audit_writer, key, "a", status="xm")
+
+    merged = tmpdir / "audit.csv"
+    with open(merged, "w", newline="") as fd:
+        count = swiftUtilities.audit_merge(swiftUtilities.audit_init(fd), paths)
+    assert count == len(node_list)
+    with open(merged, "r", newline="") as fd:
+        rows = list(csv.DictReader(fd))
+    assert [int(row["drupal_id"]) for row in rows] == list(node_list)
+    assert {row["status"] for row in rows} == {"xm"}
+
+
+# Test the deep audit verifies the streamed object bytes against the Swift metadata
+def test_audit_deep(tmpdir, mocker):
+    content = b"aip bytes" * 1000
+    headers = {
+        "etag": f'"{hashlib.md5(content).hexdigest()}"',
+        "x-object-meta-sha256sum": hashlib.sha256(content).hexdigest(),
+    }
+    conn = mocker.patch.object(swiftConnection, "new_connection").return_value
+    conn.get_object.side_effect = lambda container, name, resp_chunk_size: (
+        {},
+        iter([content[:4096], content[4096:]]),
+    )
+    path = tmpdir / "audit.csv"
+    deep = swiftUtilities.DeepAudit(2, None)
+    with open(path, "w", newline="") as fd:
+        audit_writer = swiftUtilities.audit_init(fd)
+        with swiftUtilities.DeepFixityCheck(None, "c", deep) as deep_check:
+            deep_check.submit(1, "aip_1.zip", headers, {}, (audit_writer, 1, "a"))
+            deep_check.submit(
+                2,
+                "aip_2.zip",
+                dict(headers, etag='"0"'),
+                {},
+                (audit_writer, 2, "a"),
+            )
+    assert deep_check.objects == 2
+    assert deep_check.bytes == 2 * len(content)
+    with open(path, "r", newline="") as fd:
+        rows = {int(row["drupal_id"]): row["status"] for row in csv.DictReader(fd)}
+    assert rows == {1: "", 2: "sw"}
+
+
+# Test the bandwidth limiter paces consumers to the cap
+def test_bandwidth_limiter(mocker):
+    sleep = mocker.patch.object(swiftUtilities.time, "sleep")
+    limiter = swiftUtilities.BandwidthLimiter(1000)
+    for _ in range(3):
+        limiter.consume(500)
+    assert sum(call.args[0] for call in sleep.call_args_list) > 0.9
+    swiftUtilities.BandwidthLimiter().consume(10**9)
+    assert sleep.call_count == 2